@@ -784,13 +784,13 @@ function applyDeviceCommand(text){
   return null;
 }
 
-// サーバー側のエージェント API にチャット履歴を送信して応答を取得
+// サーバー側のエージェント API にチャット履歴を送信し、応答トークンを逐次表示しながら最終応答を取得
 async function requestAssistantResponse(){
   const payload = {
     messages: chatHistory.map(({ role, content }) => ({ role, content })),
   };
 
-  const res = await fetch("/api/chat", {
+  const res = await fetch("/api/chat/stream", {
     method: "POST",
     headers: { "Content-Type": "application/json" },
     body: JSON.stringify(payload),
@@ -801,8 +801,122 @@ async function requestAssistantResponse(){
     throw new Error(errText || `HTTP ${res.status}`);
   }
 
-  const data = await res.json();
-  return typeof data.reply === "string" ? data.reply : "";
+  const progress = createProgressMessage();
+  try{
+    return await readChatStream(res, progress);
+  }finally{
+    progress.remove();
+  }
+}
+
+// 実行中のチャットの応答途中のテキストと進捗を一時的に表示するバブル（会話履歴には含めない）
+function createProgressMessage(){
+  const item = document.createElement("div");
+  item.className = "message message--assistant message--progress";
+  item.innerHTML = `
+    <div class="message__avatar">🤖</div>
+    <div>
+      <div class="message__bubble">応答を作成しています…</div>
+      <div class="message__meta">LLM ・ 処理中</div>
+    </div>
+  `;
+  logEl.appendChild(item);
+  logEl.scrollTop = logEl.scrollHeight;
+  const bubble = item.querySelector(".message__bubble");
+  const meta = item.querySelector(".message__meta");
+  return {
+    update(text){
+      bubble.textContent = text;
+      logEl.scrollTop = logEl.scrollHeight;
+    },
+    status(text){
+      meta.textContent = `LLM ・ ${text}`;
+    },
+    remove(){
+      item.remove();
+    },
+  };
+}
+
+// fetch の応答本文を Server-Sent Events として読み、イベントごとに handler を呼ぶ
+async function readEventStream(res, handler){
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  while(true){
+    const { value, done } = await reader.read();
+    if(done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let boundary;
+    while((boundary = buffer.indexOf("\n\n")) !== -1){
+      const block = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      let type = "message";
+      const dataLines = [];
+      for(const line of block.split("\n")){
+        if(line.startsWith("event:")){
+          type = line.slice(6).trim();
+        }else if(line.startsWith("data:")){
+          dataLines.push(line.slice(5).replace(/^ /, ""));
+        }
+      }
+      if(!dataLines.length) continue;
+      let data = {};
+      try{
+        data = JSON.parse(dataLines.join("\n"));
+      }catch(_err){
+        data = {};
+      }
+      if(handler(type, data) === false){
+        reader.cancel();
+        return;
+      }
+    }
+  }
+}
+
+// チャットのストリームを読み、reply_delta を吹き出しへ逐次描画して完了時の最終応答を返す
+async function readChatStream(res, progress){
+  let phase = null;
+  let text = "";
+  let reply = null;
+  let failure = null;
+
+  await readEventStream(res, (type, data) => {
+    if(type === "reply_delta"){
+      if(data.phase !== phase){
+        // 計画時の応答から結果の要約へ切り替わったら表示をやり直す
+        phase = data.phase;
+        text = "";
+      }
+      text += data.delta || "";
+      progress.update(text);
+    }else if(type === "plan"){
+      const count = Array.isArray(data.steps) ? data.steps.length : 0;
+      if(count) progress.status(`${count} 件のコマンドを実行します`);
+    }else if(type === "step_started"){
+      const label = data.device_label || data.device_id || "デバイス";
+      progress.status(`(${data.index}/${data.total}) ${label} で「${data.command}」を実行中`);
+    }else if(type === "step_completed"){
+      progress.status(`(${data.index}/${data.total}) 完了`);
+    }else if(type === "summarizing"){
+      progress.status("結果をまとめています");
+    }else if(type === "completed"){
+      reply = data.reply || "";
+      return false;
+    }else if(type === "failed"){
+      failure = data.error || "チャットの処理に失敗しました";
+      return false;
+    }else if(type === "closed"){
+      failure = "チャットの実行状況を取得できませんでした";
+      return false;
+    }
+    return true;
+  });
+
+  if(failure) throw new Error(failure);
+  if(reply === null) throw new Error("チャットの応答が途中で途切れました");
+  return reply;
 }
 
 // チャット送信時の処理。入力テキストを履歴に追加し、API 応答を待機
@@ -1,19 +1,38 @@
+import atexit
+import heapq
+import itertools
 import json
+import math
 
 # Flask ベースの IoT 管理サーバーとダッシュボード API を実装するモジュール
 # 標準ライブラリ：環境変数、時刻処理、識別子生成を扱う
 import os
+import sys
+import threading
 import time
 import uuid
-from collections import deque
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import Any, Deque, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, Generator, Iterable, Iterator, List, Optional, Set, Tuple
 
 # 外部依存：環境変数の読み込み、Web アプリ基盤、OpenAI クライアント
 from dotenv import load_dotenv as loadenv
-from flask import Flask, jsonify, redirect, request, session, url_for
+from flask import Flask, Response, jsonify, redirect, request, session, url_for
+from flask_sock import Sock
 from openai import OpenAI
 
+try:
+    # OpenAI SDK が使う HTTP ライブラリ（新しい SDK は httpx2、従来の SDK は httpx）
+    import httpx2 as httpx
+except ImportError:  # pragma: no cover - older openai SDK
+    import httpx
+
+from device_retrieval import DeviceTerms, build_device_terms, rank_devices
+from intent_router import IntentRouter, RouteTarget
+from job_store import create_job_store
+from state_broker import BROKER_ROLE, connect_state_broker
+
 
 ## ------------------------------------------------------------
 ## アプリケーション初期化
@@ -24,6 +43,7 @@ loadenv()
 
 app = Flask(__name__, static_folder=".", static_url_path="")
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "change-this-secret")
+sock = Sock(app)
 
 APP_PASSWORD = "kkawagoe"
 
@@ -32,6 +52,168 @@ AGENT_CAPABILITY_NAME = "agent_instruction"
 AGENT_COMMAND_NAME = "agent_instruction"
 
 
+class DeviceJobQueue:
+    # 優先度（高い順）→ 締め切り（早い順）→ 投入順でジョブを取り出すデバイス別キュー
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[int, float, float, int, Dict[str, Any]]] = []
+        self._counter = itertools.count()
+        # キュー上で有効なジョブ（job_id → ジョブ本体）。取り消しはここから外すだけで、
+        # ヒープ上の要素は取り出し時に墓標として読み飛ばす
+        self._live: Dict[str, Dict[str, Any]] = {}
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+    def __bool__(self) -> bool:
+        return bool(self._live)
+
+    def __contains__(self, job_id: object) -> bool:
+        return job_id in self._live
+
+    def push(
+        self,
+        job: Dict[str, Any],
+        *,
+        priority: int = 0,
+        deadline: Optional[float] = None,
+        queued_at: Optional[float] = None,
+    ) -> None:
+        # 同じ優先度・締め切りでは queued_at が早いものから取り出される
+        deadline_key = deadline if deadline is not None else float("inf")
+        queued_key = queued_at if queued_at is not None else time.time()
+        job_id = job.get("job_id")
+        if isinstance(job_id, str):
+            self._live[job_id] = job
+        heapq.heappush(
+            self._heap, (-priority, deadline_key, queued_key, next(self._counter), job)
+        )
+
+    def pop(self) -> Dict[str, Any]:
+        # 取り消し済み（墓標）の要素を読み飛ばし、有効な先頭ジョブを返す
+        while True:
+            job = heapq.heappop(self._heap)[-1]
+            job_id = job.get("job_id")
+            if not isinstance(job_id, str):
+                return job
+            if self._live.get(job_id) is job:
+                del self._live[job_id]
+                return job
+
+    def remove(self, job_id: str) -> bool:
+        # 指定ジョブを O(1) で取り消し、見つかったかどうかを返す
+        if self._live.pop(job_id, None) is None:
+            return False
+        if len(self._heap) > 2 * len(self._live) + 32:
+            # 墓標が溜まりすぎたら有効なジョブだけでヒープを組み直す
+            self._heap = [
+                entry for entry in self._heap
+                if self._live.get(entry[-1].get("job_id")) is entry[-1]
+            ]
+            heapq.heapify(self._heap)
+        return True
+
+
+class CompletedJobStore:
+    # 完了ジョブの結果を格納順（最近更新したものが末尾）に保持する LRU ストア
+
+    def __init__(self) -> None:
+        # job_id → (結果, 推定バイト数, 格納時刻)
+        self._entries: "OrderedDict[str, Tuple[Dict[str, Any], int, float]]" = OrderedDict()
+        self.total_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, job_id: object) -> bool:
+        return job_id in self._entries
+
+    def __getitem__(self, job_id: str) -> Dict[str, Any]:
+        return self._entries[job_id][0]
+
+    def get(self, job_id: str, default: Any = None) -> Any:
+        entry = self._entries.get(job_id)
+        return entry[0] if entry is not None else default
+
+    def put(self, job_id: str, result: Dict[str, Any], *, stored_at: Optional[float] = None) -> None:
+        # 既存エントリは置き換えて末尾へ移動する（いずれも O(1)）。stored_at は time.monotonic() 基準の格納時刻
+        size = len(json.dumps(result, ensure_ascii=False, default=str))
+        previous = self._entries.pop(job_id, None)
+        if previous is not None:
+            self.total_bytes -= previous[1]
+        self._entries[job_id] = (result, size, time.monotonic() if stored_at is None else stored_at)
+        self.total_bytes += size
+
+    def evict(self, *, max_count: int, max_bytes: int, max_age: float) -> Iterator[str]:
+        # 件数・合計バイト数・経過秒数のいずれかの上限を超えている間、最古から破棄する
+        cutoff = time.monotonic() - max_age if max_age > 0 else None
+        while self._entries:
+            job_id, (_, size, stored_at) = next(iter(self._entries.items()))
+            if (
+                len(self._entries) <= max_count
+                and (max_bytes <= 0 or self.total_bytes <= max_bytes)
+                and (cutoff is None or stored_at >= cutoff)
+            ):
+                return
+            self._entries.popitem(last=False)
+            self.total_bytes -= size
+            yield job_id
+
+
+class ResultMailbox:
+    # 結果待ちのリクエストへ渡すまでジョブ結果を預かる、件数・保持期間付きの受け箱
+
+    def __init__(self) -> None:
+        # job_id → (結果, 格納時刻)。格納順に並ぶため最古のものから破棄できる
+        self._entries: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, job_id: object) -> bool:
+        return job_id in self._entries
+
+    def put(self, job_id: str, result: Dict[str, Any]) -> int:
+        # 結果を格納し、上限を超えた古い結果を破棄して破棄件数を返す
+        with self._lock:
+            self._entries.pop(job_id, None)
+            self._entries[job_id] = (result, time.monotonic())
+        return self.evict(max_count=MAILBOX_MAX_RESULTS, max_age=MAILBOX_RESULT_TTL)
+
+    def pop(self, job_id: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.pop(job_id, None)
+        return entry[0] if entry is not None else default
+
+    def evict(self, *, max_count: int, max_age: float) -> int:
+        # 件数上限または保持期間を超えた結果を最古から破棄する
+        cutoff = time.monotonic() - max_age if max_age > 0 else None
+        evicted = 0
+        with self._lock:
+            while self._entries:
+                _, stored_at = next(iter(self._entries.values()))
+                if len(self._entries) <= max_count and (cutoff is None or stored_at >= cutoff):
+                    break
+                self._entries.popitem(last=False)
+                evicted += 1
+        return evicted
+
+
+# デバイス単位の状態（キュー・リース・そのデバイスのジョブメタデータ）を守るストライプロック。
+# デバイス ID のハッシュでロックを選ぶため、別デバイスへの操作は互いに待たされない
+JOB_LOCK_STRIPES = max(1, int(os.getenv("JOB_LOCK_STRIPES", "64")))
+_DEVICE_LOCK_STRIPES = [threading.RLock() for _ in range(JOB_LOCK_STRIPES)]
+# _DEVICES / _PENDING_JOBS / _JOB_METADATA / 完了ジョブストアの登録・削除と
+# デバイス別索引を守る小さなグローバルロック。取得順は必ずデバイスロック → グローバルロック
+_STATE_LOCK = threading.RLock()
+
+
+def _device_lock(device_id: Optional[str]) -> threading.RLock:
+    # device_id に対応するストライプロックを返す
+    return _DEVICE_LOCK_STRIPES[hash(device_id) % len(_DEVICE_LOCK_STRIPES)]
+
+
 @dataclass
 class DeviceState:
     # メモリ上に保持するエッジデバイスの状態情報
@@ -43,9 +225,9 @@ class DeviceState:
     # 任意メタデータ（表示名や説明など）
     meta: Dict[str, Any]
     # エッジデバイスが取得するジョブの待ち行列
-    job_queue: Deque[Dict[str, Any]] = field(default_factory=deque)
-    # 完了したジョブ結果を job_id ごとに保持
-    job_results: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    job_queue: DeviceJobQueue = field(default_factory=DeviceJobQueue)
+    # 結果待ちのリクエストへ渡すまでジョブ結果を job_id ごとに預かる受け箱
+    job_results: ResultMailbox = field(default_factory=ResultMailbox)
     # 最後にポーリングされた時刻（UNIX 時刻）
     last_seen: float = field(default_factory=time.time)
     # 直近のジョブ結果
@@ -54,22 +236,153 @@ class DeviceState:
     registered_at: float = field(default_factory=time.time)
     # 管理者承認済みかどうか
     approved: bool = False
+    # ロングポーリング中のリクエストへ新規ジョブを通知する条件変数（デバイスのストライプロックを共有）
+    job_ready: threading.Condition = field(init=False, repr=False, compare=False)
+    # 配信済みでリース期間中のジョブ ID（ハートビートで一括延長する対象）
+    leased_job_ids: Set[str] = field(default_factory=set)
+    # 結果待ち（キュー上・配信済み）のジョブ ID を投入順に保持する索引
+    pending_job_ids: Dict[str, None] = field(default_factory=dict)
+    # メタデータを保持している全ジョブ ID を投入順に保持する索引（履歴表示用）
+    job_ids: Dict[str, None] = field(default_factory=dict)
+    # プロンプト用の状況サマリーの版数（登録・更新・結果受信で進め、キャッシュ済みのブロックを無効にする）
+    context_version: int = field(default=0, compare=False)
+    # (版数, キューの長さ, 結果待ちの件数, 最終確認の秒) をキーにキャッシュした状況サマリーのブロック
+    context_block: Optional[Tuple[Tuple[int, int, int, int], str]] = field(default=None, repr=False, compare=False)
+    # (版数, 関連度の索引, 1 行の概要) のキャッシュ（デバイス数が多いときのプロンプト絞り込み用）
+    context_index: Optional[Tuple[int, DeviceTerms, str]] = field(default=None, repr=False, compare=False)
+    # 共有状態モードのワーカーのミラーでは、ブローカー側の (キュー上のジョブ数, 結果待ちのジョブ数) を写して持つ
+    mirrored_job_counts: Optional[Tuple[int, int]] = field(default=None, compare=False)
+
+    def __post_init__(self) -> None:
+        self.job_ready = threading.Condition(_device_lock(self.device_id))
 
 
 # メモリ上でデバイス情報と進行中ジョブを管理する辞書
 _DEVICES: Dict[str, DeviceState] = {}
 _PENDING_JOBS: Dict[str, str] = {}
 _JOB_METADATA: Dict[str, Dict[str, Any]] = {}
-_COMPLETED_JOBS: Dict[str, Dict[str, Any]] = {}
-_COMPLETED_JOB_ORDER: Deque[str] = deque()
+_COMPLETED_JOBS = CompletedJobStore()
+# 結果待ちのリクエストを起こすためのジョブ単位の完了イベント
+_JOB_RESULT_EVENTS: Dict[str, threading.Event] = {}
+# ASGI モード（asgi.py）で待機中のコルーチンを起こすコールバック。
+# デバイス ID ごと（新規ジョブ）とジョブ ID ごと（結果到着）に登録される
+_ASYNC_DEVICE_WAKERS: Dict[str, Set[Callable[[], None]]] = {}
+_ASYNC_RESULT_WAKERS: Dict[str, Set[Callable[[], None]]] = {}
+# チャット実行 ID ごと（進捗イベント追加）
+_ASYNC_CHAT_RUN_WAKERS: Dict[str, Set[Callable[[], None]]] = {}
+# 配信済みジョブのリース期限を (期限, job_id) で管理するタイマーヒープ
+_LEASE_HEAP: List[Tuple[float, str]] = []
+_LEASE_CONDITION = threading.Condition()
 
 
 MAX_COMPLETED_JOBS = int(os.getenv("MAX_COMPLETED_JOBS", "200"))
+# 完了ジョブ結果の合計サイズ上限（JSON 換算のバイト数、0 で無制限）
+MAX_COMPLETED_JOB_BYTES = int(os.getenv("MAX_COMPLETED_JOB_BYTES", str(32 * 1024 * 1024)))
+# 完了ジョブ結果を保持する最大秒数（0 で無期限）
+COMPLETED_JOB_TTL = float(os.getenv("COMPLETED_JOB_TTL", "86400"))
 
 
 # デバイスがジョブ結果を返さない場合にタイムアウトとみなす秒数
 DEVICE_RESULT_TIMEOUT = float(os.getenv("DEVICE_RESULT_TIMEOUT", "120"))
 
+# チャット由来（対話的）のジョブと、それ以外のジョブの既定優先度
+JOB_PRIORITY_INTERACTIVE = int(os.getenv("JOB_PRIORITY_INTERACTIVE", "10"))
+JOB_PRIORITY_DEFAULT = int(os.getenv("JOB_PRIORITY_DEFAULT", "0"))
+_INTERACTIVE_JOB_SOURCES = {"llm", "agent"}
+
+# デバイスごとの結果受け箱に預ける最大件数と保持秒数。
+# 誰も待っていない結果（wait_for_result=false やタイムアウト後の到着）はここで破棄される
+MAILBOX_MAX_RESULTS = int(os.getenv("MAILBOX_MAX_RESULTS", "100"))
+MAILBOX_RESULT_TTL = float(os.getenv("MAILBOX_RESULT_TTL", "300"))
+# 受け箱の期限切れ結果を掃除するバックグラウンドスレッドの実行間隔（秒）
+MAILBOX_SWEEP_INTERVAL = float(os.getenv("MAILBOX_SWEEP_INTERVAL", "30"))
+
+# デバイス・ジョブ状態の永続化エンジン（memory: 永続化なし / sqlite: WAL モードの SQLite）
+JOB_STORE = os.getenv("JOB_STORE", "memory")
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "iot_agent.db")
+# SQLite エンジンで書き込みを 1 トランザクションにまとめる待ち時間（秒）
+JOB_STORE_COMMIT_INTERVAL = float(os.getenv("JOB_STORE_COMMIT_INTERVAL", "0.05"))
+
+# 複数ワーカー構成では状態をブローカープロセスに集約する（gunicorn.conf.py が自動設定）。
+# _BROKER が None のプロセス（単一プロセス起動またはブローカー自身）が状態を保持する
+STATE_BROKER_ADDRESS = os.getenv("STATE_BROKER_ADDRESS", "").strip()
+_BROKER = (
+    connect_state_broker(STATE_BROKER_ADDRESS)
+    if STATE_BROKER_ADDRESS and os.getenv("IOT_AGENT_STATE_ROLE") != BROKER_ROLE
+    else None
+)
+
+# 永続化はブローカー側だけが行う
+_JOB_STORE = create_job_store(
+    JOB_STORE if _BROKER is None else "memory",
+    path=JOB_STORE_PATH,
+    commit_interval=JOB_STORE_COMMIT_INTERVAL,
+)
+
+# 配信したジョブのリース秒数。期限までに結果もハートビートも無ければ再配信する
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "30"))
+# 1 ジョブを配信する最大回数。超えた場合は失敗として結果待ちへ通知する
+JOB_MAX_DELIVERIES = int(os.getenv("JOB_MAX_DELIVERIES", "3"))
+# 全配信分のリースが DEVICE_RESULT_TIMEOUT 内に収まるよう配信回数を抑える
+# （結果待ちが先にタイムアウトすると lease_expired の失敗が誰にも届かないため）
+if JOB_LEASE_SECONDS > 0 and JOB_LEASE_SECONDS * JOB_MAX_DELIVERIES >= DEVICE_RESULT_TIMEOUT:
+    _fitting_deliveries = max(1, int((DEVICE_RESULT_TIMEOUT - 1) // JOB_LEASE_SECONDS))
+    app.logger.warning(
+        "JOB_LEASE_SECONDS (%s) x JOB_MAX_DELIVERIES (%s) exceeds DEVICE_RESULT_TIMEOUT (%s); "
+        "limiting deliveries to %s.",
+        JOB_LEASE_SECONDS,
+        JOB_MAX_DELIVERIES,
+        DEVICE_RESULT_TIMEOUT,
+        _fitting_deliveries,
+    )
+    JOB_MAX_DELIVERIES = _fitting_deliveries
+
+# /jobs/next の ?wait= で待機できる最大秒数（ロングポーリング）
+MAX_LONG_POLL_WAIT = float(os.getenv("MAX_LONG_POLL_WAIT", "30"))
+
+# /jobs/next の ?max= で一度に取り出せるジョブ数の上限
+MAX_JOBS_PER_POLL = int(os.getenv("MAX_JOBS_PER_POLL", "20"))
+
+# SSE ストリームでジョブが無い間に keep-alive コメントを送る間隔（秒）
+SSE_KEEPALIVE_INTERVAL = float(os.getenv("SSE_KEEPALIVE_INTERVAL", "15"))
+
+# WebSocket チャネルでデバイスから何も届かない場合に切断するまでの秒数
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "90"))
+
+# 非同期モード（"async": true）のチャットを実行するワーカースレッド数
+CHAT_RUN_WORKERS = max(1, int(os.getenv("CHAT_RUN_WORKERS", "8")))
+# 完了したチャット実行の進捗と応答を保持する件数と秒数
+MAX_CHAT_RUNS = int(os.getenv("MAX_CHAT_RUNS", "200"))
+CHAT_RUN_TTL = float(os.getenv("CHAT_RUN_TTL", "3600"))
+
+# LLM が計画を出力している途中で、確定したコマンドを先行してデバイスへ送信するか
+SPECULATIVE_DISPATCH = os.getenv("SPECULATIVE_DISPATCH", "1").strip().lower() not in {"0", "false", "no", "off"}
+# 単発の直接操作（「LED を 3 回点滅して」など）を LLM を介さずにコマンドへ変換するか
+INTENT_ROUTER = os.getenv("INTENT_ROUTER", "1").strip().lower() not in {"0", "false", "no", "off"}
+# 全ステップが成功し戻り値が数値・真偽値・値なしのときは、要約用の LLM を呼ばずに定型文で最終応答を作るか
+TEMPLATE_SUMMARIES = os.getenv("TEMPLATE_SUMMARIES", "1").strip().lower() not in {"0", "false", "no", "off"}
+# 定型文で要約する最大ステップ数
+TEMPLATE_SUMMARY_MAX_STEPS = int(os.getenv("TEMPLATE_SUMMARY_MAX_STEPS", "3"))
+
+# OpenAI API への接続プール（プロセス内の全チャットで 1 つのクライアントを共有する）
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "10"))
+# アイドル状態の接続を保持する秒数（短いとチャットの間隔が空くたびに TLS 接続をやり直す）
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "90"))
+# 1 回の API 呼び出しのタイムアウト（ストリーミング時は断片の受信間隔）と接続確立のタイムアウト
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+# 起動時に API への接続を確立しておき、最初のチャットで TCP / TLS 接続の待ち時間を払わないようにするか
+OPENAI_WARMUP = os.getenv("OPENAI_WARMUP", "0").strip().lower() not in {"0", "false", "no", "off"}
+
+# プロンプトに詳しい情報を載せるデバイス数（登録数がこれを超えると発話に関連する上位だけを載せる。0 で常に全デバイス）
+DEVICE_CONTEXT_TOP_K = int(os.getenv("DEVICE_CONTEXT_TOP_K", "10"))
+# 上位以外のデバイスを 1 行の概要で載せる件数の上限
+DEVICE_CONTEXT_MAX_COMPACT = int(os.getenv("DEVICE_CONTEXT_MAX_COMPACT", "200"))
+# 設置場所として関連度の判定に使うメタ情報のキー
+_LOCATION_META_KEYS = ("location", "room", "place", "area", "site")
+
 
 def _normalise_capability_params(params: Any) -> List[Dict[str, Any]]:
     # capability の params 部分を検証・整形するユーティリティ
@@ -157,13 +470,88 @@ def _normalise_capabilities(raw_capabilities: Any) -> List[Dict[str, Any]]:
     return cleaned_capabilities
 
 
+_OPENAI_CLIENT: Optional[OpenAI] = None
+_OPENAI_CLIENT_LOCK = threading.Lock()
+# OpenAI API への HTTP リクエスト数と、新たに確立した接続・TLS ハンドシェイクの数（/api/stats で公開する）
+_OPENAI_POOL_LOCK = threading.Lock()
+_OPENAI_POOL_STATS = {"requests": 0, "connections_opened": 0, "tls_handshakes": 0}
+_OPENAI_TRACE_COUNTERS = {
+    "connection.connect_tcp.complete": "connections_opened",
+    "connection.start_tls.complete": "tls_handshakes",
+}
+
+
+def _trace_openai_connection(name: str, info: Dict[str, Any]) -> None:
+    # HTTP 接続の確立イベントを数える（接続プールの接続を再利用した場合は呼ばれない）
+    counter = _OPENAI_TRACE_COUNTERS.get(name)
+    if counter is not None:
+        with _OPENAI_POOL_LOCK:
+            _OPENAI_POOL_STATS[counter] += 1
+
+
+def _count_openai_request(request: Any) -> None:
+    # OpenAI API への HTTP リクエストを数え、接続確立を数えるトレースを仕掛ける
+    with _OPENAI_POOL_LOCK:
+        _OPENAI_POOL_STATS["requests"] += 1
+    request.extensions["trace"] = _trace_openai_connection
+
+
+def _openai_http_options() -> Dict[str, Any]:
+    # 同期・非同期クライアント共通の接続プールとタイムアウトの設定
+    return {
+        "limits": httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+        "follow_redirects": True,
+    }
+
+
+def _openai_pool_stats() -> Dict[str, Any]:
+    # /api/stats 向けに接続の再利用状況を返す（このプロセスのクライアントの値）
+    with _OPENAI_POOL_LOCK:
+        stats: Dict[str, Any] = dict(_OPENAI_POOL_STATS)
+    stats["connections_reused"] = max(0, stats["requests"] - stats["connections_opened"])
+    stats["reuse_rate"] = round(stats["connections_reused"] / stats["requests"], 3) if stats["requests"] else 0.0
+    return stats
+
+
 def _client() -> OpenAI:
-    # OpenAI API クライアントを生成し、API キーが無い場合は例外を送出
+    # プロセス全体で共有する OpenAI API クライアントを返し、API キーが無い場合は例外を送出
+    # （接続プールを使い回し、チャットごとに TCP / TLS 接続を確立し直さないようにする）
+    global _OPENAI_CLIENT
+    if _OPENAI_CLIENT is not None:
+        return _OPENAI_CLIENT
+    with _OPENAI_CLIENT_LOCK:
+        if _OPENAI_CLIENT is None:
+            api_key = os.getenv("OPENAI_API_KEY")
+            if not api_key:
+                raise RuntimeError("OPENAI_API_KEY is not set")
+            options = _openai_http_options()
+            _OPENAI_CLIENT = OpenAI(
+                api_key=api_key,
+                timeout=options["timeout"],
+                max_retries=OPENAI_MAX_RETRIES,
+                http_client=httpx.Client(**options, event_hooks={"request": [_count_openai_request]}),
+            )
+        return _OPENAI_CLIENT
+
+
+def _warm_up_openai_client() -> None:
+    # 軽量な API 呼び出しで接続プールに接続を 1 本用意しておく（失敗しても通常どおり動作する）
+    try:
+        _client().with_options(max_retries=0).models.list()
+    except Exception as exc:  # pragma: no cover - network/SDK errors
+        app.logger.warning("OpenAI warm-up failed: %s", exc)
 
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise RuntimeError("OPENAI_API_KEY is not set")
-    return OpenAI(api_key=api_key)
+
+def start_openai_warmup() -> None:
+    # OPENAI_WARMUP が有効なら、このプロセスの接続プールをバックグラウンドで温めておく
+    # （Gunicorn ワーカー・ブローカー・開発サーバーの起動時に呼ぶ。ASGI 版は asgi.py が非同期クライアントを温める）
+    if OPENAI_WARMUP and os.getenv("OPENAI_API_KEY"):
+        threading.Thread(target=_warm_up_openai_client, name="openai-warmup", daemon=True).start()
 
 
 def _first_device_id() -> Optional[str]:
@@ -284,121 +672,620 @@ def _describe_device_role(device: DeviceState) -> List[str]:
     return lines
 
 
-def _build_device_context() -> str:
-    # LLM へのプロンプトに用いる全デバイスの状況サマリーを構築
-    if not _DEVICES:
+def _touch_device_context(device: DeviceState) -> None:
+    # 機能・メタ情報・直近の結果が変わったデバイスの状況サマリーを作り直させる
+    device.context_version += 1
+
+
+def _build_device_context(
+    messages: Optional[List[Dict[str, str]]] = None, focus_device_ids: Iterable[Optional[str]] = ()
+) -> str:
+    # LLM へのプロンプトに用いるデバイスの状況サマリーを、デバイスごとのキャッシュ済みブロックから組み立てる
+    # messages を渡した場合、登録数が DEVICE_CONTEXT_TOP_K を超えていれば会話に関連する上位のデバイス
+    # （と focus_device_ids・エージェント役）だけを詳しく載せ、残りは 1 行の概要にする
+    devices = list(_DEVICES.values())
+    if not devices:
         return "No devices are currently registered."
+    if messages is None or DEVICE_CONTEXT_TOP_K <= 0 or len(devices) <= DEVICE_CONTEXT_TOP_K:
+        return "\n\n".join(_device_context_block(device) for device in devices)
 
-    lines: List[str] = []
-    for device in _DEVICES.values():
-        lines.append(f"Device ID: {device.device_id}")
-        display_name = device.meta.get("display_name") if isinstance(device.meta, dict) else None
-        if isinstance(display_name, str) and display_name.strip():
-            lines.append(f"  Friendly name: {display_name.strip()}")
-        lines.extend(_describe_device_role(device))
-        if device.meta:
-            lines.append(f"  Meta: {json.dumps(device.meta, ensure_ascii=False)}")
+    ranked = rank_devices(
+        _device_context_queries(messages),
+        [(device.device_id, _device_context_index(device)[0]) for device in devices],
+        DEVICE_CONTEXT_TOP_K,
+    )
+    if not ranked:
+        # 会話から手掛かりが得られない場合は、最近通信したデバイスを優先する
+        recent = sorted(devices, key=lambda device: device.last_seen, reverse=True)
+        ranked = [device.device_id for device in recent[:DEVICE_CONTEXT_TOP_K]]
+    selected: Dict[str, None] = dict.fromkeys(
+        device_id for device_id in focus_device_ids if isinstance(device_id, str) and device_id in _DEVICES
+    )
+    selected.update(dict.fromkeys(device.device_id for device in devices if _device_is_agent(device)))
+    selected.update(dict.fromkeys(ranked))
+
+    blocks = [_device_context_block(_DEVICES[device_id]) for device_id in selected if device_id in _DEVICES]
+    others = [device for device in devices if device.device_id not in selected]
+    if others:
+        compact = [_device_context_index(device)[1] for device in others[:DEVICE_CONTEXT_MAX_COMPACT]]
+        if len(others) > len(compact):
+            compact.append(f"- ... and {len(others) - len(compact)} more devices not shown")
+        blocks.append(
+            "Other registered devices (summary only; use one of them only when the user clearly refers to it):\n"
+            + "\n".join(compact)
+        )
+    return "\n\n".join(blocks)
+
+
+def _device_job_counts(device: DeviceState) -> Tuple[int, int]:
+    # (キュー上のジョブ数, 結果待ちのジョブ数) を返す（ワーカーのミラーではブローカーのスナップショットの値）
+    if device.mirrored_job_counts is not None:
+        return device.mirrored_job_counts
+    return len(device.job_queue), len(device.pending_job_ids)
+
+
+def _device_context_block(device: DeviceState) -> str:
+    # 1 台分の状況サマリーをキャッシュから返す（版数・ジョブ数・最終確認の秒が変わったら作り直す）
+    key = (device.context_version, *_device_job_counts(device), int(device.last_seen))
+    cached = device.context_block
+    if cached is None or cached[0] != key:
+        cached = (key, _render_device_context_block(device))
+        device.context_block = cached
+    return cached[1]
+
+
+def _device_context_index(device: DeviceState) -> Tuple[DeviceTerms, str]:
+    # 関連度の索引と 1 行の概要をキャッシュから返す（版数が変わったら作り直す）
+    cached = device.context_index
+    if cached is not None and cached[0] == device.context_version:
+        return cached[1], cached[2]
+
+    meta = device.meta if isinstance(device.meta, dict) else {}
+    display_name = meta.get("display_name")
+    locations = [meta[key] for key in _LOCATION_META_KEYS if isinstance(meta.get(key), str)]
+    labels = [device.device_id, *([display_name] if isinstance(display_name, str) else []), *locations]
+    texts: List[str] = []
+    for capability in device.capabilities:
+        texts.append(str(capability.get("name", "")))
+        texts.append(str(capability.get("description", "")))
+        texts.extend(str(param.get("name", "")) for param in capability.get("params") or [] if isinstance(param, dict))
+    for key in ("description", "role", "device_role"):
+        if isinstance(meta.get(key), str):
+            texts.append(meta[key])
+    terms = build_device_terms(labels, texts)
+
+    names = ", ".join(str(capability.get("name")) for capability in device.capabilities) or "no capabilities"
+    details = [value.strip() for value in (display_name, *locations) if isinstance(value, str) and value.strip()]
+    line = f"- {device.device_id}" + (f" ({' / '.join(details)})" if details else "") + f": {names}"
+    device.context_index = (device.context_version, terms, line)
+    return terms, line
+
+
+def _device_context_queries(messages: List[Dict[str, str]]) -> List[Tuple[str, float]]:
+    # 関連度の判定に使う発話（最新のユーザー発話を重く、直前のやり取りを軽く数える）
+    queries: List[Tuple[str, float]] = []
+    recent = [message for message in messages if isinstance(message.get("content"), str)][-5:]
+    for position, message in enumerate(reversed(recent)):
+        weight = 1.0 if position == 0 and message.get("role") == "user" else 0.5
+        queries.append((message["content"], weight))
+    return queries
+
+
+def _render_device_context_block(device: DeviceState) -> str:
+    # 1 台分の状況サマリー（ID・役割・メタ情報・機能・直近の結果）を文字列化する
+    lines: List[str] = [f"Device ID: {device.device_id}"]
+    display_name = device.meta.get("display_name") if isinstance(device.meta, dict) else None
+    if isinstance(display_name, str) and display_name.strip():
+        lines.append(f"  Friendly name: {display_name.strip()}")
+    lines.extend(_describe_device_role(device))
+    if device.meta:
+        lines.append(f"  Meta: {json.dumps(device.meta, ensure_ascii=False)}")
+    lines.append(
+        "  Registered at: "
+        + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(device.registered_at))
+    )
+    lines.append(
+        "  Last seen: "
+        + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(device.last_seen))
+    )
+    queue_depth, pending_jobs = _device_job_counts(device)
+    lines.append(f"  Queue depth: {queue_depth}")
+    if pending_jobs > queue_depth:
+        lines.append(f"  Jobs running on device: {pending_jobs - queue_depth}")
+    lines.append("  Capabilities:")
+    for cap in device.capabilities:
+        params = cap.get("params") or []
+        if params:
+            param_desc = ", ".join(
+                f"{p.get('name')} ({p.get('type', 'unknown')})"
+                + (
+                    f" default={json.dumps(p.get('default'))}"
+                    if p.get("default") is not None
+                    else ""
+                )
+                for p in params
+            )
+        else:
+            param_desc = "no parameters"
         lines.append(
-            "  Registered at: "
-            + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(device.registered_at))
+            f"    - {cap.get('name')}: {cap.get('description', '')} | params: {param_desc}"
         )
+    if device.last_result:
+        summary = {
+            "job_id": device.last_result.get("job_id"),
+            "ok": device.last_result.get("ok"),
+            "return_value": device.last_result.get("return_value"),
+        }
         lines.append(
-            "  Last seen: "
-            + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(device.last_seen))
+            "  Most recent result: "
+            + json.dumps(summary, ensure_ascii=False, default=str)
         )
-        lines.append(f"  Queue depth: {len(device.job_queue)}")
-        lines.append("  Capabilities:")
-        for cap in device.capabilities:
-            params = cap.get("params") or []
-            if params:
-                param_desc = ", ".join(
-                    f"{p.get('name')} ({p.get('type', 'unknown')})"
-                    + (
-                        f" default={json.dumps(p.get('default'))}"
-                        if p.get("default") is not None
-                        else ""
-                    )
-                    for p in params
-                )
-            else:
-                param_desc = "no parameters"
-            lines.append(
-                f"    - {cap.get('name')}: {cap.get('description', '')} | params: {param_desc}"
-            )
-        if device.last_result:
-            summary = {
-                "job_id": device.last_result.get("job_id"),
-                "ok": device.last_result.get("ok"),
-                "return_value": device.last_result.get("return_value"),
-            }
-            lines.append(
-                "  Most recent result: "
-                + json.dumps(summary, ensure_ascii=False, default=str)
-            )
-        lines.append("")
     return "\n".join(lines).strip()
 
 
 def _store_completed_job(job_id: Optional[str], result: Dict[str, Any]) -> None:
     # 完了済みジョブの結果を保持し、必要に応じて古いものを破棄
+    _store_completed_jobs([(job_id, result)])
 
-    if not isinstance(job_id, str) or not job_id:
-        return
 
-    _COMPLETED_JOBS[job_id] = dict(result)
+def _store_completed_jobs(entries: List[Tuple[Optional[str], Dict[str, Any]]]) -> None:
+    # 複数の完了ジョブをまとめて保持し、古いものの破棄は最後に一度だけ行う
+
+    with _STATE_LOCK:
+        for job_id, result in entries:
+            if not isinstance(job_id, str) or not job_id:
+                continue
+
+            _COMPLETED_JOBS.put(job_id, dict(result))
+            _JOB_STORE.save_result(job_id, result)
+
+        _prune_completed_jobs()
+
+
+def _prune_completed_jobs() -> None:
+    # 件数・サイズ・保持期間の上限を超えた完了ジョブを、メタデータや索引ごと破棄する
+    evicted: List[str] = []
+    with _STATE_LOCK:
+        for oldest in _COMPLETED_JOBS.evict(
+            max_count=MAX_COMPLETED_JOBS,
+            max_bytes=MAX_COMPLETED_JOB_BYTES,
+            max_age=COMPLETED_JOB_TTL,
+        ):
+            evicted.append(oldest)
+            metadata = _JOB_METADATA.pop(oldest, None)
+            device = _DEVICES.get((metadata or {}).get("device_id"))
+            if device is not None:
+                device.job_ids.pop(oldest, None)
+    if evicted:
+        _JOB_STORE.delete_jobs(evicted)
+
+
+def _sweep_result_mailboxes() -> int:
+    # 全デバイスの受け箱から期限切れの結果を破棄し、破棄件数を返す
+    evicted = 0
+    for device in list(_DEVICES.values()):
+        evicted += device.job_results.evict(
+            max_count=MAILBOX_MAX_RESULTS, max_age=MAILBOX_RESULT_TTL
+        )
+    return evicted
+
+
+def _mailbox_sweeper_loop() -> None:
+    # 新しい結果が届かないデバイスの受け箱も、一定間隔で期限切れを掃除する
+    while True:
+        time.sleep(MAILBOX_SWEEP_INTERVAL)
+        try:
+            _sweep_result_mailboxes()
+            _prune_completed_jobs()
+        except Exception:  # pragma: no cover - keep the sweeper alive
+            app.logger.exception("Failed to sweep result mailboxes")
+
+
+def _process_rss_bytes() -> Optional[int]:
+    # 現在のプロセスの常駐メモリ（RSS）をバイト数で返す。取得できない環境では None
     try:
-        _COMPLETED_JOB_ORDER.remove(job_id)
-    except ValueError:
+        with open("/proc/self/statm", "r", encoding="ascii") as handle:
+            return int(handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
         pass
-    _COMPLETED_JOB_ORDER.append(job_id)
+    try:
+        import resource
+
+        # /proc が無い環境（macOS など）では最大 RSS で代用する
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+    except (ImportError, OSError):
+        return None
+
+
+def _persist_job(job_id: Optional[str]) -> None:
+    # ジョブメタデータの現在の内容をストレージへ書き出す
+    metadata = _JOB_METADATA.get(job_id) if job_id else None
+    if metadata is not None:
+        _JOB_STORE.save_job(metadata)
+
+
+def _persist_device(device: DeviceState) -> None:
+    # 再起動後に復元が必要なデバイス情報（承認状態・機能・メタ情報）を書き出す
+    _touch_device_context(device)
+    _JOB_STORE.save_device(
+        {
+            "device_id": device.device_id,
+            "capabilities": device.capabilities,
+            "meta": device.meta,
+            "registered_at": device.registered_at,
+            "approved": device.approved,
+            "last_seen": device.last_seen,
+        }
+    )
+
 
-    while len(_COMPLETED_JOB_ORDER) > MAX_COMPLETED_JOBS:
-        oldest = _COMPLETED_JOB_ORDER.popleft()
-        _COMPLETED_JOBS.pop(oldest, None)
-        _JOB_METADATA.pop(oldest, None)
+def _restore_from_store() -> None:
+    # 起動時にストレージからデバイスとジョブを読み込み、未完了ジョブをキューへ戻す
+    devices, jobs, results = _JOB_STORE.load()
+    for record in devices:
+        device_id = record.get("device_id")
+        if not isinstance(device_id, str) or not device_id:
+            continue
+        _DEVICES[device_id] = DeviceState(
+            device_id=device_id,
+            capabilities=record.get("capabilities") or [],
+            meta=record.get("meta") or {},
+            last_seen=record.get("last_seen") or time.time(),
+            registered_at=record.get("registered_at") or time.time(),
+            approved=bool(record.get("approved")),
+        )
+
+    completed: List[Tuple[float, str]] = []
+    for metadata in jobs:
+        job_id = metadata.get("job_id")
+        if not isinstance(job_id, str) or not job_id:
+            continue
+        _JOB_METADATA[job_id] = metadata
+        device = _DEVICES.get(metadata.get("device_id"))
+        if device is not None:
+            device.job_ids[job_id] = None
+
+        status = metadata.get("status")
+        if status in {"pending", "dispatched"} and device is not None:
+            # 配信済みでもリースは引き継げないため、再起動後は未配信として扱い直す
+            metadata["status"] = "pending"
+            metadata.pop("lease_expires_at", None)
+            _PENDING_JOBS[job_id] = device.device_id
+            device.pending_job_ids[job_id] = None
+            device.job_queue.push(
+                {"job_id": job_id, "command": metadata.get("command") or {}},
+                priority=metadata.get("priority") or 0,
+                deadline=metadata.get("deadline"),
+                queued_at=metadata.get("queued_at"),
+            )
+        elif status == "completed" and job_id in results:
+            completed.append((float(metadata.get("completed_at") or time.time()), job_id))
+
+    # 完了結果は元の完了時刻を格納時刻として古い順に戻し、再起動で保持期限が延びないようにする
+    now, monotonic_now = time.time(), time.monotonic()
+    for completed_at, job_id in sorted(completed):
+        _COMPLETED_JOBS.put(job_id, results[job_id], stored_at=monotonic_now - max(0.0, now - completed_at))
+
+    _prune_completed_jobs()
+
+
+def _add_async_waker(
+    registry: Dict[str, Set[Callable[[], None]]], key: str, waker: Callable[[], None]
+) -> None:
+    # イベントループ側の待機者を起こすコールバックを登録する
+    with _STATE_LOCK:
+        registry.setdefault(key, set()).add(waker)
+
+
+def _remove_async_waker(
+    registry: Dict[str, Set[Callable[[], None]]], key: str, waker: Callable[[], None]
+) -> None:
+    with _STATE_LOCK:
+        wakers = registry.get(key)
+        if wakers is not None:
+            wakers.discard(waker)
+            if not wakers:
+                registry.pop(key, None)
+
+
+def _wake_async_waiters(registry: Dict[str, Set[Callable[[], None]]], key: Optional[str]) -> None:
+    # 登録済みのコールバックを呼び出す（コールバックはスレッドセーフにループへ通知する）
+    wakers = registry.get(key) if key else None
+    if wakers:
+        for waker in list(wakers):
+            waker()
+
+
+def _notify_device_waiters(device: DeviceState) -> None:
+    # device.job_ready を保持した状態で、ジョブ取り出しの待機者（スレッド・コルーチン）を起こす
+    device.job_ready.notify_all()
+    _wake_async_waiters(_ASYNC_DEVICE_WAKERS, device.device_id)
+
+
+def _release_pending_job(job_id: str) -> Optional[str]:
+    # 結果待ちの登録を外し、デバイス側の索引からも取り除いて device_id を返す
+    with _STATE_LOCK:
+        device_id = _PENDING_JOBS.pop(job_id, None)
+        device = _DEVICES.get(device_id) if device_id else None
+        if device is not None:
+            device.pending_job_ids.pop(job_id, None)
+    return device_id
 
 
 def _enqueue_device_command(
-    device_id: str, command: Dict[str, Any], *, source: str = "internal"
+    device_id: str,
+    command: Dict[str, Any],
+    *,
+    source: str = "internal",
+    priority: Optional[int] = None,
+    deadline: Optional[float] = None,
 ) -> Optional[str]:
     # 指定デバイスのジョブキューへコマンドを追加し、job_id を返す
+    if _BROKER is not None:
+        return _BROKER.enqueue_command(device_id, command, source, priority, deadline)
+
     device = _DEVICES.get(device_id)
     if not device:
         return None
 
+    if priority is None:
+        # チャットからの対話的なコマンドは API 経由の一括ジョブより先に実行する
+        priority = (
+            JOB_PRIORITY_INTERACTIVE
+            if source in _INTERACTIVE_JOB_SOURCES
+            else JOB_PRIORITY_DEFAULT
+        )
+
     job_id = uuid.uuid4().hex
-    device.job_queue.append({"job_id": job_id, "command": command})
-    device.last_seen = time.time()
-    _PENDING_JOBS[job_id] = device_id
-    _JOB_METADATA[job_id] = {
+    with device.job_ready:
+        if _DEVICES.get(device_id) is not device:
+            # 取得後にデバイスが削除された
+            return None
+        queued_at = time.time()
+        device.last_seen = queued_at
+        with _STATE_LOCK:
+            _PENDING_JOBS[job_id] = device_id
+            device.pending_job_ids[job_id] = None
+            device.job_ids[job_id] = None
+            _JOB_METADATA[job_id] = {
+                "job_id": job_id,
+                "device_id": device_id,
+                "command": dict(command),
+                "queued_at": queued_at,
+                "status": "pending",
+                "source": source,
+                "priority": priority,
+                "deadline": deadline,
+            }
+        _persist_job(job_id)
+        device.job_queue.push(
+            {"job_id": job_id, "command": command},
+            priority=priority,
+            deadline=deadline,
+            queued_at=queued_at,
+        )
+        # ロングポーリングで待機中のリクエストを起こす
+        _notify_device_waiters(device)
+    return job_id
+
+
+def _parse_long_poll_wait(raw_value: Any) -> float:
+    # ?wait= の値を解釈し、0〜MAX_LONG_POLL_WAIT の秒数に丸める
+    if raw_value is None:
+        return 0.0
+    try:
+        seconds = float(raw_value)
+    except (TypeError, ValueError):
+        return 0.0
+    if seconds != seconds or seconds <= 0:
+        return 0.0
+    return min(seconds, MAX_LONG_POLL_WAIT)
+
+
+def _parse_job_batch_size(raw_value: Any) -> Optional[int]:
+    # ?max= の値を解釈し、1〜MAX_JOBS_PER_POLL の件数に丸める（未指定は None）
+    if raw_value is None:
+        return None
+    try:
+        size = int(raw_value)
+    except (TypeError, ValueError):
+        return 1
+    return max(1, min(size, MAX_JOBS_PER_POLL))
+
+
+def _pop_dispatchable_jobs(device: DeviceState, limit: int) -> List[Dict[str, Any]]:
+    # device.job_ready を保持した状態で、配信可能なジョブを最大 limit 件取り出す
+    jobs: List[Dict[str, Any]] = []
+    while device.job_queue and len(jobs) < limit:
+        job = device.job_queue.pop()
+        metadata = _JOB_METADATA.get(job.get("job_id"))
+        if metadata is not None and metadata.get("status") != "pending":
+            # 再配信待ちの間に結果が届いた・キャンセルされたジョブは捨てる
+            continue
+        jobs.append(job)
+    return jobs
+
+
+def _schedule_lease_expiry(job_id: str, expires_at: float) -> None:
+    # リース期限をタイマーヒープへ登録し、最も早い期限が変われば監視スレッドを起こす
+    with _LEASE_CONDITION:
+        heapq.heappush(_LEASE_HEAP, (expires_at, job_id))
+        if _LEASE_HEAP[0][1] == job_id:
+            _LEASE_CONDITION.notify()
+
+
+def _mark_job_dispatched(job: Dict[str, Any]) -> None:
+    # デバイスへ引き渡したジョブのメタデータを dispatched に更新し、リースを開始する
+    job_id = job.get("job_id") if isinstance(job, dict) else None
+    if not isinstance(job_id, str):
+        return
+    metadata = _JOB_METADATA.get(job_id)
+    if metadata is None:
+        return
+    with _device_lock(metadata.get("device_id")):
+        if metadata.get("status") != "pending":
+            # 書き込み中にキャンセル・結果受信・リース切れが先行した
+            return
+        now = time.time()
+        expires_at = now + JOB_LEASE_SECONDS
+        metadata["status"] = "dispatched"
+        metadata["dispatched_at"] = now
+        metadata["deliveries"] = int(metadata.get("deliveries") or 0) + 1
+        metadata["lease_expires_at"] = expires_at
+        device = _DEVICES.get(metadata.get("device_id"))
+        if device is not None:
+            device.leased_job_ids.add(job_id)
+        _schedule_lease_expiry(job_id, expires_at)
+        _persist_job(job_id)
+
+
+def _extend_job_leases(device: DeviceState, job_ids: Optional[List[str]] = None) -> List[str]:
+    # ハートビートを受けて配信中ジョブのリースを延長し、延長した job_id を返す
+    extended: List[str] = []
+    expires_at = time.time() + JOB_LEASE_SECONDS
+    with device.job_ready:
+        targets = device.leased_job_ids if job_ids is None else set(job_ids) & device.leased_job_ids
+        for job_id in list(targets):
+            metadata = _JOB_METADATA.get(job_id)
+            if metadata is None or metadata.get("status") != "dispatched":
+                device.leased_job_ids.discard(job_id)
+                continue
+            metadata["lease_expires_at"] = expires_at
+            _schedule_lease_expiry(job_id, expires_at)
+            extended.append(job_id)
+    return extended
+
+
+def _expire_job_lease(job_id: str, expires_at: float) -> None:
+    # リース切れのジョブをキューへ戻すか、再配信上限に達していれば失敗として完了させる
+    metadata = _JOB_METADATA.get(job_id)
+    if metadata is None:
+        return
+    with _device_lock(metadata.get("device_id")):
+        _expire_job_lease_locked(job_id, metadata, expires_at)
+
+
+def _expire_job_lease_locked(job_id: str, metadata: Dict[str, Any], expires_at: float) -> None:
+    # _expire_job_lease の本体。ジョブのデバイスロックを保持した状態で呼ぶ
+    if (
+        metadata.get("status") != "dispatched"
+        or metadata.get("lease_expires_at") != expires_at
+    ):
+        # 結果受信・キャンセル・延長済みの古いタイマーは無視する
+        return
+
+    device = _DEVICES.get(metadata.get("device_id"))
+    if device is not None:
+        device.leased_job_ids.discard(job_id)
+    metadata.pop("lease_expires_at", None)
+    deliveries = int(metadata.get("deliveries") or 0)
+
+    if device is not None and deliveries < JOB_MAX_DELIVERIES:
+        metadata["status"] = "pending"
+        metadata["redelivered_at"] = time.time()
+        _persist_job(job_id)
+        _requeue_jobs(device, [{"job_id": job_id, "command": metadata.get("command") or {}}])
+        return
+
+    now = time.time()
+    result_record = {
         "job_id": job_id,
-        "device_id": device_id,
-        "command": dict(command),
-        "queued_at": time.time(),
-        "status": "pending",
-        "source": source,
+        "ok": False,
+        "return_value": None,
+        "stdout": None,
+        "stderr": None,
+        "error": f"Device did not report a result after {deliveries} deliveries (lease expired).",
+        "ts": now,
+        "device_id": metadata.get("device_id"),
     }
-    return job_id
+    _release_pending_job(job_id)
+    if device is not None:
+        device.job_results.put(job_id, dict(result_record))
+    metadata["status"] = "completed"
+    metadata["completed_at"] = now
+    metadata["result_ok"] = False
+    metadata["failure_reason"] = "lease_expired"
+    _persist_job(job_id)
+    _store_completed_job(job_id, result_record)
+    _notify_job_waiters(job_id)
+
+
+def _lease_monitor_loop() -> None:
+    # タイマーヒープの先頭の期限まで眠り、期限切れのリースを順に処理する
+    while True:
+        with _LEASE_CONDITION:
+            while True:
+                now = time.time()
+                if _LEASE_HEAP and _LEASE_HEAP[0][0] <= now:
+                    break
+                timeout = _LEASE_HEAP[0][0] - now if _LEASE_HEAP else None
+                _LEASE_CONDITION.wait(timeout)
+            expired: List[Tuple[float, str]] = []
+            while _LEASE_HEAP and _LEASE_HEAP[0][0] <= now:
+                expired.append(heapq.heappop(_LEASE_HEAP))
+
+        for expires_at, job_id in expired:
+            try:
+                _expire_job_lease(job_id, expires_at)
+            except Exception:  # pragma: no cover - keep the monitor alive
+                app.logger.exception("Failed to expire lease for job %s", job_id)
+
+
+def _notify_job_waiters(job_id: Optional[str]) -> None:
+    # 結果の到着やキャンセルを _await_device_result の待機者へ通知する
+    if not job_id:
+        return
+    event = _JOB_RESULT_EVENTS.get(job_id)
+    if event is not None:
+        event.set()
+    _wake_async_waiters(_ASYNC_RESULT_WAKERS, job_id)
 
 
-def _await_device_result(device_id: str, job_id: str, timeout: float = 120.0) -> Optional[Dict[str, Any]]:
-    # デバイスから結果が返るまでポーリングし、タイムアウトしたら None
-    deadline = time.time() + timeout
-    while time.time() < deadline:
-        device = _DEVICES.get(device_id)
-        if not device:
-            return None
-        result = device.job_results.pop(job_id, None)
-        if result:
-            _PENDING_JOBS.pop(job_id, None)
+def _collect_device_result(device_id: str, job_id: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+    # 受け箱に届いた結果を受け取る。待機を終えるべきなら (True, 結果または None) を返す
+    device = _DEVICES.get(device_id)
+    if not device:
+        return True, None
+    result = device.job_results.pop(job_id, None)
+    if result:
+        with device.job_ready:
+            _release_pending_job(job_id)
             metadata = _JOB_METADATA.get(job_id)
             if metadata is not None:
                 metadata["status"] = "completed"
                 metadata["completed_at"] = time.time()
-            _store_completed_job(job_id, result)
-            return result
-        time.sleep(0.2)
-    return None
+        _store_completed_job(job_id, result)
+        return True, result
+
+    metadata = _JOB_METADATA.get(job_id)
+    if metadata is not None and metadata.get("status") == "cancelled":
+        return True, None
+    return False, None
+
+
+def _await_device_result(device_id: str, job_id: str, timeout: float = 120.0) -> Optional[Dict[str, Any]]:
+    # post_result からの完了通知を待ち、タイムアウトしたら None
+    if _BROKER is not None:
+        return _BROKER.await_result(device_id, job_id, timeout)
+
+    event = _JOB_RESULT_EVENTS.setdefault(job_id, threading.Event())
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            finished, result = _collect_device_result(device_id, job_id)
+            if finished:
+                return result
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            event.wait(remaining)
+            # 通知後は状態を再確認するため、次の待機に備えてリセットする
+            event.clear()
+    finally:
+        if _JOB_RESULT_EVENTS.get(job_id) is event:
+            _JOB_RESULT_EVENTS.pop(job_id, None)
 
 
 def _validate_device_command(command: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
@@ -449,9 +1336,29 @@ def _validate_device_command(command: Dict[str, Any]) -> Tuple[Optional[Dict[str
         "name": validated_name,
         "args": args,
     }
+    # 同じ group を持つ連続したステップは並行に実行する（不正な値は無視して逐次実行にする）
+    group = command.get("group")
+    if isinstance(group, int) and not isinstance(group, bool):
+        validated["group"] = group
+    elif isinstance(group, str) and group.strip():
+        validated["group"] = group.strip()
     return validated, None
 
 
+def _group_device_commands(commands: List[Dict[str, Any]]) -> List[List[int]]:
+    # 検証済みコマンドを、同じ group が連続する区間ごとのインデックス列にまとめる
+    groups: List[List[int]] = []
+    previous_group: Any = None
+    for index, command in enumerate(commands):
+        group = command.get("group")
+        if groups and group is not None and group == previous_group:
+            groups[-1].append(index)
+        else:
+            groups.append([index])
+        previous_group = group
+    return groups
+
+
 def _validate_device_command_sequence(
     commands: Any,
 ) -> Tuple[List[Dict[str, Any]], List[str]]:
@@ -482,12 +1389,14 @@ def _validate_device_command_sequence(
 
 def _serialize_device(device: DeviceState) -> Dict[str, Any]:
     # クライアント向けにデバイス状態を辞書へ変換する
+    queue_depth, pending_jobs = _device_job_counts(device)
     return {
         "device_id": device.device_id,
         "capabilities": device.capabilities,
         "meta": device.meta,
         "action_catalog": _action_catalog_for_device(device),
-        "queue_depth": len(device.job_queue),
+        "queue_depth": queue_depth,
+        "pending_jobs": pending_jobs,
         "last_seen": device.last_seen,
         "registered_at": device.registered_at,
         "last_result": device.last_result,
@@ -513,7 +1422,7 @@ def _format_result_for_prompt(result: Dict[str, Any]) -> str:
 
 def _structured_llm_prompt(messages: List[Dict[str, str]]) -> Dict[str, Any]:
     # LLM へ投げる構造化プロンプトとコンテキストを組み立てる
-    device_context = _build_device_context()
+    device_context = _build_device_context(messages)
     system_prompt = (
         "You are an assistant that manages IoT devices for the user. "
         "Always respond with a strict JSON object containing the keys "
@@ -521,7 +1430,11 @@ def _structured_llm_prompt(messages: List[Dict[str, str]]) -> Dict[str, Any]:
         "language response to the user. The 'device_commands' field must "
         "be either null, an empty array, or an array of objects with the "
         "keys 'device_id', 'name', and 'args'. Each array element "
-        "represents one sequential task for the devices to execute. Do "
+        "represents one sequential task for the devices to execute. When "
+        "consecutive steps target different devices and neither depends on "
+        "the other's result or ordering, give them the same integer 'group' "
+        "value so they run at the same time; omit 'group' for steps that "
+        "must run in order. Do "
         "not wrap the JSON inside code fences. If no device action is "
         "required, set 'device_commands' to null. Only use device IDs and "
         "capability names provided in the context. When an action is "
@@ -532,6 +1445,11 @@ def _structured_llm_prompt(messages: List[Dict[str, str]]) -> Dict[str, Any]:
         "'device_commands' to null and ask the user to clarify which "
         "device should be used. Prefer devices tagged with the "
         f"'{AGENT_ROLE_VALUE}' role for complex or conversational tasks. "
+        f"For every step that targets such an agent device (or a device with "
+        f"the '{AGENT_CAPABILITY_NAME}' capability), include 'args.instruction': "
+        "one simple imperative English sentence under 25 words that tells "
+        "the device exactly what to do for that step, using the official "
+        "capability names from the context. It is sent to the device as is. "
         "The 'reply' value must be written in Japanese prose without "
         "including JSON syntax, code formatting, or explicit mentions of "
         "'JSON'. Summarise any structured information conversationally."
@@ -581,11 +1499,307 @@ def _extract_json_object(text: str) -> Tuple[Optional[Any], Optional[str]]:
     return None, text.strip()
 
 
-def _call_llm_and_parse(client: OpenAI, messages: List[Dict[str, str]]) -> Dict[str, Any]:
-    # LLM 応答から reply と device_commands を抽出して辞書化
+_JSON_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class _StreamingJsonReply:
+    # ストリーミング中の LLM 出力（JSON オブジェクト）から、最上位の "reply" の文字列値を
+    # 届いた分だけ逐次デコードして取り出す
+
+    def __init__(self, field_name: str = "reply") -> None:
+        self.field_name = field_name
+        self.done = False
+        self._depth = 0
+        self._in_string = False
+        self._escape: Optional[str] = None
+        self._high_surrogate: Optional[int] = None
+        self._expect_key = False
+        self._last_key: Optional[str] = None
+        self._key_chars: List[str] = []
+        self._capturing = False
+
+    def feed(self, chunk: str) -> str:
+        # 出力断片を読み進め、新たに確定した reply の文字列を返す
+        output: List[str] = []
+        for char in chunk:
+            if self._in_string:
+                self._feed_string_char(char, output)
+                continue
+            if char in "{[":
+                self._depth += 1
+                self._expect_key = self._depth == 1 and char == "{"
+            elif char in "}]":
+                self._depth -= 1
+            elif self._depth == 1 and char == ":":
+                self._expect_key = False
+            elif self._depth == 1 and char == ",":
+                self._expect_key = True
+            elif char == '"':
+                self._in_string = True
+                self._key_chars = []
+                self._capturing = (
+                    self._depth == 1
+                    and not self._expect_key
+                    and self._last_key == self.field_name
+                    and not self.done
+                )
+        return "".join(output)
+
+    def _feed_string_char(self, char: str, output: List[str]) -> None:
+        if self._escape is not None:
+            if self._escape == "" and char != "u":
+                self._emit(_JSON_ESCAPES.get(char, char), output)
+                self._escape = None
+                return
+            self._escape += char
+            if len(self._escape) == 5:
+                try:
+                    code_point = int(self._escape[1:], 16)
+                except ValueError:
+                    code_point = ord("?")
+                self._escape = None
+                if 0xD800 <= code_point < 0xDC00:
+                    self._high_surrogate = code_point
+                    return
+                if 0xDC00 <= code_point < 0xE000 and self._high_surrogate is not None:
+                    code_point = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code_point - 0xDC00)
+                self._high_surrogate = None
+                self._emit(chr(code_point), output)
+            return
+        if char == "\\":
+            self._escape = ""
+        elif char == '"':
+            self._in_string = False
+            if self._capturing:
+                self._capturing = False
+                self.done = True
+            elif self._depth == 1 and self._expect_key:
+                self._last_key = "".join(self._key_chars)
+        else:
+            self._emit(char, output)
+
+    def _emit(self, text: str, output: List[str]) -> None:
+        if self._capturing:
+            output.append(text)
+        elif self._depth == 1 and self._expect_key:
+            self._key_chars.append(text)
+
+
+class _StreamingJsonArrayItems:
+    # ストリーミング中の LLM 出力（JSON オブジェクト）から、最上位の指定キーが持つ配列の
+    # 要素オブジェクトを、閉じ括弧が届いた時点で 1 件ずつ取り出す
+
+    def __init__(self, field_name: str) -> None:
+        self.field_name = field_name
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._expect_key = False
+        self._last_key: Optional[str] = None
+        self._key_chars: Optional[List[str]] = None
+        self._in_array = False
+        self._item_chars: Optional[List[str]] = None
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        # 出力断片を読み進め、新たに閉じた要素オブジェクトを返す
+        items: List[Dict[str, Any]] = []
+        for char in chunk:
+            if self._item_chars is not None:
+                self._item_chars.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._key_chars is not None:
+                        self._last_key = self._decode_key("".join(self._key_chars))
+                        self._key_chars = None
+                    continue
+                if self._key_chars is not None:
+                    self._key_chars.append(char)
+                continue
+
+            if char == '"':
+                self._in_string = True
+                if self._depth == 1 and self._expect_key:
+                    self._key_chars = []
+            elif char in "{[":
+                if self._depth == 1 and char == "[" and not self._expect_key:
+                    self._in_array = self._last_key == self.field_name
+                elif self._in_array and self._depth == 2 and char == "{":
+                    self._item_chars = [char]
+                self._depth += 1
+                self._expect_key = self._depth == 1 and char == "{"
+            elif char in "}]":
+                self._depth -= 1
+                if self._item_chars is not None and self._depth == 2:
+                    item = self._decode_item("".join(self._item_chars))
+                    self._item_chars = None
+                    if item is not None:
+                        items.append(item)
+                elif self._depth == 1:
+                    self._in_array = False
+            elif self._depth == 1 and char == ":":
+                self._expect_key = False
+            elif self._depth == 1 and char == ",":
+                self._expect_key = True
+        return items
+
+    @staticmethod
+    def _decode_key(raw_key: str) -> Optional[str]:
+        try:
+            return json.loads(f'"{raw_key}"')
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _decode_item(raw_item: str) -> Optional[Dict[str, Any]]:
+        try:
+            item = json.loads(raw_item)
+        except ValueError:
+            return None
+        return item if isinstance(item, dict) else None
+
+
+@dataclass
+class _LlmRequest:
+    # チャット処理フローが駆動側へ依頼する LLM 呼び出し（応答テキストが送り返される）
+
+    payload: Dict[str, Any]
+    # 指定時はストリーミングで呼び出し、出力断片ごとにこの関数を呼んで返されたイベントを通知する
+    on_delta: Optional[Callable[[str], List["_ChatEvent"]]] = None
+    # 呼び出しの用途（plan / agent_instruction / summary）。チャットごとの呼び出し回数の集計に使う
+    purpose: str = "other"
+
+
+@dataclass
+class _DeviceResultRequest:
+    # チャット処理フローが駆動側へ依頼するジョブ結果待ち（結果または None が送り返される）
+
+    device_id: str
+    job_id: str
+    timeout: float
+
+
+@dataclass
+class _ChatEvent:
+    # チャット処理フローが通知する進捗イベント（非同期モードの購読者へ転送される）
+
+    event: str
+    data: Dict[str, Any] = field(default_factory=dict)
+
+
+class _SpeculativeDispatch:
+    # LLM が計画を出力している途中で、配列内で確定したコマンドを先行してデバイスへ送信する。
+    # 逐次実行と同じ順序で動くよう、先頭から連続して同じデバイスを対象とするステップか、
+    # 先頭の並行グループに属するステップだけを送る（同一デバイスのキューは投入順に取り出される
+    # ため、結果を待たずに積んでも順序は変わらない）
+
+    def __init__(self, enabled: bool = True) -> None:
+        self._items = _StreamingJsonArrayItems("device_commands")
+        self._device_ids: Set[str] = set()
+        self._groups: Set[Any] = set()
+        self._stopped = not enabled
+        # 先行送信したステップ（検証済みコマンド, job_id）を計画順に保持する
+        self.dispatched: List[Tuple[Dict[str, Any], str]] = []
+
+    def feed(self, delta: str) -> List[_ChatEvent]:
+        # 出力断片から確定したコマンドを検証して送信し、step_dispatched イベントを返す
+        events: List[_ChatEvent] = []
+        if self._stopped:
+            return events
+        for item in self._items.feed(delta):
+            validated, _ = _validate_device_command(item)
+            device = _DEVICES.get(validated["device_id"]) if validated else None
+            if validated is None or device is None:
+                self._stopped = True
+                break
+            if _device_is_agent(device):
+                # 英語指示が無いエージェント向けステップは翻訳の LLM 呼び出しが必要なので送らない
+                instruction = validated["args"].get("instruction")
+                if not isinstance(instruction, str) or not instruction.strip():
+                    self._stopped = True
+                    break
+                command_payload = _agent_command_payload(validated["args"], instruction.strip())
+                source = "agent"
+            else:
+                command_payload = {"name": validated["name"], "args": validated["args"]}
+                source = "llm"
+            group = validated.get("group")
+            same_group = group is not None and self._groups == {group}
+            if not same_group and not self._device_ids <= {validated["device_id"]}:
+                self._stopped = True
+                break
+            job_id = _enqueue_device_command(validated["device_id"], command_payload, source=source)
+            if job_id is None:
+                self._stopped = True
+                break
+            self._device_ids.add(validated["device_id"])
+            self._groups.add(group)
+            self.dispatched.append((validated, job_id))
+            events.append(
+                _ChatEvent(
+                    "step_dispatched",
+                    {
+                        "index": len(self.dispatched),
+                        "device_id": validated["device_id"],
+                        "command": validated["name"],
+                        "job_id": job_id,
+                    },
+                )
+            )
+        return events
+
+    def settle(self, commands: List[Dict[str, Any]]) -> Tuple[List[Optional[str]], List[str]]:
+        # 確定した計画と照合し、先行送信済みの job_id をステップ順に割り当てる。計画と食い違った
+        # ジョブは取り消し、既にデバイスが受け取っていて取り消せなかったものを通知文で返す
+        job_ids: List[Optional[str]] = [None] * len(commands)
+        notices: List[str] = []
+        matching = True
+        for index, (command, job_id) in enumerate(self.dispatched):
+            matching = matching and index < len(commands) and commands[index] == command
+            if matching:
+                job_ids[index] = job_id
+                continue
+            _, status = _cancel_queued_job(job_id)
+            if status != 200:
+                notices.append(
+                    f"ステップ{index + 1}: 計画の確定前に {_device_label_for_prompt(command['device_id'])} "
+                    f"へ送信済みのため、コマンド『{command['name']}』を取り消せませんでした。"
+                )
+        self.dispatched = []
+        return job_ids, notices
+
+
+# LLM 呼び出しと結果待ちを yield で駆動側へ委ね、最後に (応答 JSON, ステータス) を返すチャット処理フロー。
+# WSGI では _run_chat_flow がブロッキング I/O で、ASGI では asgi.py が await で進める
+ChatFlow = Generator[Any, Any, Tuple[Dict[str, Any], int]]
+
 
-    response = client.responses.create(**_structured_llm_prompt(messages))
-    reply_text = getattr(response, "output_text", None) or ""
+def _call_llm_and_parse(
+    messages: List[Dict[str, str]], dispatch: Optional[_SpeculativeDispatch] = None
+) -> Generator[Any, Any, Dict[str, Any]]:
+    # LLM 応答から reply と device_commands を抽出して辞書化（dispatch 指定時は出力途中で先行送信する）
+
+    reply_handler = _reply_delta_handler("plan", _StreamingJsonReply())
+
+    def _on_delta(delta: str) -> List[_ChatEvent]:
+        events = reply_handler(delta)
+        if dispatch is not None:
+            events.extend(dispatch.feed(delta))
+        return events
+
+    try:
+        reply_text = yield _LlmRequest(
+            _structured_llm_prompt(messages), on_delta=_on_delta, purpose="plan"
+        )
+    except Exception:
+        if dispatch is not None:
+            # 計画を受け取れなかったので、先行送信したジョブは取り消す
+            dispatch.settle([])
+        raise
 
     parsed_obj, cleaned_text = _extract_json_object(reply_text)
 
@@ -622,39 +1836,257 @@ def _call_llm_and_parse(client: OpenAI, messages: List[Dict[str, str]]) -> Dict[
     }
 
 
-def _call_llm_text(client: OpenAI, payload: Dict[str, Any]) -> str:
-    # 指定ペイロードで LLM を呼び出し、クリーンなテキストを返す
+_INTENT_ROUTER = IntentRouter()
+# 意図ルーターの判定件数・LLM を省略できた件数・判定に掛かった秒数の合計（/api/stats で公開する）
+_INTENT_ROUTE_STATS: Dict[str, Any] = {"checked": 0, "hits": 0, "seconds": 0.0}
 
-    response = client.responses.create(**payload)
-    text = getattr(response, "output_text", "")
-    return text.strip()
 
+def _record_intent_route(hit: bool, seconds: float = 0.0) -> None:
+    # 意図ルーターの判定結果と判定時間を集計へ加える
+    if _BROKER is not None:
+        _BROKER.record_intent_route(hit, seconds)
+        return
+    with _LLM_USAGE_LOCK:
+        _INTENT_ROUTE_STATS["checked"] += 1
+        _INTENT_ROUTE_STATS["seconds"] += seconds
+        if hit:
+            _INTENT_ROUTE_STATS["hits"] += 1
 
-def _structured_agent_instruction_prompt(messages: List[Dict[str, str]]) -> Dict[str, Any]:
-    # エージェント向け英語命令文の生成に必要なプロンプトを組み立てる
 
-    device_context = _build_device_context()
-    system_prompt = (
-        "You translate the latest user instruction into a single, simple "
-        "English sentence that describes the IoT task to perform. Use clear "
-        "imperative phrasing and avoid technical jargon. If no action is "
-        "required or the request cannot be fulfilled, respond with "
-        "'No action required.'"
-    )
+def _route_chat_intent(messages: List[Dict[str, str]]) -> Optional[Dict[str, Any]]:
+    # 最新のユーザー発話が単発の直接操作なら、LLM の計画と同じ形の応答を決定的に組み立てる
+    if not INTENT_ROUTER or not messages or messages[-1].get("role") != "user":
+        return None
+    targets = []
+    for device in list(_DEVICES.values()):
+        if _device_is_agent(device):
+            continue
+        display_name = device.meta.get("display_name") if isinstance(device.meta, dict) else None
+        labels = (display_name.strip(),) if isinstance(display_name, str) and display_name.strip() else ()
+        targets.append(RouteTarget(device.device_id, device.capabilities, labels))
+    if not targets:
+        return None
 
-    guidance = (
-        "When referencing device capabilities, prefer the official names "
-        "listed in the available context. Keep the response under 25 words."
-    )
+    started = time.monotonic()
+    routed = _INTENT_ROUTER.route(messages[-1]["content"], targets)
+    _record_intent_route(routed is not None, time.monotonic() - started)
+    if routed is None:
+        return None
+    command = {"device_id": routed.device_id, "name": routed.name, "args": routed.args}
+    return {
+        "reply": f"{_device_label_for_prompt(routed.device_id)} でコマンド『{routed.name}』を実行します。",
+        "device_commands": [command],
+        "raw": "",
+    }
 
-    context_message = (
-        "Available device information:\n" + device_context
-        if device_context
-        else "No devices are currently registered."
-    )
 
-    return {
-        "model": "gpt-4.1-2025-04-14",
+def _plan_chat_response(
+    messages: List[Dict[str, str]], dispatch: Optional[_SpeculativeDispatch] = None
+) -> Generator[Any, Any, Dict[str, Any]]:
+    # 意図ルーターで決まる依頼は LLM を呼ばずに計画し、それ以外は LLM に計画させる
+    routed = _route_chat_intent(messages)
+    if routed is None:
+        return (yield from _call_llm_and_parse(messages, dispatch))
+    yield _ChatEvent("reply_delta", {"phase": "plan", "delta": routed["reply"]})
+    return routed
+
+
+def _call_llm_text(
+    payload: Dict[str, Any], stream_phase: Optional[str] = None, purpose: str = "other"
+) -> Generator[Any, Any, str]:
+    # 指定ペイロードで LLM を呼び出し、クリーンなテキストを返す（stream_phase 指定時は逐次配信する）
+
+    on_delta = _reply_delta_handler(stream_phase) if stream_phase else None
+    text = yield _LlmRequest(payload, on_delta=on_delta, purpose=purpose)
+    return text.strip()
+
+
+def _reply_delta_handler(
+    phase: str, extractor: Optional[_StreamingJsonReply] = None
+) -> Callable[[str], List[_ChatEvent]]:
+    # LLM の出力断片を reply_delta イベントへ変換する関数を返す（JSON 出力は reply 部分だけを取り出す）
+
+    def _handle(delta: str) -> List[_ChatEvent]:
+        text = extractor.feed(delta) if extractor is not None else delta
+        if not text:
+            return []
+        return [_ChatEvent("reply_delta", {"phase": phase, "delta": text})]
+
+    return _handle
+
+
+def _apply_llm_stream_event(
+    event: Any,
+    step: _LlmRequest,
+    on_event: Optional[Callable[[str, Dict[str, Any]], None]],
+    parts: List[str],
+) -> Optional[str]:
+    # ストリーミング応答の 1 イベントを処理する。完了イベントでは全文を返す
+    event_type = getattr(event, "type", "")
+    if event_type == "response.output_text.delta":
+        delta = getattr(event, "delta", "") or ""
+        parts.append(delta)
+        for chat_event in step.on_delta(delta) if step.on_delta is not None else []:
+            if on_event is not None:
+                on_event(chat_event.event, chat_event.data)
+    elif event_type == "response.completed":
+        return _response_output_text(getattr(event, "response", None)) or "".join(parts)
+    elif event_type in {"response.failed", "error"}:
+        raise RuntimeError(f"LLM stream failed: {event_type}")
+    return None
+
+
+def _response_output_text(response: Any) -> str:
+    # Responses API の応答から出力テキストを取り出す
+    return getattr(response, "output_text", None) or ""
+
+
+def _run_chat_flow(
+    flow: ChatFlow, on_event: Optional[Callable[[str, Dict[str, Any]], None]] = None
+) -> Tuple[Dict[str, Any], int]:
+    # チャット処理フローをブロッキング I/O で最後まで進める（WSGI・ワーカーから呼ぶ）
+    client: Optional[OpenAI] = None
+    llm_calls: Dict[str, int] = {}
+    llm_seconds: Dict[str, float] = {}
+    value: Any = None
+    error: Optional[Exception] = None
+    while True:
+        try:
+            step = flow.throw(error) if error is not None else flow.send(value)
+        except StopIteration as stop:
+            _record_chat_llm_usage(llm_calls, llm_seconds)
+            return stop.value
+        value, error = None, None
+        try:
+            if isinstance(step, _LlmRequest):
+                llm_calls[step.purpose] = llm_calls.get(step.purpose, 0) + 1
+                started = time.monotonic()
+                try:
+                    if client is None:
+                        client = _client()
+                    if step.on_delta is not None:
+                        # 出力をストリーミングで受け取り、断片ごとに on_delta を呼ぶ
+                        parts: List[str] = []
+                        value = None
+                        for event in client.responses.create(**step.payload, stream=True):
+                            text = _apply_llm_stream_event(event, step, on_event, parts)
+                            if text is not None:
+                                value = text
+                        if value is None:
+                            value = "".join(parts)
+                    else:
+                        value = _response_output_text(client.responses.create(**step.payload))
+                finally:
+                    llm_seconds[step.purpose] = llm_seconds.get(step.purpose, 0.0) + time.monotonic() - started
+            elif isinstance(step, _DeviceResultRequest):
+                value = _await_device_result(step.device_id, step.job_id, timeout=step.timeout)
+            elif isinstance(step, _ChatEvent):
+                if on_event is not None:
+                    on_event(step.event, step.data)
+            else:
+                raise TypeError(f"unsupported chat flow step: {step!r}")
+        except Exception as exc:
+            # 例外はフロー側の try/except で従来どおり処理させる
+            error = exc
+
+
+# チャット 1 件あたりの LLM 呼び出し回数の集計（/api/stats で公開する）
+_LLM_USAGE_LOCK = threading.Lock()
+_LLM_USAGE: Dict[str, Any] = {
+    "chats": 0,
+    "calls": 0,
+    "calls_by_purpose": {},
+    "chats_by_call_count": {},
+    "seconds_by_purpose": {},
+}
+
+
+def _record_chat_llm_usage(calls: Dict[str, int], seconds: Optional[Dict[str, float]] = None) -> None:
+    # 完了したチャット 1 件分の用途別 LLM 呼び出し回数と所要秒数を集計へ加える
+    if _BROKER is not None:
+        _BROKER.record_chat_llm_usage(calls, seconds)
+        return
+    total = sum(calls.values())
+    with _LLM_USAGE_LOCK:
+        _LLM_USAGE["chats"] += 1
+        _LLM_USAGE["calls"] += total
+        by_purpose = _LLM_USAGE["calls_by_purpose"]
+        for purpose, count in calls.items():
+            by_purpose[purpose] = by_purpose.get(purpose, 0) + count
+        histogram = _LLM_USAGE["chats_by_call_count"]
+        histogram[str(total)] = histogram.get(str(total), 0) + 1
+        seconds_by_purpose = _LLM_USAGE["seconds_by_purpose"]
+        for purpose, elapsed in (seconds or {}).items():
+            seconds_by_purpose[purpose] = seconds_by_purpose.get(purpose, 0.0) + elapsed
+
+
+def _chat_llm_usage_stats() -> Dict[str, Any]:
+    # /api/stats 向けに LLM 呼び出し回数・所要秒数と、意図ルーターで省略できた時間の見積もりを返す
+    with _LLM_USAGE_LOCK:
+        chats = _LLM_USAGE["chats"]
+        calls_by_purpose = dict(_LLM_USAGE["calls_by_purpose"])
+        seconds_by_purpose = dict(_LLM_USAGE["seconds_by_purpose"])
+        checked, hits, route_seconds = (
+            _INTENT_ROUTE_STATS["checked"],
+            _INTENT_ROUTE_STATS["hits"],
+            _INTENT_ROUTE_STATS["seconds"],
+        )
+        calls = _LLM_USAGE["calls"]
+
+    avg_seconds_by_purpose = {
+        purpose: round(seconds_by_purpose[purpose] / calls_by_purpose[purpose], 4)
+        for purpose in seconds_by_purpose
+        if calls_by_purpose.get(purpose)
+    }
+    # ルーターが当たったチャットは計画用の LLM 呼び出し 1 回分を省略しているので、
+    # 実際に計画を LLM で行ったときの平均所要時間から判定時間を引いた分を短縮時間とみなす
+    avg_route_seconds = route_seconds / checked if checked else 0.0
+    saved_per_hit = max(0.0, avg_seconds_by_purpose.get("plan", 0.0) - avg_route_seconds) if hits else 0.0
+    return {
+        "chats": chats,
+        "calls": calls,
+        "calls_per_chat": round(calls / chats, 3) if chats else 0.0,
+        "calls_by_purpose": calls_by_purpose,
+        "chats_by_call_count": dict(_LLM_USAGE["chats_by_call_count"]),
+        "avg_seconds_by_purpose": avg_seconds_by_purpose,
+        "intent_router": {
+            "enabled": INTENT_ROUTER,
+            "checked": checked,
+            "hits": hits,
+            "hit_rate": round(hits / checked, 3) if checked else 0.0,
+            "avg_route_ms": round(avg_route_seconds * 1000, 3),
+            "saved_seconds_per_hit": round(saved_per_hit, 4),
+            "saved_seconds_total": round(saved_per_hit * hits, 3),
+            "saved_seconds_per_chat": round(saved_per_hit * hits / chats, 4) if chats else 0.0,
+        },
+    }
+
+
+def _structured_agent_instruction_prompt(messages: List[Dict[str, str]]) -> Dict[str, Any]:
+    # エージェント向け英語命令文の生成に必要なプロンプトを組み立てる
+
+    device_context = _build_device_context(messages)
+    system_prompt = (
+        "You translate the latest user instruction into a single, simple "
+        "English sentence that describes the IoT task to perform. Use clear "
+        "imperative phrasing and avoid technical jargon. If no action is "
+        "required or the request cannot be fulfilled, respond with "
+        "'No action required.'"
+    )
+
+    guidance = (
+        "When referencing device capabilities, prefer the official names "
+        "listed in the available context. Keep the response under 25 words."
+    )
+
+    context_message = (
+        "Available device information:\n" + device_context
+        if device_context
+        else "No devices are currently registered."
+    )
+
+    return {
+        "model": "gpt-4.1-2025-04-14",
         "input": [
             {"role": "system", "content": system_prompt},
             {"role": "system", "content": guidance},
@@ -675,7 +2107,7 @@ def _structured_agent_followup_prompt(
 ) -> Dict[str, Any]:
     # デバイス応答をもとにユーザー向け日本語要約を生成するプロンプト
 
-    device_context = _build_device_context()
+    device_context = _build_device_context(base_messages)
     summary_instruction = (
         "The edge device executed the request using the following simple "
         f"English instruction: {english_instruction}\n"
@@ -843,6 +2275,7 @@ class _CommandExecutionSummary:
     is_agent: bool = False
     status: int = 200
     error_text: Optional[str] = None
+    job_id: Optional[str] = None
 
 
 def _timeout_reply(command: Dict[str, Any], timeout_seconds: float) -> str:
@@ -872,12 +2305,12 @@ def _timeout_reply(command: Dict[str, Any], timeout_seconds: float) -> str:
 
 
 def _execute_standard_device_command(
-    client: OpenAI,
     messages: List[Dict[str, str]],
     initial_reply: str,
     command: Dict[str, Any],
-) -> _CommandExecutionSummary:
-    # 通常デバイスに対して単発コマンドを送り、結果をまとめる
+    job_id: Optional[str] = None,
+) -> Generator[Any, Any, _CommandExecutionSummary]:
+    # 通常デバイスに対して単発コマンドを送り、結果をまとめる（job_id 指定時は先行送信済みのジョブを待つ）
 
     device_id = command.get("device_id")
     command_name = (
@@ -886,7 +2319,8 @@ def _execute_standard_device_command(
     args_dict = command.get("args") if isinstance(command.get("args"), dict) else {}
 
     command_payload = {"name": command_name, "args": args_dict}
-    job_id = _enqueue_device_command(device_id, command_payload, source="llm")
+    if job_id is None:
+        job_id = _enqueue_device_command(device_id, command_payload, source="llm")
     if job_id is None:
         notice = "(注意: デバイスにコマンドを送信できませんでした。)"
         combined = (initial_reply + "\n" if initial_reply else "") + notice
@@ -897,7 +2331,7 @@ def _execute_standard_device_command(
             manual_reply=combined,
         )
 
-    result = _await_device_result(device_id, job_id, timeout=DEVICE_RESULT_TIMEOUT)
+    result = yield _DeviceResultRequest(device_id, job_id, DEVICE_RESULT_TIMEOUT)
     device_label = _device_label_for_prompt(device_id) if device_id else "対象デバイス"
 
     if result:
@@ -908,6 +2342,7 @@ def _execute_standard_device_command(
             args=args_dict,
             manual_reply=manual_reply,
             result=result,
+            job_id=job_id,
         )
 
     timeout_reply = _timeout_reply(
@@ -919,78 +2354,195 @@ def _execute_standard_device_command(
         command_name=command_name,
         args=args_dict,
         manual_reply=timeout_reply,
+        job_id=job_id,
     )
 
 
+def _advance_to_device_wait(
+    flow: Generator[Any, Any, _CommandExecutionSummary],
+    value: Any = None,
+    error: Optional[Exception] = None,
+) -> Generator[Any, Any, Tuple[Optional[_DeviceResultRequest], Optional[_CommandExecutionSummary]]]:
+    # ステップのフローを次の結果待ちまで進める。LLM 呼び出しなど他の要求は駆動側へ中継し、
+    # (結果待ちの要求, None) か、ステップが終わった場合は (None, 実行結果) を返す
+    while True:
+        try:
+            step = flow.throw(error) if error is not None else flow.send(value)
+        except StopIteration as stop:
+            return None, stop.value
+        if isinstance(step, _DeviceResultRequest):
+            return step, None
+        value, error = None, None
+        try:
+            value = yield step
+        except Exception as exc:
+            error = exc
+
+
+def _gather_device_steps(
+    flows: List[Generator[Any, Any, _CommandExecutionSummary]],
+) -> Generator[Any, Any, List[_CommandExecutionSummary]]:
+    # 複数ステップのフローを並行に進め、実行結果を渡された順に返す。各ステップのジョブ投入を
+    # 先に済ませてから結果を順に待つため、デバイス上では同時に実行され所要時間は最長のステップ程度になる
+    summaries: List[Optional[_CommandExecutionSummary]] = [None] * len(flows)
+    waiting: List[Tuple[int, _DeviceResultRequest, float]] = []
+    for index, flow in enumerate(flows):
+        request, summary = yield from _advance_to_device_wait(flow)
+        if request is None:
+            summaries[index] = summary
+        else:
+            waiting.append((index, request, time.monotonic() + request.timeout))
+
+    while waiting:
+        still_waiting: List[Tuple[int, _DeviceResultRequest, float]] = []
+        for index, request, deadline in waiting:
+            # 各ステップの待ち時間は、そのジョブを投入した時点から数える
+            result: Any = None
+            error: Optional[Exception] = None
+            try:
+                result = yield _DeviceResultRequest(
+                    request.device_id, request.job_id, max(0.0, deadline - time.monotonic())
+                )
+            except Exception as exc:
+                error = exc
+            next_request, summary = yield from _advance_to_device_wait(flows[index], result, error)
+            if next_request is None:
+                summaries[index] = summary
+            else:
+                still_waiting.append((index, next_request, time.monotonic() + next_request.timeout))
+        waiting = still_waiting
+
+    return [summary for summary in summaries if summary is not None]
+
+
 def _execute_device_command_sequence(
-    client: OpenAI,
     messages: List[Dict[str, str]],
     initial_reply: str,
     commands: List[Dict[str, Any]],
-) -> Tuple[str, int]:
-    # 連続コマンドを順に処理し、レスポンス文と言語コードを返す
+    job_ids: Optional[List[Optional[str]]] = None,
+) -> Generator[Any, Any, Tuple[str, int]]:
+    # 連続コマンドを順に処理し、レスポンス文と言語コードを返す（job_ids は先行送信済みのジョブ）
 
     if not commands:
         return initial_reply, 200
 
     summaries: List[_CommandExecutionSummary] = []
     current_initial = initial_reply
+    total = len(commands)
+
+    yield _ChatEvent(
+        "plan",
+        {
+            "reply": initial_reply,
+            "steps": [
+                {
+                    "device_id": command.get("device_id"),
+                    "name": command.get("name"),
+                    "args": command.get("args"),
+                    "group": command.get("group"),
+                }
+                for command in commands
+            ],
+        },
+    )
 
-    for command in commands:
-        device_id = command.get("device_id")
-        device = _DEVICES.get(device_id) if isinstance(device_id, str) else None
+    for group in _group_device_commands(commands):
+        step_flows: List[Generator[Any, Any, _CommandExecutionSummary]] = []
+        for index in group:
+            command = commands[index]
+            device_id = command.get("device_id")
+            device = _DEVICES.get(device_id) if isinstance(device_id, str) else None
 
-        if device and _device_is_agent(device):
-            summary = _execute_agent_device_command(
-                client, device, messages, current_initial, command
-            )
-        else:
-            summary = _execute_standard_device_command(
-                client, messages, current_initial, command
+            yield _ChatEvent(
+                "step_started",
+                {
+                    "index": index + 1,
+                    "total": total,
+                    "device_id": device_id,
+                    "device_label": _device_label_for_prompt(device_id) if device_id else None,
+                    "command": command.get("name"),
+                },
             )
+            if device and _device_is_agent(device):
+                step_flows.append(
+                    _execute_agent_device_command(
+                        device, messages, current_initial, command, job_ids[index] if job_ids else None
+                    )
+                )
+            else:
+                step_flows.append(
+                    _execute_standard_device_command(
+                        messages, current_initial, command, job_ids[index] if job_ids else None
+                    )
+                )
 
-        if summary.status != 200:
-            failure_messages: List[str] = []
-            for existing in summaries:
-                if isinstance(existing.manual_reply, str):
-                    text = existing.manual_reply.strip()
-                    if text:
-                        failure_messages.append(text)
+        # 同じグループのステップはジョブをまとめて投入してから結果を待つ
+        group_summaries = yield from _gather_device_steps(step_flows)
+        for index, summary in zip(group, group_summaries):
+            yield _ChatEvent(
+                "step_completed",
+                {
+                    "index": index + 1,
+                    "total": total,
+                    "device_id": commands[index].get("device_id"),
+                    "job_id": summary.job_id,
+                    "ok": summary.result.get("ok") if summary.result else None,
+                    "reply": summary.manual_reply,
+                },
+            )
 
-            candidate = ""
+        for summary in group_summaries:
+            if summary.status != 200:
+                failure_messages: List[str] = []
+                for existing in summaries:
+                    if isinstance(existing.manual_reply, str):
+                        text = existing.manual_reply.strip()
+                        if text:
+                            failure_messages.append(text)
+
+                candidate = ""
+                if isinstance(summary.manual_reply, str) and summary.manual_reply.strip():
+                    candidate = summary.manual_reply.strip()
+                elif isinstance(summary.error_text, str) and summary.error_text.strip():
+                    candidate = summary.error_text.strip()
+
+                if candidate:
+                    failure_messages.append(candidate)
+
+                if failure_messages:
+                    return "\n\n".join(failure_messages), summary.status
+                return initial_reply, summary.status
+
+            summaries.append(summary)
             if isinstance(summary.manual_reply, str) and summary.manual_reply.strip():
-                candidate = summary.manual_reply.strip()
-            elif isinstance(summary.error_text, str) and summary.error_text.strip():
-                candidate = summary.error_text.strip()
-
-            if candidate:
-                failure_messages.append(candidate)
-
-            if failure_messages:
-                return "\n\n".join(failure_messages), summary.status
-            return initial_reply, summary.status
-
-        summaries.append(summary)
-        if isinstance(summary.manual_reply, str) and summary.manual_reply.strip():
-            current_initial = summary.manual_reply
+                current_initial = summary.manual_reply
 
     if not summaries:
         return initial_reply, 200
 
-    final_reply = _summarize_device_command_sequence(
-        client, messages, initial_reply, summaries
+    yield _ChatEvent("summarizing")
+    final_reply = yield from _summarize_device_command_sequence(
+        messages, initial_reply, summaries
     )
     return final_reply, 200
 
 
+def _agent_command_payload(args: Dict[str, Any], instruction: str) -> Dict[str, Any]:
+    # エージェント役デバイスへ送る英語指示のコマンドを組み立てる
+    command_args = dict(args)
+    command_args["instruction"] = instruction
+    return {"name": AGENT_COMMAND_NAME, "args": command_args}
+
+
 def _execute_agent_device_command(
-    client: OpenAI,
     agent: DeviceState,
     messages: List[Dict[str, str]],
     initial_reply: str,
     command: Dict[str, Any],
-) -> _CommandExecutionSummary:
-    # エージェント役デバイスに英語指示を生成して送信し、結果を整理
+    job_id: Optional[str] = None,
+) -> Generator[Any, Any, _CommandExecutionSummary]:
+    # エージェント役デバイスに英語指示を生成して送信し、結果を整理（job_id 指定時は先行送信済みのジョブを待つ）
+    # 英語指示は通常、計画の args.instruction に含まれており、無い場合だけ翻訳用の LLM 呼び出しを行う
 
     args = command.get("args") if isinstance(command, dict) else {}
     args_dict = args if isinstance(args, dict) else {}
@@ -1001,8 +2553,10 @@ def _execute_agent_device_command(
         english_instruction = raw_instruction.strip()
     else:
         try:
-            english_instruction = _call_llm_text(
-                client, _structured_agent_instruction_prompt(messages)
+            english_instruction = (
+                yield from _call_llm_text(
+                    _structured_agent_instruction_prompt(messages), purpose="agent_instruction"
+                )
             ).strip()
         except Exception as exc:  # pragma: no cover - network/SDK errors
             message = str(exc)
@@ -1030,15 +2584,11 @@ def _execute_agent_device_command(
                 error_text=message,
             )
 
-    command_args = dict(args_dict)
-    command_args["instruction"] = english_instruction
-
-    command_payload = {
-        "name": AGENT_COMMAND_NAME,
-        "args": command_args,
-    }
+    command_payload = _agent_command_payload(args_dict, english_instruction)
+    command_args = command_payload["args"]
 
-    job_id = _enqueue_device_command(agent.device_id, command_payload, source="agent")
+    if job_id is None:
+        job_id = _enqueue_device_command(agent.device_id, command_payload, source="agent")
     if job_id is None:
         failure_message = "指示を送信できませんでした。デバイスの接続状態を確認してください。"
         combined = (initial_reply + "\n" if initial_reply else "") + failure_message
@@ -1051,7 +2601,7 @@ def _execute_agent_device_command(
             is_agent=True,
         )
 
-    result = _await_device_result(agent.device_id, job_id, timeout=DEVICE_RESULT_TIMEOUT)
+    result = yield _DeviceResultRequest(agent.device_id, job_id, DEVICE_RESULT_TIMEOUT)
     device_label = _device_label_for_prompt(agent.device_id)
     if result:
         manual_reply = _manual_result_reply(
@@ -1067,6 +2617,7 @@ def _execute_agent_device_command(
             result=result,
             instruction=english_instruction,
             is_agent=True,
+            job_id=job_id,
         )
 
     timeout_reply = _timeout_reply(
@@ -1084,16 +2635,78 @@ def _execute_agent_device_command(
         manual_reply=timeout_reply,
         instruction=english_instruction,
         is_agent=True,
+        job_id=job_id,
     )
 
 
+def _template_number(value: Any) -> Optional[str]:
+    # 定型文に埋め込める数値（数値または数値だけの文字列）を表記に直す（該当しなければ None）
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        try:
+            value = float(value.strip())
+        except ValueError:
+            return None
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float) and math.isfinite(value):
+        return f"{value:.3f}".rstrip("0").rstrip(".")
+    return None
+
+
+def _template_step_reply(summary: _CommandExecutionSummary) -> Optional[str]:
+    # 成功したステップを 1 文で伝える定型文を作る。戻り値が数値・真偽値・値なしの場合だけ扱い、
+    # 文字列・辞書や、値が無く標準出力だけがある結果（英語のログなど）は None にして LLM に要約させる
+    result = summary.result
+    if summary.is_agent or not isinstance(result, dict) or result.get("ok") is not True:
+        return None
+    for key in ("stderr", "error"):
+        text = result.get(key)
+        if isinstance(text, str) and text.strip():
+            return None
+
+    return_value = result.get("return_value")
+    stdout = result.get("stdout")
+    if return_value is True:
+        outcome = "正常に完了しました。"
+    elif return_value is False:
+        outcome = "結果は「いいえ」でした。"
+    elif return_value is None:
+        if isinstance(stdout, str) and stdout.strip():
+            return None
+        outcome = "正常に完了しました。"
+    else:
+        number = _template_number(return_value)
+        if number is None:
+            return None
+        outcome = f"結果は {number} です。"
+
+    device_label = _device_label_for_prompt(summary.device_id) if summary.device_id else "対象デバイス"
+    return f"{device_label} でコマンド『{summary.command_name}』を実行しました。{outcome}"
+
+
+def _template_summary(summaries: List[_CommandExecutionSummary]) -> Optional[str]:
+    # 要約方針: 全ステップが成功し結果が単純なら定型文を返し、失敗や込み入った結果が含まれれば None（LLM で要約）
+    if not TEMPLATE_SUMMARIES or not summaries or len(summaries) > TEMPLATE_SUMMARY_MAX_STEPS:
+        return None
+    replies = [_template_step_reply(summary) for summary in summaries]
+    if any(reply is None for reply in replies):
+        return None
+    return "\n\n".join(reply for reply in replies if reply)
+
+
 def _summarize_device_command_sequence(
-    client: Optional[OpenAI],
     base_messages: List[Dict[str, str]],
     initial_reply: str,
     summaries: List[_CommandExecutionSummary],
-) -> str:
-    # 実行済みコマンドの要約を LLM もしくはフォールバックで生成
+) -> Generator[Any, Any, str]:
+    # 実行済みコマンドの要約を定型文・LLM・フォールバックのいずれかで生成
+
+    template_reply = _template_summary(summaries)
+    if template_reply is not None:
+        yield _ChatEvent("reply_delta", {"phase": "summary", "delta": template_reply})
+        return template_reply
 
     fallback_parts = [
         summary.manual_reply.strip()
@@ -1102,14 +2715,13 @@ def _summarize_device_command_sequence(
     ]
     fallback_reply = "\n\n".join(fallback_parts) if fallback_parts else initial_reply
 
-    if client is None:
-        return fallback_reply
-
     try:
         prompt_payload = _structured_multi_command_followup_prompt(
             base_messages, initial_reply, summaries
         )
-        llm_reply = _call_llm_text(client, prompt_payload)
+        llm_reply = yield from _call_llm_text(
+            prompt_payload, stream_phase="summary", purpose="summary"
+        )
     except Exception:
         return fallback_reply
 
@@ -1124,7 +2736,7 @@ def _structured_multi_command_followup_prompt(
 ) -> Dict[str, Any]:
     # マルチステップの実行結果を踏まえた最終回答生成プロンプトを構築
 
-    device_context = _build_device_context()
+    device_context = _build_device_context(base_messages, (summary.device_id for summary in summaries))
     step_descriptions: List[str] = []
 
     for index, summary in enumerate(summaries, start=1):
@@ -1186,12 +2798,12 @@ def _structured_multi_command_followup_prompt(
     return {"model": "gpt-4.1-2025-04-14", "input": messages}
 
 
-def _chat_via_legacy(messages: List[Dict[str, str]]) -> Tuple[Dict[str, Any], int]:
+def _chat_via_legacy(messages: List[Dict[str, str]]) -> ChatFlow:
     # エージェントデバイス不在時にレガシーフローでチャットを処理
 
+    dispatch = _SpeculativeDispatch(enabled=SPECULATIVE_DISPATCH)
     try:
-        client = _client()
-        parsed_response = _call_llm_and_parse(client, messages)
+        parsed_response = yield from _plan_chat_response(messages, dispatch)
     except RuntimeError as exc:
         return {"error": str(exc)}, 500
     except Exception as exc:  # pragma: no cover - network/SDK errors
@@ -1204,6 +2816,8 @@ def _chat_via_legacy(messages: List[Dict[str, str]]) -> Tuple[Dict[str, Any], in
     validated_commands, validation_errors = _validate_device_command_sequence(
         parsed_response.get("device_commands")
     )
+    job_ids, dispatch_notices = dispatch.settle([] if validation_errors else validated_commands)
+    validation_errors.extend(dispatch_notices)
 
     final_reply = reply_message
 
@@ -1213,14 +2827,229 @@ def _chat_via_legacy(messages: List[Dict[str, str]]) -> Tuple[Dict[str, Any], in
         return {"reply": final_reply}, 200
 
     if validated_commands:
-        final_reply, status = _execute_device_command_sequence(
-            client, messages, reply_message, validated_commands
+        final_reply, status = yield from _execute_device_command_sequence(
+            messages, reply_message, validated_commands, job_ids
         )
         return {"reply": final_reply}, status
 
     return {"reply": final_reply}, 200
 
 
+def _chat_messages_from_payload(
+    payload: Dict[str, Any],
+) -> Tuple[Optional[List[Dict[str, str]]], Optional[str]]:
+    # /api/chat の要求本文から会話履歴を取り出す。不正な場合は (None, エラー文) を返す
+    messages = payload.get("messages", [])
+
+    if not isinstance(messages, list):
+        return None, "messages must be a list"
+
+    formatted_messages = []
+    for msg in messages:
+        if not isinstance(msg, dict):
+            continue
+        role = msg.get("role")
+        content = msg.get("content")
+        if role not in {"system", "user", "assistant"} or not isinstance(content, str):
+            continue
+        formatted_messages.append({"role": role, "content": content})
+
+    if not formatted_messages or formatted_messages[-1]["role"] != "user":
+        return None, "last message must be from user"
+    return formatted_messages, None
+
+
+def _chat_flow(formatted_messages: List[Dict[str, str]]) -> ChatFlow:
+    # LLM 連携とデバイス制御を仲介するチャット処理本体
+
+    agent_device = _agent_device()
+    if not agent_device:
+        return (yield from _chat_via_legacy(formatted_messages))
+
+    dispatch = _SpeculativeDispatch(enabled=SPECULATIVE_DISPATCH)
+    try:
+        parsed_response = yield from _plan_chat_response(formatted_messages, dispatch)
+    except RuntimeError as exc:
+        return {"error": str(exc)}, 500
+    except Exception as exc:  # pragma: no cover - network/SDK errors
+        return {"error": str(exc)}, 500
+
+    reply_message = parsed_response.get("reply")
+    if not isinstance(reply_message, str):
+        reply_message = parsed_response.get("raw", "").strip()
+
+    validated_commands, validation_errors = _validate_device_command_sequence(
+        parsed_response.get("device_commands")
+    )
+    job_ids, dispatch_notices = dispatch.settle([] if validation_errors else validated_commands)
+    validation_errors.extend(dispatch_notices)
+
+    payload: Dict[str, Any] = {"reply": reply_message}
+    status: int = 200
+
+    if validation_errors:
+        notice = "\n".join(f"(システム通知: {error})" for error in validation_errors)
+        payload["reply"] = (reply_message + "\n" if reply_message else "") + notice
+    elif validated_commands:
+        final_reply, status = yield from _execute_device_command_sequence(
+            formatted_messages, reply_message, validated_commands, job_ids
+        )
+        payload = {"reply": final_reply}
+    return payload, status
+
+
+class ChatRun:
+    # 非同期モードで受け付けたチャット 1 件の進捗イベントと最終応答を保持する
+
+    FINISHED = frozenset({"completed", "failed"})
+
+    def __init__(self, run_id: str) -> None:
+        self.run_id = run_id
+        self.status = "queued"
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.events: List[Dict[str, Any]] = []
+        self.reply: Optional[str] = None
+        self.error: Optional[str] = None
+        self.http_status: Optional[int] = None
+        self._condition = threading.Condition()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in self.FINISHED
+
+    def add_event(self, event_type: str, data: Optional[Dict[str, Any]] = None) -> None:
+        # 進捗イベントを連番付きで追加し、ポーリング・SSE の待機者を起こす
+        with self._condition:
+            self._append_event(event_type, data)
+        _wake_async_waiters(_ASYNC_CHAT_RUN_WAKERS, self.run_id)
+
+    def _append_event(self, event_type: str, data: Optional[Dict[str, Any]]) -> None:
+        # self._condition を保持した状態で呼ぶ
+        now = time.time()
+        event: Dict[str, Any] = dict(data or {})
+        event.update({"seq": len(self.events) + 1, "type": event_type, "ts": now})
+        self.events.append(event)
+        self.updated_at = now
+        self._condition.notify_all()
+
+    def start(self) -> None:
+        with self._condition:
+            self.status = "running"
+            self._append_event("running", None)
+        _wake_async_waiters(_ASYNC_CHAT_RUN_WAKERS, self.run_id)
+
+    def finish(self, payload: Dict[str, Any], http_status: int) -> None:
+        # チャット処理フローの戻り値を記録し、completed / failed イベントで完了を通知する
+        reply = payload.get("reply")
+        error = payload.get("error")
+        with self._condition:
+            self.reply = reply if isinstance(reply, str) else None
+            self.error = str(error) if error is not None else None
+            self.http_status = http_status
+            self.status = "failed" if self.error is not None else "completed"
+            self._append_event(
+                self.status,
+                {"reply": self.reply, "error": self.error, "http_status": http_status},
+            )
+        _wake_async_waiters(_ASYNC_CHAT_RUN_WAKERS, self.run_id)
+
+    def snapshot(self, since: int = 0) -> Dict[str, Any]:
+        # 連番 since より後のイベントを含む現在の状態を返す
+        with self._condition:
+            return {
+                "run_id": self.run_id,
+                "status": self.status,
+                "created_at": self.created_at,
+                "updated_at": self.updated_at,
+                "reply": self.reply,
+                "error": self.error,
+                "http_status": self.http_status,
+                "events": [dict(event) for event in self.events[max(0, since):]],
+                "next_seq": len(self.events),
+            }
+
+    def wait_for_events(self, since: int, timeout: float) -> None:
+        # 連番 since より後のイベントが届くか完了するまで最大 timeout 秒待つ
+        with self._condition:
+            self._condition.wait_for(
+                lambda: len(self.events) > since or self.finished, timeout=timeout
+            )
+
+
+# 非同期モードのチャット実行を run_id で保持する（作成順）
+_CHAT_RUNS: "OrderedDict[str, ChatRun]" = OrderedDict()
+_CHAT_RUNS_LOCK = threading.Lock()
+_CHAT_RUN_EXECUTOR = ThreadPoolExecutor(max_workers=CHAT_RUN_WORKERS, thread_name_prefix="chat-run")
+
+
+def _create_chat_run() -> ChatRun:
+    # 新しいチャット実行を登録する。保持期限切れと上限超過の完了済み実行はここで破棄する
+    run = ChatRun(uuid.uuid4().hex)
+    now = time.time()
+    with _CHAT_RUNS_LOCK:
+        excess = len(_CHAT_RUNS) + 1 - MAX_CHAT_RUNS
+        for run_id, existing in list(_CHAT_RUNS.items()):
+            if not existing.finished:
+                continue
+            if excess > 0 or (CHAT_RUN_TTL and now - existing.updated_at > CHAT_RUN_TTL):
+                _CHAT_RUNS.pop(run_id, None)
+                excess -= 1
+        _CHAT_RUNS[run.run_id] = run
+    return run
+
+
+def _execute_chat_run(run: ChatRun, messages: List[Dict[str, str]]) -> None:
+    # ワーカースレッドでチャット処理フローを実行し、結果を run に記録する
+    run.start()
+    try:
+        payload, status = _run_chat_flow(_chat_flow(messages), on_event=run.add_event)
+    except Exception as exc:  # pragma: no cover - keep the worker alive
+        app.logger.exception("Chat run %s failed", run.run_id)
+        payload, status = {"error": str(exc)}, 500
+    run.finish(payload, status)
+
+
+def _start_chat_run(messages: List[Dict[str, str]]) -> Dict[str, Any]:
+    # チャットをワーカープールへ投入し、受け付け時点の状態を返す
+    if _BROKER is not None:
+        return _BROKER.start_chat_run(messages)
+    run = _create_chat_run()
+    _CHAT_RUN_EXECUTOR.submit(_execute_chat_run, run, messages)
+    return run.snapshot()
+
+
+def _chat_run_snapshot(run_id: str, since: int = 0, timeout: float = 0.0) -> Optional[Dict[str, Any]]:
+    # チャット実行の状態を返す。timeout 指定時は新しいイベントか完了まで待つ（不明な ID は None）
+    if _BROKER is not None:
+        return _BROKER.chat_run_snapshot(run_id, since, timeout)
+    run = _CHAT_RUNS.get(run_id)
+    if run is None:
+        return None
+    if timeout > 0:
+        run.wait_for_events(since, timeout)
+    return run.snapshot(since)
+
+
+def _chat_run_accepted(snapshot: Dict[str, Any]) -> Dict[str, Any]:
+    # 非同期モードの /api/chat が返す受け付け応答
+    run_id = snapshot["run_id"]
+    return {
+        "run_id": run_id,
+        "status": snapshot["status"],
+        "status_url": f"/api/chat/runs/{run_id}",
+        "stream_url": f"/api/chat/runs/{run_id}/stream",
+    }
+
+
+def _parse_event_seq(raw_value: Any) -> int:
+    # ?since= や Last-Event-ID の値をイベント連番として解釈する
+    try:
+        return max(0, int(raw_value))
+    except (TypeError, ValueError):
+        return 0
+
+
 @app.get("/")
 def index():
     # 認証済みでなければログインページへリダイレクト
@@ -1284,6 +3113,48 @@ def session_logout():
     return jsonify({"authenticated": False})
 
 
+@app.get("/api/stats")
+def server_stats():
+    # メモリ上に保持しているジョブ・結果の件数とプロセスのメモリ使用量を返す
+
+    return jsonify(_server_stats())
+
+
+def _server_stats() -> Dict[str, Any]:
+    # 状態を保持するプロセス（共有状態モードではブローカー）の統計を集計する
+    if _BROKER is not None:
+        return _BROKER.server_stats()
+
+    devices = list(_DEVICES.values())
+    return {
+        "memory": {
+            "rss_bytes": _process_rss_bytes(),
+            "devices": len(devices),
+            "queued_jobs": sum(len(device.job_queue) for device in devices),
+            "pending_jobs": len(_PENDING_JOBS),
+            "leased_jobs": sum(len(device.leased_job_ids) for device in devices),
+            "lease_timers": len(_LEASE_HEAP),
+            "job_metadata": len(_JOB_METADATA),
+            "completed_jobs": len(_COMPLETED_JOBS),
+            "completed_job_bytes": _COMPLETED_JOBS.total_bytes,
+            "mailbox_results": sum(len(device.job_results) for device in devices),
+            "result_waiters": len(_JOB_RESULT_EVENTS),
+            "async_device_waiters": sum(len(w) for w in list(_ASYNC_DEVICE_WAKERS.values())),
+            "async_result_waiters": sum(len(w) for w in list(_ASYNC_RESULT_WAKERS.values())),
+        },
+        "store": _JOB_STORE.stats(),
+        "llm": _chat_llm_usage_stats(),
+        "openai_pool": _openai_pool_stats(),
+        "limits": {
+            "max_completed_jobs": MAX_COMPLETED_JOBS,
+            "max_completed_job_bytes": MAX_COMPLETED_JOB_BYTES,
+            "completed_job_ttl": COMPLETED_JOB_TTL,
+            "mailbox_max_results": MAILBOX_MAX_RESULTS,
+            "mailbox_result_ttl": MAILBOX_RESULT_TTL,
+        },
+    }
+
+
 @app.get("/api/devices/ping")
 def device_ping():
     # エッジデバイスからの疎通確認に応答するシンプルなエンドポイント
@@ -1296,57 +3167,81 @@ def chat():
     # チャット API のメインエントリーポイントで、LLM 連携とデバイス制御を仲介
 
     payload = request.get_json(silent=True) or {}
-    messages = payload.get("messages", [])
+    formatted_messages, error = _chat_messages_from_payload(payload)
+    if error:
+        return jsonify({"error": error}), 400
 
-    if not isinstance(messages, list):
-        return jsonify({"error": "messages must be a list"}), 400
+    if payload.get("async"):
+        # run_id を即座に返し、進捗は /api/chat/runs/<run_id> で取得させる
+        return jsonify(_chat_run_accepted(_start_chat_run(formatted_messages))), 202
 
-    formatted_messages = []
-    for msg in messages:
-        if not isinstance(msg, dict):
-            continue
-        role = msg.get("role")
-        content = msg.get("content")
-        if role not in {"system", "user", "assistant"} or not isinstance(content, str):
-            continue
-        formatted_messages.append({"role": role, "content": content})
+    _sync_device_mirror()
+    payload, status = _run_chat_flow(_chat_flow(formatted_messages))
+    return jsonify(payload), status
 
-    if not formatted_messages or formatted_messages[-1]["role"] != "user":
-        return jsonify({"error": "last message must be from user"}), 400
 
-    agent_device = _agent_device()
-    if agent_device:
-        try:
-            client = _client()
-            parsed_response = _call_llm_and_parse(client, formatted_messages)
-        except RuntimeError as exc:
-            return jsonify({"error": str(exc)}), 500
-        except Exception as exc:  # pragma: no cover - network/SDK errors
-            return jsonify({"error": str(exc)}), 500
+@app.post("/api/chat/stream")
+def chat_stream():
+    # チャットを非同期実行し、応答トークンと進捗イベントをそのまま SSE で返す
 
-        reply_message = parsed_response.get("reply")
-        if not isinstance(reply_message, str):
-            reply_message = parsed_response.get("raw", "").strip()
+    payload = request.get_json(silent=True) or {}
+    formatted_messages, error = _chat_messages_from_payload(payload)
+    if error:
+        return jsonify({"error": error}), 400
 
-        validated_commands, validation_errors = _validate_device_command_sequence(
-            parsed_response.get("device_commands")
-        )
+    snapshot = _start_chat_run(formatted_messages)
+    response = _chat_run_event_stream(snapshot["run_id"], 0)
+    response.headers["X-Chat-Run-Id"] = snapshot["run_id"]
+    return response
 
-        payload: Dict[str, Any] = {"reply": reply_message}
-        status: int = 200
 
-        if validation_errors:
-            notice = "\n".join(f"(システム通知: {error})" for error in validation_errors)
-            payload["reply"] = (reply_message + "\n" if reply_message else "") + notice
-        elif validated_commands:
-            final_reply, status = _execute_device_command_sequence(
-                client, formatted_messages, reply_message, validated_commands
-            )
-            payload = {"reply": final_reply}
-    else:
-        payload, status = _chat_via_legacy(formatted_messages)
+@app.get("/api/chat/runs/<run_id>")
+def get_chat_run(run_id: str):
+    # 非同期モードのチャットの状態と、?since= より後の進捗イベントを返す（?wait= で保留可能）
 
-    return jsonify(payload), status
+    snapshot = _chat_run_snapshot(
+        run_id,
+        _parse_event_seq(request.args.get("since")),
+        _parse_long_poll_wait(request.args.get("wait")),
+    )
+    if snapshot is None:
+        return jsonify({"error": "chat run not found"}), 404
+    return jsonify(snapshot)
+
+
+@app.get("/api/chat/runs/<run_id>/stream")
+def stream_chat_run(run_id: str):
+    # 非同期モードのチャットの進捗イベントを SSE で配信し、完了イベントで終了する
+
+    if _chat_run_snapshot(run_id) is None:
+        return jsonify({"error": "chat run not found"}), 404
+    since = _parse_event_seq(request.headers.get("Last-Event-ID") or request.args.get("since"))
+    return _chat_run_event_stream(run_id, since)
+
+
+def _chat_run_event_stream(run_id: str, since: int) -> Response:
+    # チャット実行の since より後のイベントを完了まで SSE で送り続けるレスポンスを生成する
+
+    def _generate():
+        next_seq = since
+        while True:
+            snapshot = _chat_run_snapshot(run_id, next_seq, SSE_KEEPALIVE_INTERVAL)
+            if snapshot is None:
+                yield _format_sse_event("closed", {"reason": "chat run not found"})
+                return
+            for event in snapshot["events"]:
+                yield _format_sse_event(event["type"], event, str(event["seq"]))
+            next_seq = snapshot["next_seq"]
+            if snapshot["status"] in ChatRun.FINISHED:
+                return
+            if not snapshot["events"]:
+                yield ": keep-alive\n\n"
+
+    return Response(
+        _generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.post("/api/devices/register")
@@ -1364,7 +3259,6 @@ def register_device():
         return jsonify({"error": "capabilities must be a list"}), 400
     capabilities = _normalise_capabilities(capabilities)
     cleaned_id = device_id.strip()
-    now = time.time()
     metadata = meta if isinstance(meta, dict) else {}
     manual_registration = metadata.get("registered_via") == "dashboard" or bool(
         payload.get("approved")
@@ -1380,66 +3274,84 @@ def register_device():
     elif isinstance(metadata, dict) and "display_name" in metadata:
         metadata.pop("display_name", None)
 
-    existing = _DEVICES.get(cleaned_id)
+    response_payload, status_code = _register_device(
+        cleaned_id, capabilities, metadata, manual_registration
+    )
+    return jsonify(response_payload), status_code
+
 
-    if existing:
-        if not existing.approved and not manual_registration:
-            return (
-                jsonify(
+def _register_device(
+    device_id: str,
+    capabilities: List[Dict[str, Any]],
+    metadata: Dict[str, Any],
+    manual_registration: bool,
+) -> Tuple[Dict[str, Any], int]:
+    # 検証済みの登録内容をデバイス状態へ反映し、(応答 JSON, ステータス) を返す
+    if _BROKER is not None:
+        return _BROKER.register_device(device_id, capabilities, metadata, manual_registration)
+
+    now = time.time()
+    # 同じ ID への登録・更新・削除が並行しても状態が混ざらないよう、デバイスロック内で行う
+    with _device_lock(device_id):
+        existing = _DEVICES.get(device_id)
+
+        if existing:
+            if not existing.approved and not manual_registration:
+                return (
                     {
                         "error": "device not approved",
                         "message": "Device must be registered from the dashboard before connecting.",
-                    }
-                ),
-                403,
-            )
+                    },
+                    403,
+                )
 
-        existing.capabilities = capabilities
-
-        if not isinstance(existing.meta, dict):
-            existing.meta = {}
-
-        incoming_meta = metadata.copy()
-        if manual_registration:
-            if "display_name" not in incoming_meta:
-                existing.meta.pop("display_name", None)
-        elif "display_name" in incoming_meta:
-            incoming_meta.pop("display_name", None)
-
-        existing.meta.update(incoming_meta)
-        existing.last_seen = now
-        if manual_registration:
-            existing.approved = True
-            existing.registered_at = existing.registered_at or now
-        status = "updated"
-        device_state = existing
-    else:
-        if not manual_registration:
-            return (
-                jsonify(
+            existing.capabilities = capabilities
+
+            if not isinstance(existing.meta, dict):
+                existing.meta = {}
+
+            incoming_meta = metadata.copy()
+            if manual_registration:
+                if "display_name" not in incoming_meta:
+                    existing.meta.pop("display_name", None)
+            elif "display_name" in incoming_meta:
+                incoming_meta.pop("display_name", None)
+
+            existing.meta.update(incoming_meta)
+            existing.last_seen = now
+            if manual_registration:
+                existing.approved = True
+                existing.registered_at = existing.registered_at or now
+            status = "updated"
+            device_state = existing
+        else:
+            if not manual_registration:
+                return (
                     {
                         "error": "device not approved",
                         "message": "Device must be registered from the dashboard before connecting.",
-                    }
-                ),
-                403,
+                    },
+                    403,
+                )
+
+            device_state = DeviceState(
+                device_id=device_id,
+                capabilities=capabilities,
+                meta=metadata,
+                last_seen=now,
+                approved=True,
             )
+            with _STATE_LOCK:
+                _DEVICES[device_id] = device_state
+            status = "registered"
 
-        device_state = DeviceState(
-            device_id=cleaned_id,
-            capabilities=capabilities,
-            meta=metadata,
-            last_seen=now,
-            approved=True,
-        )
-        _DEVICES[cleaned_id] = device_state
-        status = "registered"
+        _persist_device(device_state)
 
-    return jsonify({
+    return {
         "status": status,
         "device_id": device_state.device_id,
         "device": _serialize_device(device_state),
-    })
+    }, 200
 
 
 @app.get("/api/devices/<device_id>")
@@ -1450,11 +3362,26 @@ def get_device(device_id: str):
     if not cleaned_id:
         return jsonify({"error": "device_id is required"}), 400
 
-    device = _DEVICES.get(cleaned_id)
-    if not device:
+    record = _device_record(cleaned_id)
+    if record is None:
         return jsonify({"error": "device not registered"}), 404
 
-    return jsonify({"device": _serialize_device(device)})
+    return jsonify({"device": record})
+
+
+def _device_record(device_id: str) -> Optional[Dict[str, Any]]:
+    # 指定デバイスをシリアライズして返す（未登録なら None）
+    if _BROKER is not None:
+        return _BROKER.device_record(device_id)
+    device = _DEVICES.get(device_id)
+    return _serialize_device(device) if device is not None else None
+
+
+def _device_records() -> List[Dict[str, Any]]:
+    # 登録済みデバイスをすべてシリアライズして返す
+    if _BROKER is not None:
+        return _BROKER.device_snapshot()
+    return [_serialize_device(device) for device in list(_DEVICES.values())]
 
 
 @app.put("/api/devices/<device_id>")
@@ -1465,49 +3392,58 @@ def update_device(device_id: str):
     if not cleaned_id:
         return jsonify({"error": "device_id is required"}), 400
 
-    device = _DEVICES.get(cleaned_id)
-    if not device:
-        return jsonify({"error": "device not registered"}), 404
+    response_payload, status_code = _update_device(cleaned_id, request.get_json(silent=True) or {})
+    return jsonify(response_payload), status_code
 
-    payload = request.get_json(silent=True) or {}
 
-    if "capabilities" in payload:
-        capabilities = payload.get("capabilities")
-        if capabilities is None:
-            device.capabilities = []
-        elif isinstance(capabilities, list):
-            device.capabilities = _normalise_capabilities(capabilities)
-        else:
-            return jsonify({"error": "capabilities must be a list or null"}), 400
+def _update_device(device_id: str, payload: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+    # 更新内容をデバイス状態へ反映し、(応答 JSON, ステータス) を返す
+    if _BROKER is not None:
+        return _BROKER.update_device(device_id, payload)
 
-    if "meta" in payload:
-        meta = payload.get("meta")
-        if meta is None:
-            device.meta = {}
-        elif isinstance(meta, dict):
-            if not isinstance(device.meta, dict):
+    device = _DEVICES.get(device_id)
+    if not device:
+        return {"error": "device not registered"}, 404
+
+    with device.job_ready:
+        if "capabilities" in payload:
+            capabilities = payload.get("capabilities")
+            if capabilities is None:
+                device.capabilities = []
+            elif isinstance(capabilities, list):
+                device.capabilities = _normalise_capabilities(capabilities)
+            else:
+                return {"error": "capabilities must be a list or null"}, 400
+
+        if "meta" in payload:
+            meta = payload.get("meta")
+            if meta is None:
                 device.meta = {}
-            for key, value in meta.items():
-                if value is None:
-                    device.meta.pop(key, None)
-                else:
-                    device.meta[key] = value
-
-            display_name = device.meta.get("display_name")
-            if isinstance(display_name, str):
-                trimmed = display_name.strip()
-                if trimmed:
-                    device.meta["display_name"] = trimmed
-                else:
-                    device.meta.pop("display_name", None)
-        else:
-            return jsonify({"error": "meta must be an object or null"}), 400
+            elif isinstance(meta, dict):
+                if not isinstance(device.meta, dict):
+                    device.meta = {}
+                for key, value in meta.items():
+                    if value is None:
+                        device.meta.pop(key, None)
+                    else:
+                        device.meta[key] = value
+
+                display_name = device.meta.get("display_name")
+                if isinstance(display_name, str):
+                    trimmed = display_name.strip()
+                    if trimmed:
+                        device.meta["display_name"] = trimmed
+                    else:
+                        device.meta.pop("display_name", None)
+            else:
+                return {"error": "meta must be an object or null"}, 400
 
-    if "approved" in payload:
-        device.approved = bool(payload.get("approved"))
+        if "approved" in payload:
+            device.approved = bool(payload.get("approved"))
 
-    device.last_seen = time.time()
-    return jsonify({"status": "updated", "device": _serialize_device(device)})
+        device.last_seen = time.time()
+        _persist_device(device)
+    return {"status": "updated", "device": _serialize_device(device)}, 200
 
 
 @app.get("/api/devices/<device_id>/jobs")
@@ -1518,43 +3454,60 @@ def list_device_jobs(device_id: str):
     if not cleaned_id:
         return jsonify({"error": "device_id is required"}), 400
 
-    device = _DEVICES.get(cleaned_id)
-    if not device:
+    jobs = _device_job_history(cleaned_id)
+    if jobs is None:
         return jsonify({"error": "device not registered"}), 404
 
+    return jsonify({"device_id": cleaned_id, "jobs": jobs})
+
+
+def _device_job_history(device_id: str) -> Optional[List[Dict[str, Any]]]:
+    # デバイスのジョブを投入順に状態・結果付きで返す（未登録なら None）
+    if _BROKER is not None:
+        return _BROKER.device_job_history(device_id)
+
+    device = _DEVICES.get(device_id)
+    if not device:
+        return None
+
+    _prune_completed_jobs()
+    # デバイス別の索引は投入順に並んでいるため、全ジョブの走査やソートは不要
     jobs: List[Dict[str, Any]] = []
-    for job_id, metadata in _JOB_METADATA.items():
-        if metadata.get("device_id") != cleaned_id:
-            continue
+    with device.job_ready:
+        for job_id in list(device.job_ids):
+            metadata = _JOB_METADATA.get(job_id)
+            if metadata is None or metadata.get("device_id") != device_id:
+                continue
 
-        job_info = dict(metadata)
-        job_info["job_id"] = job_id
+            job_info = dict(metadata)
+            job_info["job_id"] = job_id
 
-        if job_id in _PENDING_JOBS:
-            if job_info.get("status") not in {"dispatched", "cancelled"}:
-                job_info["status"] = "pending"
-        elif job_id in _COMPLETED_JOBS and job_info.get("status") != "cancelled":
-            job_info["status"] = "completed"
-            job_info["result"] = _COMPLETED_JOBS[job_id]
+            completed_result = _COMPLETED_JOBS.get(job_id)
+            if job_id in _PENDING_JOBS:
+                if job_info.get("status") not in {"dispatched", "cancelled"}:
+                    job_info["status"] = "pending"
+            elif completed_result is not None and job_info.get("status") != "cancelled":
+                job_info["status"] = "completed"
+                job_info["result"] = completed_result
 
-        jobs.append({k: v for k, v in job_info.items() if v is not None})
+            jobs.append({k: v for k, v in job_info.items() if v is not None})
 
-    jobs.sort(key=lambda item: item.get("queued_at") or 0)
-    return jsonify({"device_id": cleaned_id, "jobs": jobs})
+    return jobs
 
 
-@app.post("/api/devices/<device_id>/jobs")
-def create_device_job(device_id: str):
-    # 外部サービスから直接ジョブを投入する API
+def _submit_device_job(
+    device_id: str, payload: Dict[str, Any]
+) -> Tuple[Dict[str, Any], int, Optional[float]]:
+    # ジョブ投入 API の本体。(応答 JSON, ステータス, 結果を待つ秒数または None) を返す
+    if _BROKER is not None:
+        return _BROKER.submit_device_job(device_id, payload)
 
     cleaned_id = (device_id or "").strip()
     if not cleaned_id:
-        return jsonify({"error": "device_id is required"}), 400
+        return {"error": "device_id is required"}, 400, None
 
     if cleaned_id not in _DEVICES:
-        return jsonify({"error": "device not registered"}), 404
-
-    payload = request.get_json(silent=True) or {}
+        return {"error": "device not registered"}, 404, None
 
     command_payload: Dict[str, Any]
     raw_command = payload.get("command")
@@ -1571,16 +3524,32 @@ def create_device_job(device_id: str):
 
     validated_command, error_message = _validate_device_command(command_payload)
     if not validated_command:
-        return jsonify({"error": error_message or "invalid command"}), 400
+        return {"error": error_message or "invalid command"}, 400, None
 
     queue_command = {
         "name": validated_command["name"],
         "args": validated_command.get("args", {}),
     }
 
-    job_id = _enqueue_device_command(cleaned_id, queue_command, source="api")
+    priority: Optional[int] = None
+    raw_priority = payload.get("priority")
+    if raw_priority is not None:
+        if isinstance(raw_priority, bool) or not isinstance(raw_priority, (int, float)):
+            return {"error": "priority must be an integer"}, 400, None
+        priority = int(raw_priority)
+
+    deadline: Optional[float] = None
+    raw_deadline = payload.get("deadline")
+    if raw_deadline is not None:
+        if isinstance(raw_deadline, bool) or not isinstance(raw_deadline, (int, float)):
+            return {"error": "deadline must be a UNIX timestamp"}, 400, None
+        deadline = float(raw_deadline)
+
+    job_id = _enqueue_device_command(
+        cleaned_id, queue_command, source="api", priority=priority, deadline=deadline
+    )
     if job_id is None:
-        return jsonify({"error": "device not registered"}), 404
+        return {"error": "device not registered"}, 404, None
 
     wait_for_result = bool(payload.get("wait_for_result"))
     timeout_value = payload.get("timeout")
@@ -1599,6 +3568,7 @@ def create_device_job(device_id: str):
             metadata["requested_via"] = requested_via.strip()
         else:
             metadata.setdefault("requested_via", "api")
+        _persist_job(job_id)
 
     response_payload: Dict[str, Any] = {
         "status": "queued",
@@ -1610,23 +3580,43 @@ def create_device_job(device_id: str):
 
     if metadata is not None:
         response_payload["queued_at"] = metadata.get("queued_at")
+        response_payload["priority"] = metadata.get("priority")
+        if metadata.get("deadline") is not None:
+            response_payload["deadline"] = metadata.get("deadline")
 
-    if wait_for_result:
-        result = _await_device_result(cleaned_id, job_id, timeout=timeout_seconds)
-        if result is not None:
-            response_payload.update({"status": "completed", "result": result})
-            status_code = 200
-        else:
-            response_payload.update(
-                {
-                    "status": "timeout",
-                    "message": f"Result not available within {int(timeout_seconds)} seconds.",
-                }
-            )
-            status_code = 202
-    else:
-        status_code = 202
+    return response_payload, 202, timeout_seconds if wait_for_result else None
+
+
+def _finish_device_job_wait(
+    response_payload: Dict[str, Any], result: Optional[Dict[str, Any]], timeout_seconds: float
+) -> Tuple[Dict[str, Any], int]:
+    # 結果待ちの終了後に、ジョブ投入 API の応答へ結果またはタイムアウトを反映する
+    if result is not None:
+        response_payload.update({"status": "completed", "result": result})
+        return response_payload, 200
+    response_payload.update(
+        {
+            "status": "timeout",
+            "message": f"Result not available within {int(timeout_seconds)} seconds.",
+        }
+    )
+    return response_payload, 202
+
+
+@app.post("/api/devices/<device_id>/jobs")
+def create_device_job(device_id: str):
+    # 外部サービスから直接ジョブを投入する API
 
+    response_payload, status_code, wait_seconds = _submit_device_job(
+        device_id, request.get_json(silent=True) or {}
+    )
+    if wait_seconds is not None:
+        result = _await_device_result(
+            response_payload["device_id"], response_payload["job_id"], timeout=wait_seconds
+        )
+        response_payload, status_code = _finish_device_job_wait(
+            response_payload, result, wait_seconds
+        )
     return jsonify(response_payload), status_code
 
 
@@ -1634,7 +3624,7 @@ def create_device_job(device_id: str):
 def list_devices():
     # 登録済みデバイス一覧を JSON 形式で返却
 
-    devices = [_serialize_device(device) for device in _DEVICES.values()]
+    devices = _device_records()
     devices.sort(key=lambda d: d["device_id"])
     return jsonify({"devices": devices})
 
@@ -1647,16 +3637,9 @@ def update_device_name(device_id: str):
     if not cleaned_id:
         return jsonify({"error": "device_id is required"}), 400
 
-    device = _DEVICES.get(cleaned_id)
-    if not device:
-        return jsonify({"error": "device not registered"}), 404
-
     payload = request.get_json(silent=True) or {}
     display_name = payload.get("display_name") if payload else None
 
-    if not isinstance(device.meta, dict):
-        device.meta = {}
-
     if display_name is None:
         new_name = ""
     elif isinstance(display_name, str):
@@ -1664,13 +3647,32 @@ def update_device_name(device_id: str):
     else:
         return jsonify({"error": "display_name must be a string or null"}), 400
 
-    if new_name:
-        device.meta["display_name"] = new_name
-    else:
-        device.meta.pop("display_name", None)
+    device_record = _rename_device(cleaned_id, new_name)
+    if device_record is None:
+        return jsonify({"error": "device not registered"}), 404
+    return jsonify({"status": "updated", "device": device_record})
 
-    device.last_seen = time.time()
-    return jsonify({"status": "updated", "device": _serialize_device(device)})
+
+def _rename_device(device_id: str, new_name: str) -> Optional[Dict[str, Any]]:
+    # 表示名を更新（空文字なら削除）し、更新後のデバイスを返す（未登録なら None）
+    if _BROKER is not None:
+        return _BROKER.rename_device(device_id, new_name)
+
+    device = _DEVICES.get(device_id)
+    if not device:
+        return None
+
+    with device.job_ready:
+        if not isinstance(device.meta, dict):
+            device.meta = {}
+        if new_name:
+            device.meta["display_name"] = new_name
+        else:
+            device.meta.pop("display_name", None)
+
+        device.last_seen = time.time()
+        _persist_device(device)
+    return _serialize_device(device)
 
 
 @app.delete("/api/devices/<device_id>")
@@ -1681,19 +3683,38 @@ def delete_device(device_id: str):
     if not cleaned_id:
         return jsonify({"error": "device_id is required"}), 400
 
-    device = _DEVICES.pop(cleaned_id, None)
-    if not device:
+    if not _delete_device(cleaned_id):
         return jsonify({"error": "device not registered"}), 404
+    return jsonify({"status": "deleted", "device_id": cleaned_id})
 
-    stale_jobs = [job_id for job_id, mapped in _PENDING_JOBS.items() if mapped == cleaned_id]
-    for job_id in stale_jobs:
-        _PENDING_JOBS.pop(job_id, None)
-        metadata = _JOB_METADATA.get(job_id)
-        if metadata is not None:
-            metadata["status"] = "cancelled"
-            metadata["cancelled_at"] = time.time()
 
-    return jsonify({"status": "deleted", "device_id": cleaned_id})
+def _delete_device(device_id: str) -> bool:
+    # デバイスと未完了のジョブを取り消す。未登録なら False
+    if _BROKER is not None:
+        return _BROKER.delete_device(device_id)
+
+    with _device_lock(device_id):
+        with _STATE_LOCK:
+            device = _DEVICES.pop(device_id, None)
+        if not device:
+            return False
+
+        # ロングポーリング中の取得要求を即座に終了させる
+        _notify_device_waiters(device)
+
+        for job_id in list(device.pending_job_ids):
+            with _STATE_LOCK:
+                _PENDING_JOBS.pop(job_id, None)
+            metadata = _JOB_METADATA.get(job_id)
+            if metadata is not None:
+                metadata["status"] = "cancelled"
+                metadata["cancelled_at"] = time.time()
+            _persist_job(job_id)
+            _notify_job_waiters(job_id)
+        # 取り消したジョブの書き込みより後に積み、デバイスのジョブ・結果ごと保存先から消す
+        _JOB_STORE.delete_device(device_id)
+
+    return True
 
 
 @app.get("/api/devices/<device_id>/jobs/next")
@@ -1704,23 +3725,156 @@ def next_job(device_id: str):
     if not cleaned_id:
         return jsonify({"error": "device_id is required"}), 400
 
-    device = _DEVICES.get(cleaned_id)
-    if not device:
+    wait_seconds = _parse_long_poll_wait(request.args.get("wait"))
+    # ?max= 指定時は {"jobs": [...]} 形式で複数ジョブを返す（未指定時は従来の単一ジョブ）
+    batch_size = _parse_job_batch_size(request.args.get("max"))
+
+    # ?wait= 指定時はジョブ投入か削除、またはタイムアウトまで保留する
+    jobs = _take_device_jobs(cleaned_id, timeout=wait_seconds, limit=batch_size or 1)
+    if jobs is None:
         return jsonify({"error": "device not registered"}), 404
+    if not jobs:
+        return ("", 204)
+
+    _confirm_jobs_dispatched(jobs)
+
+    if batch_size is None:
+        return jsonify(jobs[0])
+    return jsonify({"jobs": jobs})
+
+
+def _requeue_jobs(device: DeviceState, jobs: List[Dict[str, Any]]) -> None:
+    # 配信できなかったジョブを元の優先度・投入時刻のままキューへ戻す
+    if not jobs:
+        return
+    with device.job_ready:
+        for job in jobs:
+            metadata = _JOB_METADATA.get(job.get("job_id")) or {}
+            device.job_queue.push(
+                job,
+                priority=metadata.get("priority") or 0,
+                deadline=metadata.get("deadline"),
+                queued_at=metadata.get("queued_at"),
+            )
+        _notify_device_waiters(device)
+
+
+def _device_registered(device_id: str) -> bool:
+    if _BROKER is not None:
+        return _BROKER.device_registered(device_id)
+    return device_id in _DEVICES
+
 
+def _take_device_jobs(
+    device_id: str,
+    *,
+    timeout: float,
+    limit: int,
+    stop: Optional[threading.Event] = None,
+) -> Optional[List[Dict[str, Any]]]:
+    # ジョブが入るまで最大 timeout 秒待って取り出す。デバイスが削除されていれば None
+    if _BROKER is not None:
+        return _BROKER.take_device_jobs(device_id, timeout, limit)
+
+    device = _DEVICES.get(device_id)
+    if device is None:
+        return None
+    device.last_seen = time.time()
+    with device.job_ready:
+        if not device.job_queue and timeout > 0:
+            device.job_ready.wait_for(
+                lambda: bool(device.job_queue)
+                or _DEVICES.get(device_id) is not device
+                or (stop is not None and stop.is_set()),
+                timeout=timeout,
+            )
+        if _DEVICES.get(device_id) is not device:
+            return None
+        if stop is not None and stop.is_set():
+            return []
+        jobs = _pop_dispatchable_jobs(device, limit)
     device.last_seen = time.time()
+    return jobs
 
-    if not device.job_queue:
-        return ("", 204)
 
-    job = device.job_queue.popleft()
-    job_id = job.get("job_id") if isinstance(job, dict) else None
-    if isinstance(job_id, str):
-        metadata = _JOB_METADATA.get(job_id)
-        if metadata is not None and metadata.get("status") == "pending":
-            metadata["status"] = "dispatched"
-            metadata["dispatched_at"] = time.time()
-    return jsonify(job)
+def _confirm_jobs_dispatched(jobs: List[Dict[str, Any]]) -> None:
+    # ストリームやソケットへの書き込みが完了したジョブを配信済みにする
+    if _BROKER is not None:
+        _BROKER.confirm_dispatched(jobs)
+        return
+    for job in jobs:
+        _mark_job_dispatched(job)
+
+
+def _return_undelivered_jobs(device_id: str, jobs: List[Dict[str, Any]]) -> None:
+    # 書き込めなかったジョブを元の順位のままキューへ戻す
+    if not jobs:
+        return
+    if _BROKER is not None:
+        _BROKER.return_jobs(device_id, jobs)
+        return
+    device = _DEVICES.get(device_id)
+    if device is not None:
+        _requeue_jobs(device, jobs)
+
+
+def _wake_device_waiters(device_id: str) -> None:
+    # ローカルで待機中のジョブ取り出しを起こす（ブローカー経由の待機はタイムアウトで戻る）
+    device = _DEVICES.get(device_id) if _BROKER is None else None
+    if device is not None:
+        with device.job_ready:
+            _notify_device_waiters(device)
+
+
+def _format_sse_event(event: str, data: Any, event_id: Optional[str] = None) -> str:
+    # Server-Sent Events 形式のメッセージ文字列を組み立てる
+    lines = [f"event: {event}"]
+    if event_id:
+        lines.append(f"id: {event_id}")
+    payload = json.dumps(data, ensure_ascii=False, default=str)
+    lines.extend(f"data: {line}" for line in payload.splitlines() or [""])
+    return "\n".join(lines) + "\n\n"
+
+
+@app.get("/api/devices/<device_id>/jobs/stream")
+def stream_jobs(device_id: str):
+    # ジョブ投入と同時にデバイスへ配信する SSE ストリーム
+
+    cleaned_id = (device_id or "").strip()
+    if not cleaned_id:
+        return jsonify({"error": "device_id is required"}), 400
+
+    if not _device_registered(cleaned_id):
+        return jsonify({"error": "device not registered"}), 404
+
+    def _generate():
+        yield _format_sse_event("ready", {"device_id": cleaned_id})
+        while True:
+            jobs = _take_device_jobs(
+                cleaned_id, timeout=SSE_KEEPALIVE_INTERVAL, limit=MAX_JOBS_PER_POLL
+            )
+            if jobs is None:
+                yield _format_sse_event("closed", {"reason": "device not registered"})
+                return
+            if not jobs:
+                yield ": keep-alive\n\n"
+                continue
+
+            for index, job in enumerate(jobs):
+                try:
+                    yield _format_sse_event("job", job, job.get("job_id"))
+                except GeneratorExit:
+                    # 書き込み前に切断されたジョブは次の接続やポーリングへ回す
+                    _return_undelivered_jobs(cleaned_id, jobs[index:])
+                    raise
+                # WSGI サーバーが次の要素を要求した時点で書き込みは完了している
+                _confirm_jobs_dispatched([job])
+
+    return Response(
+        _generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.get("/api/jobs/<job_id>")
@@ -1731,14 +3885,27 @@ def get_job(job_id: str):
     if not cleaned_id:
         return jsonify({"error": "job_id is required"}), 400
 
-    metadata = _JOB_METADATA.get(cleaned_id)
-    pending_device = _PENDING_JOBS.get(cleaned_id)
-    result = _COMPLETED_JOBS.get(cleaned_id)
+    response_payload = _job_status(cleaned_id)
+    if response_payload is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(response_payload)
+
+
+def _job_status(job_id: str) -> Optional[Dict[str, Any]]:
+    # ジョブの状態と結果をまとめて返す（見つからなければ None）
+    if _BROKER is not None:
+        return _BROKER.job_status(job_id)
+
+    # 新しい完了が無い間も保持期間切れの結果を返さないよう、参照時にも整理する
+    _prune_completed_jobs()
+    metadata = _JOB_METADATA.get(job_id)
+    pending_device = _PENDING_JOBS.get(job_id)
+    result = _COMPLETED_JOBS.get(job_id)
 
     if not metadata and not pending_device and result is None:
-        return jsonify({"error": "job not found"}), 404
+        return None
 
-    response_payload: Dict[str, Any] = {"job_id": cleaned_id}
+    response_payload: Dict[str, Any] = {"job_id": job_id}
 
     if metadata:
         response_payload.update({k: v for k, v in metadata.items() if v is not None})
@@ -1757,7 +3924,7 @@ def get_job(job_id: str):
 
     response_payload.setdefault("status", metadata.get("status") if metadata else "unknown")
 
-    return jsonify(response_payload)
+    return response_payload
 
 
 @app.delete("/api/jobs/<job_id>")
@@ -1768,108 +3935,114 @@ def cancel_job(job_id: str):
     if not cleaned_id:
         return jsonify({"error": "job_id is required"}), 400
 
-    if cleaned_id in _COMPLETED_JOBS:
-        return jsonify({"error": "job already completed"}), 409
+    payload, status = _cancel_queued_job(cleaned_id)
+    return jsonify(payload), status
+
+
+def _cancel_queued_job(job_id: str) -> Tuple[Dict[str, Any], int]:
+    # デバイスへ未配信のジョブを取り消し、(応答 JSON, ステータス) を返す
+    if _BROKER is not None:
+        return _BROKER.cancel_job(job_id)
+
+    if job_id in _COMPLETED_JOBS:
+        return {"error": "job already completed"}, 409
 
-    device_id = _PENDING_JOBS.get(cleaned_id)
-    metadata = _JOB_METADATA.get(cleaned_id)
+    device_id = _PENDING_JOBS.get(job_id)
+    metadata = _JOB_METADATA.get(job_id)
 
     if not device_id:
         if metadata and metadata.get("status") == "cancelled":
-            response_payload = {
-                "status": "cancelled",
-                "job_id": cleaned_id,
-                "device_id": metadata.get("device_id"),
-            }
-            return jsonify(response_payload)
-        return jsonify({"error": "job not found or already dispatched"}), 404
+            return {"status": "cancelled", "job_id": job_id, "device_id": metadata.get("device_id")}, 200
+        return {"error": "job not found or already dispatched"}, 404
 
-    device = _DEVICES.get(device_id)
-    if not device:
-        _PENDING_JOBS.pop(cleaned_id, None)
+    with _device_lock(device_id):
+        device = _DEVICES.get(device_id)
+        if not device:
+            _release_pending_job(job_id)
+            if metadata is not None:
+                metadata["status"] = "cancelled"
+                metadata["cancelled_at"] = time.time()
+            _persist_job(job_id)
+            _notify_job_waiters(job_id)
+            return {"status": "cancelled", "job_id": job_id, "device_id": device_id}, 200
+
+        # 取り出し・キャンセルは同じデバイスロック内で行うため、どちらか一方だけが成功する
+        if not device.job_queue.remove(job_id):
+            # ジョブは既にデバイスに取得されている
+            return {"error": "job already dispatched"}, 409
+
+        device.last_seen = time.time()
+        _release_pending_job(job_id)
         if metadata is not None:
             metadata["status"] = "cancelled"
             metadata["cancelled_at"] = time.time()
-        return jsonify({"status": "cancelled", "job_id": cleaned_id, "device_id": device_id})
-
-    removed = False
-    new_queue: Deque[Dict[str, Any]] = deque()
-    while device.job_queue:
-        job = device.job_queue.popleft()
-        if not removed and job.get("job_id") == cleaned_id:
-            removed = True
-            continue
-        new_queue.append(job)
+        _persist_job(job_id)
+        _notify_job_waiters(job_id)
 
-    device.job_queue = new_queue
+    return {"status": "cancelled", "job_id": job_id, "device_id": device_id}, 200
 
-    if not removed:
-        # ジョブは既にデバイスに取得されている
-        device.job_queue = new_queue
-        return jsonify({"error": "job already dispatched"}), 409
 
-    device.last_seen = time.time()
-    _PENDING_JOBS.pop(cleaned_id, None)
-    if metadata is not None:
-        metadata["status"] = "cancelled"
-        metadata["cancelled_at"] = time.time()
+@app.post("/api/devices/<device_id>/heartbeat")
+def device_heartbeat(device_id: str):
+    # 処理中ジョブのリースを延長し、デバイスの生存を記録する
 
-    return jsonify({"status": "cancelled", "job_id": cleaned_id, "device_id": device_id})
+    cleaned_id = (device_id or "").strip()
+    if not cleaned_id:
+        return jsonify({"error": "device_id is required"}), 400
 
+    payload = request.get_json(silent=True) or {}
+    raw_job_ids = payload.get("job_ids") if isinstance(payload, dict) else None
+    job_ids: Optional[List[str]] = None
+    if isinstance(raw_job_ids, list):
+        job_ids = [job_id.strip() for job_id in raw_job_ids if isinstance(job_id, str) and job_id.strip()]
 
-@app.post("/api/devices/<device_id>/jobs/result")
-def post_result(device_id: str):
-    # エッジデバイスからのジョブ結果を受け取り記録
+    extended = _record_device_heartbeat(cleaned_id, job_ids)
+    if extended is None:
+        return jsonify({"error": "device not registered"}), 404
+    return jsonify(
+        {
+            "status": "ok",
+            "device_id": cleaned_id,
+            "leases_extended": extended,
+            "lease_seconds": JOB_LEASE_SECONDS,
+        }
+    )
 
-    payload = request.get_json(silent=True)
-    if payload is None:
-        raw_body = request.get_data(cache=False, as_text=True) or ""
-        try:
-            payload = json.loads(raw_body) if raw_body else {}
-        except json.JSONDecodeError:
-            payload = {}
 
-    job_id = payload.get("job_id") if isinstance(payload, dict) else None
-    raw_device_id = payload.get("device_id") if isinstance(payload, dict) else None
+def _record_device_heartbeat(device_id: str, job_ids: Optional[List[str]]) -> Optional[List[str]]:
+    # デバイスの生存を記録してリースを延長し、延長した job_id を返す（未登録なら None）
+    if _BROKER is not None:
+        return _BROKER.device_heartbeat(device_id, job_ids)
+
+    device = _DEVICES.get(device_id)
+    if not device:
+        return None
+    device.last_seen = time.time()
+    return _extend_job_leases(device, job_ids)
+
 
-    query_device_id = request.args.get("device_id", "")
-    query_job_id = request.args.get("job_id", "")
-    header_device_id = request.headers.get("X-Device-ID", "")
-    path_device_id = device_id
+def _normalise_result_candidate(value: Any) -> Optional[str]:
+    # 結果送信に含まれる device_id / job_id 候補を空白除去して返す
+    if isinstance(value, str):
+        cleaned = value.strip()
+        if cleaned:
+            return cleaned
+    return None
 
-    provided_ids: List[str] = []
 
-    def _normalise_candidate(value: Any) -> Optional[str]:
-        if isinstance(value, str):
-            cleaned = value.strip()
-            if cleaned:
-                return cleaned
-        return None
+def _resolve_result_device(
+    job_id: Optional[str], candidate_ids: List[Any]
+) -> Tuple[Optional[DeviceState], bool, Optional[Tuple[Dict[str, Any], int]]]:
+    # 結果の送信元デバイスを特定し、(デバイス, job_id で補正したか, エラー応答) を返す
 
-    for candidate in (
-        raw_device_id,
-        query_device_id,
-        header_device_id,
-        path_device_id,
-    ):
-        cleaned = _normalise_candidate(candidate)
+    provided_ids: List[str] = []
+    for candidate in candidate_ids:
+        cleaned = _normalise_result_candidate(candidate)
         if cleaned and cleaned not in provided_ids:
             provided_ids.append(cleaned)
 
     if len(provided_ids) > 1:
-        return (
-            jsonify({"error": "conflicting device_id values"}),
-            400,
-        )
-
-    if not isinstance(job_id, str) or not job_id.strip():
-        cleaned_job_id = _normalise_candidate(query_job_id)
-        if cleaned_job_id:
-            job_id = cleaned_job_id
-        else:
-            job_id = None
-    else:
-        job_id = job_id.strip()
+        return None, False, ({"error": "conflicting device_id values"}, 400)
 
     mapped_device_id: Optional[str] = None
     if job_id:
@@ -1900,52 +4073,412 @@ def post_result(device_id: str):
 
     if not resolved_device:
         if provided_ids or job_id:
-            return jsonify({"error": "device not registered"}), 404
-        return jsonify({"error": "device_id is required"}), 400
+            return None, False, ({"error": "device not registered"}, 404)
+        return None, False, ({"error": "device_id is required"}, 400)
 
-    if (
-        mapped_device_id
-        and mapped_device_id in _DEVICES
-        and resolved_device.device_id != mapped_device_id
-    ):
-        resolved_device = _DEVICES[mapped_device_id]
-        mismatch_resolved_via_job = True
+    return resolved_device, mismatch_resolved_via_job, None
 
-    device = resolved_device
 
-    device.last_seen = time.time()
-    if isinstance(job_id, str) and job_id:
-        _PENDING_JOBS.pop(job_id, None)
-    else:
-        job_id = None
-    result_record = {
-        "job_id": job_id,
-        "ok": bool(payload.get("ok")),
-        "return_value": payload.get("return_value"),
-        "stdout": payload.get("stdout"),
-        "stderr": payload.get("stderr"),
-        "error": payload.get("error"),
-        "ts": payload.get("ts"),
-        "device_id": device.device_id,
-    }
-    device.last_result = result_record
-    if job_id:
-        device.job_results[job_id] = dict(result_record)
-        metadata = _JOB_METADATA.setdefault(job_id, {"job_id": job_id})
-        metadata["device_id"] = device.device_id
-        metadata.setdefault("command", payload.get("command"))
-        metadata.setdefault("queued_at", time.time())
-        metadata["status"] = "completed"
-        metadata["completed_at"] = time.time()
-        metadata["result_ok"] = bool(payload.get("ok"))
+def _record_job_result(
+    device: DeviceState, job_id: Optional[str], payload: Dict[str, Any]
+) -> Dict[str, Any]:
+    # 受信した結果をデバイス状態とジョブメタデータへ反映し、結果レコードを返す
+
+    with device.job_ready:
+        device.last_seen = time.time()
+        if job_id:
+            _release_pending_job(job_id)
+            device.leased_job_ids.discard(job_id)
+        result_record = {
+            "job_id": job_id,
+            "ok": bool(payload.get("ok")),
+            "return_value": payload.get("return_value"),
+            "stdout": payload.get("stdout"),
+            "stderr": payload.get("stderr"),
+            "error": payload.get("error"),
+            "ts": payload.get("ts"),
+            "device_id": device.device_id,
+        }
+        device.last_result = result_record
+        _touch_device_context(device)
+        if job_id:
+            device.job_results.put(job_id, dict(result_record))
+            with _STATE_LOCK:
+                metadata = _JOB_METADATA.setdefault(job_id, {"job_id": job_id})
+                metadata["device_id"] = device.device_id
+                device.job_ids.setdefault(job_id, None)
+            metadata.setdefault("command", payload.get("command"))
+            metadata.setdefault("queued_at", time.time())
+            metadata["status"] = "completed"
+            metadata["completed_at"] = time.time()
+            metadata["result_ok"] = bool(payload.get("ok"))
+            metadata.pop("lease_expires_at", None)
+            _persist_job(job_id)
+    return result_record
+
+
+@app.post("/api/devices/<device_id>/jobs/result")
+def post_result(device_id: str):
+    # エッジデバイスからのジョブ結果を受け取り記録
+
+    payload = request.get_json(silent=True)
+    if payload is None:
+        raw_body = request.get_data(cache=False, as_text=True) or ""
+        try:
+            payload = json.loads(raw_body) if raw_body else {}
+        except json.JSONDecodeError:
+            payload = {}
+    if not isinstance(payload, dict):
+        payload = {}
+
+    job_id = _normalise_result_candidate(payload.get("job_id")) or _normalise_result_candidate(
+        request.args.get("job_id", "")
+    )
+
+    response_payload, status_code = _accept_device_result(
+        job_id,
+        [
+            payload.get("device_id"),
+            request.args.get("device_id", ""),
+            request.headers.get("X-Device-ID", ""),
+            device_id,
+        ],
+        payload,
+    )
+    return jsonify(response_payload), status_code
+
+
+def _accept_device_result(
+    job_id: Optional[str], candidate_ids: List[Any], payload: Dict[str, Any]
+) -> Tuple[Dict[str, Any], int]:
+    # 送信元デバイスを特定して結果を記録し、待機者を起こす。(応答 JSON, ステータス) を返す
+    if _BROKER is not None:
+        return _BROKER.accept_result(job_id, candidate_ids, payload)
+
+    device, mismatch_resolved_via_job, error = _resolve_result_device(job_id, candidate_ids)
+    if error:
+        return error
+
+    result_record = _record_job_result(device, job_id, payload)
     _store_completed_job(job_id, result_record)
+    _notify_job_waiters(job_id)
 
     response_payload = {"status": "ack"}
     if mismatch_resolved_via_job:
         response_payload["warning"] = "device_id mismatch resolved via job_id"
 
-    return jsonify(response_payload)
+    return response_payload, 200
+
+
+@app.post("/api/devices/<device_id>/jobs/results")
+def post_results_bulk(device_id: str):
+    # 複数のジョブ結果を一括で受け取り、項目ごとの受領結果を返す
+
+    payload = request.get_json(silent=True)
+    if isinstance(payload, dict):
+        items = payload.get("results")
+    else:
+        items = payload
+
+    if not isinstance(items, list):
+        return jsonify({"error": "results must be a list"}), 400
+
+    return jsonify(_accept_device_results(items, [request.headers.get("X-Device-ID", ""), device_id]))
+
+
+def _accept_device_results(items: List[Any], candidate_ids: List[Any]) -> Dict[str, Any]:
+    # 複数の結果をまとめて記録し、項目ごとの受領結果を返す
+    if _BROKER is not None:
+        return _BROKER.accept_results(items, candidate_ids)
+
+    acks: List[Dict[str, Any]] = []
+    completed: List[Tuple[Optional[str], Dict[str, Any]]] = []
+
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            acks.append({"index": index, "status": "error", "error": "result must be an object"})
+            continue
+
+        job_id = _normalise_result_candidate(item.get("job_id"))
+        device, mismatch_resolved_via_job, error = _resolve_result_device(
+            job_id, [item.get("device_id"), *candidate_ids]
+        )
+        ack: Dict[str, Any] = {"index": index, "job_id": job_id}
+        if error:
+            error_payload, status_code = error
+            ack.update({"status": "error", "error": error_payload.get("error"), "code": status_code})
+            acks.append(ack)
+            continue
+
+        completed.append((job_id, _record_job_result(device, job_id, item)))
+        ack["status"] = "ack"
+        if mismatch_resolved_via_job:
+            ack["warning"] = "device_id mismatch resolved via job_id"
+        acks.append(ack)
+
+    _store_completed_jobs(completed)
+    for job_id, _ in completed:
+        _notify_job_waiters(job_id)
+
+    return {
+        "status": "ack",
+        "accepted": len(completed),
+        "rejected": len(acks) - len(completed),
+        "results": acks,
+    }
+
+
+def _handle_device_channel_message(device_id: str, raw_message: Any) -> Optional[Dict[str, Any]]:
+    # WebSocket で受信したデバイスからのメッセージを処理し、返信内容を返す
+
+    if _BROKER is not None:
+        return _BROKER.channel_message(device_id, raw_message)
+
+    device = _DEVICES.get(device_id)
+    if device is None:
+        return {"type": "closed", "reason": "device not registered"}
+
+    try:
+        message = json.loads(raw_message) if isinstance(raw_message, (str, bytes)) else None
+    except (TypeError, ValueError):
+        message = None
+    if not isinstance(message, dict):
+        return {"type": "error", "error": "message must be a JSON object"}
+
+    device.last_seen = time.time()
+    message_type = message.get("type")
+
+    if message_type == "heartbeat":
+        extended = _extend_job_leases(device)
+        return {"type": "heartbeat_ack", "ts": time.time(), "leases_extended": len(extended)}
+
+    if message_type == "result":
+        job_id = _normalise_result_candidate(message.get("job_id"))
+        resolved_device, mismatch_resolved_via_job, error = _resolve_result_device(
+            job_id, [message.get("device_id"), device.device_id]
+        )
+        ack: Dict[str, Any] = {"type": "ack", "job_id": job_id}
+        if error:
+            error_payload, status_code = error
+            ack.update({"status": "error", "error": error_payload.get("error"), "code": status_code})
+            return ack
+
+        result_record = _record_job_result(resolved_device, job_id, message)
+        _store_completed_job(job_id, result_record)
+        _notify_job_waiters(job_id)
+        ack["status"] = "ack"
+        if mismatch_resolved_via_job:
+            ack["warning"] = "device_id mismatch resolved via job_id"
+        return ack
+
+    return {"type": "error", "error": f"unsupported message type: {message_type}"}
+
+
+@sock.route("/api/devices/<device_id>/ws")
+def device_channel(ws, device_id: str):
+    # ジョブ配信・結果受信・死活監視を 1 本の WebSocket で扱うデバイスチャネル
+
+    cleaned_id = (device_id or "").strip()
+    if not _device_registered(cleaned_id):
+        ws.send(json.dumps({"type": "closed", "reason": "device not registered"}))
+        ws.close(reason=1008, message="device not registered")
+        return
+
+    send_lock = threading.Lock()
+    closed = threading.Event()
+
+    def _send(message: Dict[str, Any]) -> None:
+        with send_lock:
+            ws.send(json.dumps(message, ensure_ascii=False, default=str))
+
+    def _push_jobs() -> None:
+        # キューに入ったジョブを即座にソケットへ書き出す送信スレッド
+        while not closed.is_set():
+            jobs = _take_device_jobs(
+                cleaned_id, timeout=SSE_KEEPALIVE_INTERVAL, limit=MAX_JOBS_PER_POLL, stop=closed
+            )
+            if jobs is None:
+                closed.set()
+                try:
+                    _send({"type": "closed", "reason": "device not registered"})
+                    ws.close(reason=1008, message="device not registered")
+                except Exception:
+                    pass
+                return
+            if closed.is_set():
+                _return_undelivered_jobs(cleaned_id, jobs)
+                return
+
+            for index, job in enumerate(jobs):
+                try:
+                    _send({"type": "job", "job": job})
+                except Exception:
+                    # 送信できなかったジョブは次の接続やポーリングへ回す
+                    _return_undelivered_jobs(cleaned_id, jobs[index:])
+                    closed.set()
+                    return
+                _confirm_jobs_dispatched([job])
+
+    _send({"type": "ready", "device_id": cleaned_id})
+    sender = threading.Thread(target=_push_jobs, name=f"ws-jobs-{cleaned_id}", daemon=True)
+    sender.start()
+    try:
+        while not closed.is_set():
+            raw_message = ws.receive(timeout=WS_IDLE_TIMEOUT)
+            if raw_message is None:
+                # 一定時間ハートビートも結果も届かなければ切断とみなす
+                break
+            reply = _handle_device_channel_message(cleaned_id, raw_message)
+            if reply:
+                _send(reply)
+    finally:
+        closed.set()
+        _wake_device_waiters(cleaned_id)
+        sender.join(timeout=SSE_KEEPALIVE_INTERVAL)
+
+
+class DeviceStateService:
+    # ブローカープロセスで動作し、各ワーカーからの状態操作を受け付ける
+
+    def server_stats(self) -> Dict[str, Any]:
+        return _server_stats()
+
+    def device_snapshot(self) -> List[Dict[str, Any]]:
+        return _device_records()
+
+    def device_record(self, device_id: str) -> Optional[Dict[str, Any]]:
+        return _device_record(device_id)
+
+    def register_device(
+        self,
+        device_id: str,
+        capabilities: List[Dict[str, Any]],
+        metadata: Dict[str, Any],
+        manual_registration: bool,
+    ) -> Tuple[Dict[str, Any], int]:
+        return _register_device(device_id, capabilities, metadata, manual_registration)
+
+    def update_device(self, device_id: str, payload: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+        return _update_device(device_id, payload)
+
+    def rename_device(self, device_id: str, new_name: str) -> Optional[Dict[str, Any]]:
+        return _rename_device(device_id, new_name)
+
+    def delete_device(self, device_id: str) -> bool:
+        return _delete_device(device_id)
+
+    def device_heartbeat(self, device_id: str, job_ids: Optional[List[str]]) -> Optional[List[str]]:
+        return _record_device_heartbeat(device_id, job_ids)
+
+    def device_job_history(self, device_id: str) -> Optional[List[Dict[str, Any]]]:
+        return _device_job_history(device_id)
+
+    def job_status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return _job_status(job_id)
+
+    def submit_device_job(
+        self, device_id: str, payload: Dict[str, Any]
+    ) -> Tuple[Dict[str, Any], int, Optional[float]]:
+        return _submit_device_job(device_id, payload)
+
+    def accept_result(
+        self, job_id: Optional[str], candidate_ids: List[Any], payload: Dict[str, Any]
+    ) -> Tuple[Dict[str, Any], int]:
+        return _accept_device_result(job_id, candidate_ids, payload)
+
+    def accept_results(self, items: List[Any], candidate_ids: List[Any]) -> Dict[str, Any]:
+        return _accept_device_results(items, candidate_ids)
+
+    def enqueue_command(
+        self,
+        device_id: str,
+        command: Dict[str, Any],
+        source: str,
+        priority: Optional[int],
+        deadline: Optional[float],
+    ) -> Optional[str]:
+        return _enqueue_device_command(
+            device_id, command, source=source, priority=priority, deadline=deadline
+        )
+
+    def await_result(self, device_id: str, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        return _await_device_result(device_id, job_id, timeout=timeout)
+
+    def device_registered(self, device_id: str) -> bool:
+        return _device_registered(device_id)
+
+    def take_device_jobs(self, device_id: str, timeout: float, limit: int) -> Optional[List[Dict[str, Any]]]:
+        return _take_device_jobs(device_id, timeout=timeout, limit=limit)
+
+    def confirm_dispatched(self, jobs: List[Dict[str, Any]]) -> None:
+        _confirm_jobs_dispatched(jobs)
+
+    def return_jobs(self, device_id: str, jobs: List[Dict[str, Any]]) -> None:
+        _return_undelivered_jobs(device_id, jobs)
+
+    def channel_message(self, device_id: str, raw_message: Any) -> Optional[Dict[str, Any]]:
+        return _handle_device_channel_message(device_id, raw_message)
+
+    def cancel_job(self, job_id: str) -> Tuple[Dict[str, Any], int]:
+        return _cancel_queued_job(job_id)
+
+    def record_chat_llm_usage(self, calls: Dict[str, int], seconds: Optional[Dict[str, float]] = None) -> None:
+        _record_chat_llm_usage(calls, seconds)
+
+    def record_intent_route(self, hit: bool, seconds: float = 0.0) -> None:
+        _record_intent_route(hit, seconds)
+
+    def start_chat_run(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        return _start_chat_run(messages)
+
+    def chat_run_snapshot(self, run_id: str, since: int, timeout: float) -> Optional[Dict[str, Any]]:
+        return _chat_run_snapshot(run_id, since, timeout)
+
+
+def _sync_device_mirror() -> None:
+    # ワーカーのチャット処理が参照するデバイス一覧を、ブローカーの最新状態で置き換える
+    if _BROKER is None:
+        return
+    mirrored: Dict[str, DeviceState] = {}
+    for record in _device_records():
+        device = DeviceState(
+            device_id=record["device_id"],
+            capabilities=record.get("capabilities") or [],
+            meta=record.get("meta") or {},
+            last_seen=record.get("last_seen") or time.time(),
+            last_result=record.get("last_result"),
+            registered_at=record.get("registered_at") or time.time(),
+            approved=bool(record.get("approved")),
+            mirrored_job_counts=(int(record.get("queue_depth") or 0), int(record.get("pending_jobs") or 0)),
+        )
+        previous = _DEVICES.get(device.device_id)
+        if (
+            previous is not None
+            and previous.capabilities == device.capabilities
+            and previous.meta == device.meta
+            and previous.last_result == device.last_result
+            and previous.registered_at == device.registered_at
+        ):
+            # 内容が変わっていなければ、前回作った状況サマリーのブロックを引き継ぐ
+            device.context_version = previous.context_version
+            device.context_block = previous.context_block
+            device.context_index = previous.context_index
+        mirrored[device.device_id] = device
+    _DEVICES.clear()
+    _DEVICES.update(mirrored)
+
+
+if _BROKER is None:
+    # 保存済みの状態を復元し、終了時には未コミットの書き込みを書き出す
+    _restore_from_store()
+    atexit.register(_JOB_STORE.close)
+
+    # リース期限を監視し、応答の無いジョブを再配信するバックグラウンドスレッド
+    threading.Thread(target=_lease_monitor_loop, name="job-lease-monitor", daemon=True).start()
+    # 誰にも受け取られなかった結果を定期的に破棄する掃除スレッド
+    threading.Thread(target=_mailbox_sweeper_loop, name="result-mailbox-sweeper", daemon=True).start()
 
 
 if __name__ == "__main__":
+    start_openai_warmup()
     app.run(host="0.0.0.0", port=5006)
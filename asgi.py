@@ -0,0 +1,721 @@
+# ASGI サーバー（uvicorn など）で app.py と同じ API を提供するエントリーポイント
+#   uvicorn asgi:application --host 0.0.0.0 --port 5006
+# ロングポーリング・SSE・WebSocket・ジョブ結果待ち・チャットは非同期ハンドラで処理し、
+# 待機中の接続やチャットはスレッドを占有しない。その他の API と静的ファイルは
+# Flask アプリをスレッドプールで実行して応答する
+import asyncio
+import io
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs
+
+from openai import AsyncOpenAI
+
+from app import (
+    MAX_JOBS_PER_POLL,
+    OPENAI_MAX_RETRIES,
+    OPENAI_WARMUP,
+    SSE_KEEPALIVE_INTERVAL,
+    WS_IDLE_TIMEOUT,
+    _ASYNC_CHAT_RUN_WAKERS,
+    _ASYNC_DEVICE_WAKERS,
+    _ASYNC_RESULT_WAKERS,
+    _BROKER,
+    ChatFlow,
+    httpx,
+    ChatRun,
+    _ChatEvent,
+    _DeviceResultRequest,
+    _LlmRequest,
+    _add_async_waker,
+    _chat_flow,
+    _chat_messages_from_payload,
+    _chat_run_accepted,
+    _chat_run_snapshot,
+    _create_chat_run,
+    _collect_device_result,
+    _confirm_jobs_dispatched,
+    _device_registered,
+    _finish_device_job_wait,
+    _format_sse_event,
+    _count_openai_request,
+    _handle_device_channel_message,
+    _parse_event_seq,
+    _parse_job_batch_size,
+    _parse_long_poll_wait,
+    _openai_http_options,
+    _record_chat_llm_usage,
+    _remove_async_waker,
+    _apply_llm_stream_event,
+    _response_output_text,
+    _return_undelivered_jobs,
+    _submit_device_job,
+    _take_device_jobs,
+    _trace_openai_connection,
+)
+from app import app as flask_app
+
+Scope = Dict[str, Any]
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+if _BROKER is not None:
+    raise RuntimeError("asgi.py runs as a single process; unset STATE_BROKER_ADDRESS")
+
+# 非同期化していない API（ログイン・デバイス管理・静的ファイルなど）を実行するスレッド数
+ASGI_WSGI_THREADS = max(1, int(os.getenv("ASGI_WSGI_THREADS", "32")))
+_WSGI_EXECUTOR = ThreadPoolExecutor(max_workers=ASGI_WSGI_THREADS, thread_name_prefix="asgi-wsgi")
+
+_ASYNC_CLIENT: Optional[AsyncOpenAI] = None
+# 起動時の接続確立（OPENAI_WARMUP）のタスク
+_WARMUP_TASK: Optional["asyncio.Task[None]"] = None
+
+# 非同期モードで実行中のチャット（タスクが途中で破棄されないよう参照を保持する）
+_CHAT_RUN_TASKS: Set["asyncio.Task[None]"] = set()
+
+_DEVICE_ROUTE = re.compile(r"^/api/devices/(?P<device_id>[^/]+)/(?P<action>jobs/next|jobs/stream|jobs|ws)$")
+_CHAT_RUN_ROUTE = re.compile(r"^/api/chat/runs/(?P<run_id>[^/]+)(?P<stream>/stream)?$")
+
+
+## ------------------------------------------------------------
+## 待機処理（app.py からの通知でコルーチンを起こす）
+## ------------------------------------------------------------
+
+
+async def _wait_for_state(
+    registry: Dict[str, Set[Callable[[], None]]],
+    key: str,
+    check: Callable[[], Tuple[bool, Any]],
+    timeout: float,
+) -> Tuple[bool, Any]:
+    # check() が (完了, 値) の完了を返すまで、通知を受けるたびに再確認する
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+
+    def _waker() -> None:
+        loop.call_soon_threadsafe(event.set)
+
+    _add_async_waker(registry, key, _waker)
+    deadline = loop.time() + timeout
+    try:
+        while True:
+            # 確認より先にクリアし、確認直後の通知を取りこぼさないようにする
+            event.clear()
+            done, value = check()
+            if done:
+                return True, value
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False, value
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        _remove_async_waker(registry, key, _waker)
+
+
+async def _take_device_jobs_async(
+    device_id: str, *, timeout: float, limit: int
+) -> Optional[List[Dict[str, Any]]]:
+    # _take_device_jobs の非同期版。デバイスが削除されていれば None
+
+    def _check() -> Tuple[bool, Optional[List[Dict[str, Any]]]]:
+        jobs = _take_device_jobs(device_id, timeout=0, limit=limit)
+        return jobs is None or bool(jobs), jobs
+
+    done, jobs = await _wait_for_state(_ASYNC_DEVICE_WAKERS, device_id, _check, timeout)
+    return jobs if done else []
+
+
+async def _await_device_result_async(
+    device_id: str, job_id: str, timeout: float
+) -> Optional[Dict[str, Any]]:
+    # _await_device_result の非同期版。タイムアウトしたら None
+    _, result = await _wait_for_state(
+        _ASYNC_RESULT_WAKERS, job_id, lambda: _collect_device_result(device_id, job_id), timeout
+    )
+    return result
+
+
+async def _trace_openai_connection_async(name: str, info: Dict[str, Any]) -> None:
+    _trace_openai_connection(name, info)
+
+
+async def _count_openai_request_async(request: Any) -> None:
+    # app._count_openai_request の非同期版（非同期クライアントのトレースは coroutine で受け取る）
+    _count_openai_request(request)
+    request.extensions["trace"] = _trace_openai_connection_async
+
+
+def _async_client() -> AsyncOpenAI:
+    # 全チャットで共有する非同期版の OpenAI API クライアントを返し、API キーが無い場合は例外を送出
+    # （app._client と同じ接続プール設定で、チャットごとの TCP / TLS 接続の確立を避ける）
+    global _ASYNC_CLIENT
+    if _ASYNC_CLIENT is None:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise RuntimeError("OPENAI_API_KEY is not set")
+        options = _openai_http_options()
+        _ASYNC_CLIENT = AsyncOpenAI(
+            api_key=api_key,
+            timeout=options["timeout"],
+            max_retries=OPENAI_MAX_RETRIES,
+            http_client=httpx.AsyncClient(**options, event_hooks={"request": [_count_openai_request_async]}),
+        )
+    return _ASYNC_CLIENT
+
+
+async def _warm_up_async_client() -> None:
+    # 起動直後に接続プールへ接続を 1 本用意しておく（失敗しても通常どおり動作する）
+    try:
+        await _async_client().with_options(max_retries=0).models.list()
+    except Exception as exc:  # pragma: no cover - network/SDK errors
+        flask_app.logger.warning("OpenAI warm-up failed: %s", exc)
+
+
+async def _run_chat_flow_async(
+    flow: ChatFlow, on_event: Optional[Callable[[str, Dict[str, Any]], None]] = None
+) -> Tuple[Dict[str, Any], int]:
+    # app._run_chat_flow の非同期版。LLM 呼び出しと結果待ちを await で進める
+    llm_calls: Dict[str, int] = {}
+    llm_seconds: Dict[str, float] = {}
+    value: Any = None
+    error: Optional[Exception] = None
+    while True:
+        try:
+            step = flow.throw(error) if error is not None else flow.send(value)
+        except StopIteration as stop:
+            _record_chat_llm_usage(llm_calls, llm_seconds)
+            return stop.value
+        value, error = None, None
+        try:
+            if isinstance(step, _LlmRequest):
+                llm_calls[step.purpose] = llm_calls.get(step.purpose, 0) + 1
+                started = time.monotonic()
+                try:
+                    if step.on_delta is not None:
+                        value = await _stream_llm_response(step, on_event)
+                    else:
+                        response = await _async_client().responses.create(**step.payload)
+                        value = _response_output_text(response)
+                finally:
+                    llm_seconds[step.purpose] = llm_seconds.get(step.purpose, 0.0) + time.monotonic() - started
+            elif isinstance(step, _DeviceResultRequest):
+                value = await _await_device_result_async(step.device_id, step.job_id, step.timeout)
+            elif isinstance(step, _ChatEvent):
+                if on_event is not None:
+                    on_event(step.event, step.data)
+            else:
+                raise TypeError(f"unsupported chat flow step: {step!r}")
+        except Exception as exc:
+            error = exc
+
+
+async def _stream_llm_response(
+    step: _LlmRequest, on_event: Optional[Callable[[str, Dict[str, Any]], None]]
+) -> str:
+    # LLM の出力をストリーミングで受け取り、断片ごとに進捗イベントを通知して全文を返す
+    parts: List[str] = []
+    value: Optional[str] = None
+    stream = await _async_client().responses.create(**step.payload, stream=True)
+    async for event in stream:
+        text = _apply_llm_stream_event(event, step, on_event, parts)
+        if text is not None:
+            value = text
+    return value if value is not None else "".join(parts)
+
+
+async def _execute_chat_run_async(run: ChatRun, messages: List[Dict[str, str]]) -> None:
+    # app._execute_chat_run の非同期版。イベントループ上でチャット処理フローを実行する
+    run.start()
+    try:
+        payload, status = await _run_chat_flow_async(_chat_flow(messages), on_event=run.add_event)
+    except Exception as exc:  # pragma: no cover - keep the loop alive
+        flask_app.logger.exception("Chat run %s failed", run.run_id)
+        payload, status = {"error": str(exc)}, 500
+    run.finish(payload, status)
+
+
+def _launch_chat_run(messages: List[Dict[str, str]]) -> ChatRun:
+    # チャット実行を登録し、イベントループ上のタスクとして開始する
+    run = _create_chat_run()
+    task = asyncio.ensure_future(_execute_chat_run_async(run, messages))
+    _CHAT_RUN_TASKS.add(task)
+    task.add_done_callback(_CHAT_RUN_TASKS.discard)
+    return run
+
+
+async def _chat_run_snapshot_async(run_id: str, since: int, timeout: float) -> Optional[Dict[str, Any]]:
+    # _chat_run_snapshot の非同期版。新しいイベントか完了まで最大 timeout 秒待つ
+
+    def _check() -> Tuple[bool, Optional[Dict[str, Any]]]:
+        snapshot = _chat_run_snapshot(run_id, since)
+        done = snapshot is None or bool(snapshot["events"]) or snapshot["status"] in ChatRun.FINISHED
+        return done, snapshot
+
+    _, snapshot = await _wait_for_state(_ASYNC_CHAT_RUN_WAKERS, run_id, _check, timeout)
+    return snapshot
+
+
+## ------------------------------------------------------------
+## HTTP / WebSocket の補助関数
+## ------------------------------------------------------------
+
+
+async def _read_body(receive: Receive) -> bytes:
+    # リクエスト本文をすべて読み込む
+    chunks: List[bytes] = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+def _json_payload(scope: Scope, body: bytes) -> Dict[str, Any]:
+    # request.get_json(silent=True) or {} と同様に JSON 本文を辞書として取り出す
+    headers = dict(scope.get("headers") or [])
+    content_type = headers.get(b"content-type", b"").decode("latin-1").split(";")[0].strip()
+    if not (content_type == "application/json" or content_type.endswith("+json")):
+        return {}
+    try:
+        payload = flask_app.json.loads(body)
+    except ValueError:
+        return {}
+    return payload if isinstance(payload, dict) else {}
+
+
+def _query_param(scope: Scope, name: str) -> Optional[str]:
+    values = parse_qs(scope.get("query_string", b"").decode("latin-1")).get(name)
+    return values[0] if values else None
+
+
+async def _send_json(send: Send, data: Any, status: int) -> None:
+    body = (flask_app.json.dumps(data) + "\n").encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_empty(send: Send, status: int) -> None:
+    await send({"type": "http.response.start", "status": status, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def _wait_for_disconnect(receive: Receive) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def _run_until_disconnect(receive: Receive, coroutine: Awaitable[Any]) -> Tuple[bool, Any]:
+    # coroutine を実行し、先にクライアントが切断した場合は取り消して (False, None) を返す
+    task = asyncio.ensure_future(coroutine)
+    watcher = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+            await asyncio.wait({task})
+    if task.cancelled():
+        return False, None
+    return True, task.result()
+
+
+async def _start_event_stream(
+    send: Send, extra_headers: Optional[List[Tuple[bytes, bytes]]] = None
+) -> None:
+    # Server-Sent Events の応答ヘッダーを送る
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+                *(extra_headers or []),
+            ],
+        }
+    )
+
+
+async def _ws_send(send: Send, message: Dict[str, Any]) -> None:
+    await send({"type": "websocket.send", "text": flask_app.json.dumps(message)})
+
+
+## ------------------------------------------------------------
+## 非同期ハンドラ
+## ------------------------------------------------------------
+
+
+async def _chat(scope: Scope, receive: Receive, send: Send) -> None:
+    # /api/chat の非同期版。LLM 応答やデバイス結果を待つ間もスレッドを占有しない
+    payload = _json_payload(scope, await _read_body(receive))
+    formatted_messages, error = _chat_messages_from_payload(payload)
+    if error:
+        await _send_json(send, {"error": error}, 400)
+        return
+
+    if payload.get("async"):
+        run = _launch_chat_run(formatted_messages)
+        await _send_json(send, _chat_run_accepted(run.snapshot()), 202)
+        return
+
+    response_payload, status = await _run_chat_flow_async(_chat_flow(formatted_messages))
+    await _send_json(send, response_payload, status)
+
+
+async def _chat_stream(scope: Scope, receive: Receive, send: Send) -> None:
+    # POST /api/chat/stream の非同期版。応答トークンと進捗イベントを SSE で返す
+    payload = _json_payload(scope, await _read_body(receive))
+    formatted_messages, error = _chat_messages_from_payload(payload)
+    if error:
+        await _send_json(send, {"error": error}, 400)
+        return
+
+    run = _launch_chat_run(formatted_messages)
+    await _send_chat_run_events(receive, send, run.run_id, 0, [(b"x-chat-run-id", run.run_id.encode())])
+
+
+async def _get_chat_run(scope: Scope, receive: Receive, send: Send, run_id: str) -> None:
+    # GET /api/chat/runs/<run_id> の非同期版
+    connected, snapshot = await _run_until_disconnect(
+        receive,
+        _chat_run_snapshot_async(
+            run_id,
+            _parse_event_seq(_query_param(scope, "since")),
+            _parse_long_poll_wait(_query_param(scope, "wait")),
+        ),
+    )
+    if not connected:
+        return
+    if snapshot is None:
+        await _send_json(send, {"error": "chat run not found"}, 404)
+        return
+    await _send_json(send, snapshot, 200)
+
+
+async def _stream_chat_run(scope: Scope, receive: Receive, send: Send, run_id: str) -> None:
+    # GET /api/chat/runs/<run_id>/stream の非同期版（SSE）
+    if _chat_run_snapshot(run_id) is None:
+        await _send_json(send, {"error": "chat run not found"}, 404)
+        return
+    headers = dict(scope.get("headers") or [])
+    last_event_id = headers.get(b"last-event-id")
+    since = _parse_event_seq(
+        last_event_id.decode("latin-1") if last_event_id else _query_param(scope, "since")
+    )
+    await _send_chat_run_events(receive, send, run_id, since)
+
+
+async def _send_chat_run_events(
+    receive: Receive,
+    send: Send,
+    run_id: str,
+    since: int,
+    extra_headers: Optional[List[Tuple[bytes, bytes]]] = None,
+) -> None:
+    # チャット実行の since より後のイベントを完了まで SSE で送り続ける
+
+    async def _send_event(text: str) -> None:
+        await send({"type": "http.response.body", "body": text.encode(), "more_body": True})
+
+    async def _pump() -> None:
+        next_seq = since
+        while True:
+            snapshot = await _chat_run_snapshot_async(run_id, next_seq, SSE_KEEPALIVE_INTERVAL)
+            if snapshot is None:
+                await _send_event(_format_sse_event("closed", {"reason": "chat run not found"}))
+                return
+            for event in snapshot["events"]:
+                await _send_event(_format_sse_event(event["type"], event, str(event["seq"])))
+            next_seq = snapshot["next_seq"]
+            if snapshot["status"] in ChatRun.FINISHED:
+                return
+            if not snapshot["events"]:
+                await _send_event(": keep-alive\n\n")
+
+    await _start_event_stream(send, extra_headers)
+    connected, _ = await _run_until_disconnect(receive, _pump())
+    if connected:
+        await send({"type": "http.response.body", "body": b""})
+
+
+async def _create_device_job(scope: Scope, receive: Receive, send: Send, device_id: str) -> None:
+    # POST /api/devices/<device_id>/jobs の非同期版
+    payload = _json_payload(scope, await _read_body(receive))
+    response_payload, status_code, wait_seconds = _submit_device_job(device_id, payload)
+    if wait_seconds is not None:
+        result = await _await_device_result_async(
+            response_payload["device_id"], response_payload["job_id"], wait_seconds
+        )
+        response_payload, status_code = _finish_device_job_wait(
+            response_payload, result, wait_seconds
+        )
+    await _send_json(send, response_payload, status_code)
+
+
+async def _next_job(scope: Scope, receive: Receive, send: Send, device_id: str) -> None:
+    # GET /api/devices/<device_id>/jobs/next の非同期版（?wait= のロングポーリング）
+    if not _device_registered(device_id):
+        await _send_json(send, {"error": "device not registered"}, 404)
+        return
+
+    wait_seconds = _parse_long_poll_wait(_query_param(scope, "wait"))
+    batch_size = _parse_job_batch_size(_query_param(scope, "max"))
+    connected, jobs = await _run_until_disconnect(
+        receive, _take_device_jobs_async(device_id, timeout=wait_seconds, limit=batch_size or 1)
+    )
+    if not connected:
+        return
+    if jobs is None:
+        await _send_json(send, {"error": "device not registered"}, 404)
+        return
+    if not jobs:
+        await _send_empty(send, 204)
+        return
+
+    _confirm_jobs_dispatched(jobs)
+    await _send_json(send, jobs[0] if batch_size is None else {"jobs": jobs}, 200)
+
+
+async def _stream_jobs(scope: Scope, receive: Receive, send: Send, device_id: str) -> None:
+    # GET /api/devices/<device_id>/jobs/stream の非同期版（SSE）
+    if not _device_registered(device_id):
+        await _send_json(send, {"error": "device not registered"}, 404)
+        return
+
+    async def _send_event(text: str) -> None:
+        await send({"type": "http.response.body", "body": text.encode(), "more_body": True})
+
+    async def _pump() -> None:
+        await _send_event(_format_sse_event("ready", {"device_id": device_id}))
+        while True:
+            jobs = await _take_device_jobs_async(
+                device_id, timeout=SSE_KEEPALIVE_INTERVAL, limit=MAX_JOBS_PER_POLL
+            )
+            if jobs is None:
+                await _send_event(_format_sse_event("closed", {"reason": "device not registered"}))
+                return
+            if not jobs:
+                await _send_event(": keep-alive\n\n")
+                continue
+            for index, job in enumerate(jobs):
+                try:
+                    await _send_event(_format_sse_event("job", job, job.get("job_id")))
+                except BaseException:
+                    # 書き込み前に切断されたジョブは次の接続やポーリングへ回す
+                    _return_undelivered_jobs(device_id, jobs[index:])
+                    raise
+                _confirm_jobs_dispatched([job])
+
+    await _start_event_stream(send)
+    connected, _ = await _run_until_disconnect(receive, _pump())
+    if connected:
+        await send({"type": "http.response.body", "body": b""})
+
+
+async def _device_channel(scope: Scope, receive: Receive, send: Send, device_id: str) -> None:
+    # /api/devices/<device_id>/ws の非同期版。送信側はジョブ待ちのタスクで処理する
+    message = await receive()
+    if message["type"] != "websocket.connect":
+        return
+    await send({"type": "websocket.accept"})
+
+    if not _device_registered(device_id):
+        await _ws_send(send, {"type": "closed", "reason": "device not registered"})
+        await send({"type": "websocket.close", "code": 1008, "reason": "device not registered"})
+        return
+
+    async def _push_jobs() -> None:
+        # キューに入ったジョブを即座にソケットへ書き出す
+        while True:
+            jobs = await _take_device_jobs_async(
+                device_id, timeout=SSE_KEEPALIVE_INTERVAL, limit=MAX_JOBS_PER_POLL
+            )
+            if jobs is None:
+                await _ws_send(send, {"type": "closed", "reason": "device not registered"})
+                await send({"type": "websocket.close", "code": 1008, "reason": "device not registered"})
+                return
+            for index, job in enumerate(jobs):
+                try:
+                    await _ws_send(send, {"type": "job", "job": job})
+                except BaseException:
+                    # 送信できなかったジョブは次の接続やポーリングへ回す
+                    _return_undelivered_jobs(device_id, jobs[index:])
+                    raise
+                _confirm_jobs_dispatched([job])
+
+    await _ws_send(send, {"type": "ready", "device_id": device_id})
+    sender = asyncio.ensure_future(_push_jobs())
+    disconnected = False
+    try:
+        while not sender.done():
+            try:
+                message = await asyncio.wait_for(receive(), WS_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                # 一定時間ハートビートも結果も届かなければ切断とみなす
+                break
+            if message["type"] == "websocket.disconnect":
+                disconnected = True
+                break
+            if message["type"] != "websocket.receive":
+                continue
+            raw_message = message.get("text")
+            if raw_message is None:
+                raw_message = message.get("bytes")
+            reply = _handle_device_channel_message(device_id, raw_message)
+            if reply:
+                await _ws_send(send, reply)
+    finally:
+        sender.cancel()
+        await asyncio.gather(sender, return_exceptions=True)
+    if not disconnected:
+        try:
+            await send({"type": "websocket.close", "code": 1000})
+        except Exception:
+            # 送信側ですでに閉じている
+            pass
+
+
+## ------------------------------------------------------------
+## Flask アプリへの委譲
+## ------------------------------------------------------------
+
+
+def _wsgi_environ(scope: Scope, body: bytes) -> Dict[str, Any]:
+    # ASGI の scope から WSGI の environ を組み立てる
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client")
+    environ: Dict[str, Any] = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": io.StringIO(),
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    if client:
+        environ["REMOTE_ADDR"] = client[0]
+    for raw_name, raw_value in scope.get("headers") or []:
+        name = raw_name.decode("latin-1").upper().replace("-", "_")
+        value = raw_value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+            continue
+        if name == "CONTENT_LENGTH":
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _run_wsgi(environ: Dict[str, Any]) -> Tuple[int, List[Tuple[bytes, bytes]], bytes]:
+    # Flask アプリを同期的に実行し、(ステータス, ヘッダー, 本文) を返す
+    started: Dict[str, Any] = {}
+
+    def _start_response(status: str, headers: List[Tuple[str, str]], exc_info: Any = None) -> None:
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = [
+            (name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers
+        ]
+
+    iterable = flask_app(environ, _start_response)
+    try:
+        body = b"".join(iterable)
+    finally:
+        close = getattr(iterable, "close", None)
+        if close is not None:
+            close()
+    return started["status"], started["headers"], body
+
+
+async def _call_wsgi(scope: Scope, receive: Receive, send: Send) -> None:
+    body = await _read_body(receive)
+    loop = asyncio.get_running_loop()
+    status, headers, content = await loop.run_in_executor(
+        _WSGI_EXECUTOR, _run_wsgi, _wsgi_environ(scope, body)
+    )
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": content})
+
+
+async def _lifespan(receive: Receive, send: Send) -> None:
+    global _WARMUP_TASK
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            if OPENAI_WARMUP and os.getenv("OPENAI_API_KEY"):
+                _WARMUP_TASK = asyncio.ensure_future(_warm_up_async_client())
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _ASYNC_CLIENT is not None:
+                await _ASYNC_CLIENT.close()
+            _WSGI_EXECUTOR.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope: Scope, receive: Receive, send: Send) -> None:
+    # ASGI アプリケーション本体。待機を伴う API は非同期ハンドラへ、それ以外は Flask へ振り分ける
+    scope_type = scope["type"]
+    if scope_type == "lifespan":
+        await _lifespan(receive, send)
+        return
+
+    path = scope.get("path", "")
+    method = scope.get("method")
+    match = _DEVICE_ROUTE.match(path)
+    device_id = match.group("device_id").strip() if match else ""
+    action = match.group("action") if match else None
+
+    if scope_type == "websocket":
+        if action == "ws":
+            await _device_channel(scope, receive, send, device_id)
+        else:
+            await send({"type": "websocket.close", "code": 1000})
+        return
+
+    run_match = _CHAT_RUN_ROUTE.match(path)
+    if path == "/api/chat" and method == "POST":
+        await _chat(scope, receive, send)
+    elif path == "/api/chat/stream" and method == "POST":
+        await _chat_stream(scope, receive, send)
+    elif run_match and method == "GET":
+        if run_match.group("stream"):
+            await _stream_chat_run(scope, receive, send, run_match.group("run_id"))
+        else:
+            await _get_chat_run(scope, receive, send, run_match.group("run_id"))
+    elif match and device_id and (method, action) == ("POST", "jobs"):
+        await _create_device_job(scope, receive, send, device_id)
+    elif match and device_id and (method, action) == ("GET", "jobs/next"):
+        await _next_job(scope, receive, send, device_id)
+    elif match and device_id and (method, action) == ("GET", "jobs/stream"):
+        await _stream_jobs(scope, receive, send, device_id)
+    else:
+        await _call_wsgi(scope, receive, send)
@@ -0,0 +1,67 @@
+# 完了ジョブの保存（_store_completed_job）にかかる時間を、保持件数ごとに測るマイクロベンチマーク
+#
+#   python benchmarks/bench_completed_jobs.py
+#
+# 変更前の数値は、変更前のコミットを別の作業ツリーに展開して --repo で指定すると測れる:
+#   git worktree add /tmp/iot-before <commit>^ && python benchmarks/bench_completed_jobs.py --repo /tmp/iot-before
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RESULT = {"ok": True, "return_value": {"temp": 21.5}, "stdout": "x" * 200, "stderr": None, "error": None, "ts": 0}
+
+
+def _reset(app, capacity: int) -> None:
+    # 保持件数の上限を変え、空の状態から測り直す
+    app.MAX_COMPLETED_JOBS = capacity
+    app.MAX_COMPLETED_JOB_BYTES = 0
+    if hasattr(app._COMPLETED_JOBS, "put"):
+        app._COMPLETED_JOBS.__init__()
+    else:
+        # 変更前の dict + deque 実装
+        app._COMPLETED_JOBS.clear()
+        app._COMPLETED_JOB_ORDER.clear()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="完了ジョブ保存のマイクロベンチマーク")
+    parser.add_argument("--repo", default=ROOT, help="app.py を読み込む作業ツリー")
+    parser.add_argument("--stores", type=int, default=2000, help="計測する保存回数")
+    parser.add_argument("--capacities", default="1000,10000,100000", help="MAX_COMPLETED_JOBS（カンマ区切り）")
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ["JOB_STORE"] = "memory"
+    sys.path.insert(0, os.path.abspath(args.repo))
+    import app
+
+    for capacity in (int(value) for value in args.capacities.split(",")):
+        _reset(app, capacity)
+        existing = ["job{}".format(index) for index in range(capacity)]
+        for job_id in existing:
+            app._store_completed_job(job_id, RESULT)
+
+        # 満杯の状態で新しい結果を保存する（毎回いちばん古い結果が追い出される）
+        started = time.perf_counter()
+        for index in range(args.stores):
+            app._store_completed_job("new{}-{}".format(capacity, index), RESULT)
+        stored = time.perf_counter()
+        # 保存済みの結果を保存し直す（最新の位置へ移動する）
+        for index in range(args.stores):
+            app._store_completed_job(existing[-1 - index] if capacity > args.stores else existing[0], RESULT)
+        restored = time.perf_counter()
+
+        print(
+            "cap={:>7}: new {:8.1f} us/job, re-store {:8.1f} us/job".format(
+                capacity,
+                (stored - started) / args.stores * 1e6,
+                (restored - stored) / args.stores * 1e6,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
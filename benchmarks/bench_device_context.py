@@ -0,0 +1,142 @@
+# LLM プロンプト用のデバイス状況サマリー（_build_device_context）の組み立て時間を測るマイクロベンチマーク
+#
+#   python benchmarks/bench_device_context.py --devices 1000
+#
+# 「full rebuild」はキャッシュを使わずに全デバイスを描画し直す時間（キャッシュ導入前の処理と同じ出力）。
+# 変更前のツリーを --repo で指定した場合は、その _build_device_context の時間だけを表示する。
+# 続けて 10 / 100 / 1,000 台（--fleet-sizes）ごとに、会話を渡した場合のプロンプトの文字数と組み立て時間を
+# DEVICE_CONTEXT_TOP_K を有効にした場合と無効（0）にした場合で表示する。
+import argparse
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 関連度の順位付けに使う会話（表示名で 1 台を指している）
+MESSAGES = [{"role": "user", "content": "Sensor 7 の温度を 3 回測って"}]
+
+
+def _register_devices(app, count: int) -> None:
+    # 機能 5 個（引数付き）・アクションカタログ・直近の結果を持つデバイスを count 台登録する
+    app._DEVICES.clear()
+    for index in range(count):
+        capabilities = [
+            {
+                "name": "cmd_{}".format(number),
+                "description": "Command {} of device {}".format(number, index),
+                "params": [
+                    {"name": "times", "type": "int", "default": 3},
+                    {"name": "interval", "type": "float", "default": 0.5},
+                ],
+            }
+            for number in range(5)
+        ]
+        meta = {
+            "display_name": "Sensor {}".format(index),
+            "location": "lab",
+            "firmware": "1.2.3",
+            "action_catalog": [{"name": "act_{}".format(number), "description": "do something"} for number in range(3)],
+        }
+        device = app.DeviceState(
+            device_id="dev-{:04d}".format(index),
+            capabilities=capabilities,
+            meta=meta,
+            approved=True,
+            last_result={"job_id": "j", "ok": True, "return_value": {"t": 23.5}},
+        )
+        app._DEVICES[device.device_id] = device
+
+
+def _median_ms(func, repeat: int, setup=None) -> float:
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def _report_fleet_sizes(app, sizes, repeat: int) -> None:
+    # 台数ごとに、上位 K 台だけを詳しく載せる場合と全台を載せる場合のプロンプト文字数・組み立て時間を表示する
+    top_k = getattr(app, "DEVICE_CONTEXT_TOP_K", None)
+    settings = [("off", 0)] if top_k is None else [("off", 0), ("on (K={})".format(top_k), top_k)]
+    for size in sizes:
+        _register_devices(app, size)
+        devices = list(app._DEVICES.values())
+
+        def clear_cache():
+            # 変更前のツリーには関連度の索引（context_index）が無い
+            for device in devices:
+                for name in ("context_block", "context_index"):
+                    if hasattr(device, name):
+                        setattr(device, name, None)
+
+        def build():
+            if top_k is None:
+                # 変更前のツリーは会話を受け取らず、常に全台を載せる
+                return app._build_device_context()
+            return app._build_device_context(MESSAGES)
+
+        for label, value in settings:
+            if top_k is not None:
+                app.DEVICE_CONTEXT_TOP_K = value
+            print(
+                "{:5d} devices  top-K {:10s} prompt {:9,d} chars  cold {:8.2f} ms  warm {:8.2f} ms".format(
+                    size,
+                    label,
+                    len(build()),
+                    _median_ms(build, repeat, clear_cache),
+                    _median_ms(build, repeat),
+                )
+            )
+        if top_k is not None:
+            app.DEVICE_CONTEXT_TOP_K = top_k
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="デバイス状況サマリーのベンチマーク")
+    parser.add_argument("--repo", default=ROOT, help="app.py を読み込む作業ツリー")
+    parser.add_argument("--devices", type=int, default=1000, help="登録するデバイス数")
+    parser.add_argument("--repeat", type=int, default=20, help="試行回数（中央値を表示）")
+    parser.add_argument("--fleet-sizes", type=int, nargs="+", default=[10, 100, 1000], help="プロンプトの大きさを測る台数")
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ["JOB_STORE"] = "memory"
+    sys.path.insert(0, os.path.abspath(args.repo))
+    import app
+
+    _register_devices(app, args.devices)
+    if not hasattr(app, "_render_device_context_block"):
+        print("build (no cache):          {:8.2f} ms".format(_median_ms(app._build_device_context, args.repeat)))
+        print()
+        _report_fleet_sizes(app, args.fleet_sizes, args.repeat)
+        return
+
+    devices = list(app._DEVICES.values())
+
+    def full_rebuild():
+        return "\n\n".join(app._render_device_context_block(device) for device in devices)
+
+    def clear_cache():
+        for device in devices:
+            device.context_block = None
+
+    def touch_ten():
+        for device in devices[:10]:
+            app._touch_device_context(device)
+
+    assert full_rebuild() == app._build_device_context(), "cached output differs from a full rebuild"
+    print("full rebuild:              {:8.2f} ms".format(_median_ms(full_rebuild, args.repeat)))
+    print("cold cache:                {:8.2f} ms".format(_median_ms(app._build_device_context, args.repeat, clear_cache)))
+    print("warm cache:                {:8.2f} ms".format(_median_ms(app._build_device_context, args.repeat)))
+    print("warm, 10 devices changed:  {:8.2f} ms".format(_median_ms(app._build_device_context, args.repeat, touch_ten)))
+    print()
+    _report_fleet_sizes(app, args.fleet_sizes, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# ジョブの追加・配信・完了を内部ヘルパーで大量に流し、JOB_STORE ごとのスループットを測るベンチマーク
+#
+#   python benchmarks/bench_job_store.py --engine memory
+#   python benchmarks/bench_job_store.py --engine sqlite
+#   python benchmarks/bench_job_store.py --engine sqlite --commit-interval 0   # グループコミット無し
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ジョブストアのスループットベンチマーク")
+    parser.add_argument("--repo", default=ROOT, help="app.py を読み込む作業ツリー")
+    parser.add_argument("--engine", choices=("memory", "sqlite"), default="sqlite", help="JOB_STORE")
+    parser.add_argument("--commit-interval", default=None, help="JOB_STORE_COMMIT_INTERVAL（省略時は既定値）")
+    parser.add_argument("--jobs", type=int, default=20000, help="流すジョブ数")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="iot-agent-bench-")
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ["JOB_STORE"] = args.engine
+    os.environ["JOB_STORE_PATH"] = os.path.join(workdir, "bench.db")
+    if args.commit_interval is not None:
+        os.environ["JOB_STORE_COMMIT_INTERVAL"] = args.commit_interval
+    sys.path.insert(0, os.path.abspath(args.repo))
+    import app
+
+    # 完了結果の追い出しで計測がぶれないよう上限を外す
+    app.MAX_COMPLETED_JOBS = 10 ** 6
+    client = app.app.test_client()
+    client.post(
+        "/api/devices/register",
+        json={"device_id": "bench", "capabilities": [{"name": "noop"}], "meta": {"registered_via": "dashboard"}},
+    )
+    device = app._DEVICES["bench"]
+    count = args.jobs
+
+    started = time.perf_counter()
+    job_ids = [app._enqueue_device_command("bench", {"name": "noop", "args": {"i": index}}) for index in range(count)]
+    enqueued = time.perf_counter()
+    with device.job_ready:
+        jobs = app._pop_dispatchable_jobs(device, count)
+    for job in jobs:
+        app._mark_job_dispatched(job)
+    dispatched = time.perf_counter()
+    for job_id in job_ids:
+        result = app._record_job_result(device, job_id, {"ok": True, "return_value": 1})
+        app._store_completed_job(job_id, result)
+    completed = time.perf_counter()
+    app._JOB_STORE.flush()
+    flushed = time.perf_counter()
+
+    print(
+        "{:7s} enqueue {:9.0f}/s  dispatch {:9.0f}/s  complete {:9.0f}/s  final flush {:.0f} ms".format(
+            args.engine,
+            count / (enqueued - started),
+            count / (dispatched - enqueued),
+            count / (completed - dispatched),
+            (flushed - completed) * 1000,
+        )
+    )
+    stats = getattr(app._JOB_STORE, "stats", None)
+    if callable(stats):
+        print("store stats: {}".format(stats()))
+    app._JOB_STORE.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# Gunicorn のワーカー数ごとに、デバイス・ジョブ API のスループットを測るベンチマーク
+#
+#   python benchmarks/bench_multi_worker.py --workers 1 4
+#
+# 負荷生成プロセスを --clients 個起動し、それぞれが 1 台の模擬デバイスとして
+# ジョブ取り出し（/jobs/next）と結果送信を繰り返しながら、同じデバイスへ結果待ち付きのジョブを投入し続ける。
+# WEB_CONCURRENCY が 2 以上ではブローカープロセスが状態を持ち、HTTP の処理は各ワーカーで行われる。
+# 変更前の数値は、変更前のコミットを別の作業ツリーに展開して --repo で指定すると測れる:
+#   git worktree add /tmp/iot-before <commit>^ && python benchmarks/bench_multi_worker.py --repo /tmp/iot-before
+import argparse
+import multiprocessing
+import os
+import subprocess
+import threading
+import time
+
+import requests
+
+from bench_parallel_plan import _free_port, _start_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run_client(base_url: str, device_id: str, duration: float, counts) -> None:
+    # 模擬デバイスとジョブ投入側を 1 プロセス内で動かし、完了したジョブ数と HTTP リクエスト数を返す
+    requests.post(
+        base_url + "/api/devices/register",
+        json={"device_id": device_id, "capabilities": [{"name": "read"}], "meta": {"registered_via": "dashboard"}},
+    ).raise_for_status()
+    deadline = time.time() + duration
+    device_requests = [0]
+
+    def device_loop():
+        session = requests.Session()
+        while time.time() < deadline:
+            response = session.get("{}/api/devices/{}/jobs/next?wait=1".format(base_url, device_id))
+            device_requests[0] += 1
+            if response.status_code != 200:
+                continue
+            session.post(
+                "{}/api/devices/{}/jobs/result".format(base_url, device_id),
+                json={"job_id": response.json()["job_id"], "ok": True, "return_value": 1},
+            )
+            device_requests[0] += 1
+
+    device = threading.Thread(target=device_loop, daemon=True)
+    device.start()
+    session = requests.Session()
+    completed = 0
+    submitted = 0
+    while time.time() < deadline:
+        response = session.post(
+            "{}/api/devices/{}/jobs".format(base_url, device_id),
+            json={"name": "read", "args": {}, "wait_for_result": True, "timeout": 10},
+        )
+        submitted += 1
+        if response.status_code == 200 and response.json().get("status") == "completed":
+            completed += 1
+    device.join(timeout=5)
+    counts.put((completed, submitted + device_requests[0]))
+
+
+def _measure(args, workers: int) -> None:
+    port = _free_port()
+    env = dict(
+        os.environ,
+        IOT_AGENT_REPO=os.path.abspath(args.repo),
+        OPENAI_API_KEY="benchmark",
+        JOB_STORE="memory",
+        WEB_CONCURRENCY=str(workers),
+    )
+    env.pop("STATE_BROKER_ADDRESS", None)
+    server = _start_server("gunicorn", port, env)
+    base_url = "http://127.0.0.1:{}".format(port)
+    try:
+        counts = multiprocessing.Queue()
+        clients = [
+            multiprocessing.Process(target=_run_client, args=(base_url, "bench-{}".format(index), args.duration, counts))
+            for index in range(args.clients)
+        ]
+        for client in clients:
+            client.start()
+        totals = [counts.get() for _ in clients]
+        for client in clients:
+            client.join()
+        jobs = sum(completed for completed, _ in totals)
+        http_requests = sum(total for _, total in totals)
+        print(
+            "workers {:2d}  jobs/s {:8.1f}  requests/s {:8.1f}".format(
+                workers, jobs / args.duration, http_requests / args.duration
+            )
+        )
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            # 保留中のロングポーリングで終了が遅れる場合は強制終了する
+            server.kill()
+            server.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="複数ワーカー構成のスループットベンチマーク")
+    parser.add_argument("--repo", default=ROOT, help="サーバーを起動する作業ツリー")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4], help="測定する WEB_CONCURRENCY の値")
+    parser.add_argument("--clients", type=int, default=8, help="負荷生成プロセス数（1 プロセスにつき模擬デバイス 1 台）")
+    parser.add_argument("--duration", type=float, default=10.0, help="各条件の測定秒数")
+    args = parser.parse_args()
+
+    print("cpus {}  clients {}".format(os.cpu_count(), args.clients))
+    for workers in args.workers:
+        _measure(args, workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# 複数デバイスへの計画を逐次実行した場合と、同じ group にまとめて並行実行した場合の /api/chat の所要時間を測るベンチマーク
+#
+#   python benchmarks/bench_parallel_plan.py --server gunicorn
+#   python benchmarks/bench_parallel_plan.py --server gunicorn --no-speculation
+#   python benchmarks/bench_parallel_plan.py --server uvicorn
+#
+# OpenAI API のスタブ（fake_openai.py）と、処理時間の異なる模擬デバイスをこのプロセス内で動かし、
+# サーバーは子プロセスとして起動する。LLM は 8 文字ごとに --chunk-delay 秒かけて出力する。
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+import fake_openai
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 模擬デバイスごとのジョブ処理秒数
+DEVICES = {"pico": 0.5, "jetson": 1.5, "esp32": 0.8, "rpi": 1.0}
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_server(kind: str, port: int, env) -> subprocess.Popen:
+    if kind == "gunicorn":
+        command = [
+            sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+            "-b", "127.0.0.1:{}".format(port), "--timeout", "600", "app:app",
+        ]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "asgi:application", "--host", "127.0.0.1", "--port", str(port)]
+    process = subprocess.Popen(command, cwd=env["IOT_AGENT_REPO"], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get("http://127.0.0.1:{}/api/devices".format(port), timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("server did not start")
+
+
+def _run_device(base_url: str, device_id: str, stop: threading.Event) -> None:
+    # ジョブを取り出し、決まった秒数だけ処理してから結果を返す模擬デバイス
+    session = requests.Session()
+    while not stop.is_set():
+        response = session.get("{}/api/devices/{}/jobs/next?wait=1".format(base_url, device_id))
+        if response.status_code != 200:
+            continue
+        time.sleep(DEVICES[device_id])
+        session.post(
+            "{}/api/devices/{}/jobs/result".format(base_url, device_id),
+            json={"job_id": response.json()["job_id"], "ok": True, "return_value": device_id},
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="並行実行グループのベンチマーク")
+    parser.add_argument("--repo", default=ROOT, help="サーバーを起動する作業ツリー")
+    parser.add_argument("--server", choices=("gunicorn", "uvicorn"), default="gunicorn")
+    parser.add_argument("--no-speculation", action="store_true", help="SPECULATIVE_DISPATCH=0 で起動する")
+    parser.add_argument("--chunk-delay", type=float, default=0.04, help="スタブ LLM の 8 文字あたりの出力秒数")
+    parser.add_argument("--repeat", type=int, default=3, help="各条件の試行回数（中央値を表示）")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="iot-agent-bench-")
+    fake_openai.CONFIG["plan_path"] = os.path.join(workdir, "plan.json")
+    fake_openai.CONFIG["chunk_delay"] = args.chunk_delay
+    llm_port = _free_port()
+    fake_openai.start(llm_port)
+
+    port = _free_port()
+    env = dict(
+        os.environ,
+        IOT_AGENT_REPO=os.path.abspath(args.repo),
+        OPENAI_BASE_URL="http://127.0.0.1:{}/v1".format(llm_port),
+        OPENAI_API_KEY="benchmark",
+        JOB_STORE="memory",
+        WEB_CONCURRENCY="1",
+        SPECULATIVE_DISPATCH="0" if args.no_speculation else "1",
+    )
+    server = _start_server(args.server, port, env)
+    base_url = "http://127.0.0.1:{}".format(port)
+    stop = threading.Event()
+    threads = []
+    try:
+        for device_id in DEVICES:
+            requests.post(
+                base_url + "/api/devices/register",
+                json={"device_id": device_id, "capabilities": [{"name": "read"}], "meta": {"registered_via": "dashboard"}},
+            )
+        threads = [threading.Thread(target=_run_device, args=(base_url, device_id, stop), daemon=True) for device_id in DEVICES]
+        for thread in threads:
+            thread.start()
+
+        names = list(DEVICES)
+        for grouped in (False, True):
+            medians = {}
+            for steps in (2, 3, 4):
+                commands = [{"device_id": names[index], "name": "read", "args": {}} for index in range(steps)]
+                if grouped:
+                    for command in commands:
+                        command["group"] = 1
+                with open(fake_openai.CONFIG["plan_path"], "w", encoding="utf-8") as handle:
+                    json.dump({"reply": "確認します。", "device_commands": commands}, handle, ensure_ascii=False)
+                timings = []
+                for _ in range(args.repeat):
+                    started = time.time()
+                    response = requests.post(base_url + "/api/chat", json={"messages": [{"role": "user", "content": "go"}]})
+                    timings.append(time.time() - started)
+                    response.raise_for_status()
+                medians[steps] = round(statistics.median(timings), 2)
+            print(
+                "{:8s} {:12s} {}".format(
+                    args.server,
+                    "one group" if grouped else "serial plan",
+                    "  ".join("{} steps {:.2f} s".format(steps, seconds) for steps, seconds in medians.items()),
+                )
+            )
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=5)
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            # 保留中のロングポーリングで終了が遅れる場合は強制終了する
+            server.kill()
+            server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# 結果待ち（_await_device_result）の待機者が、結果の送信からどれだけ遅れて起きるかを測るベンチマーク
+#
+#   python benchmarks/bench_result_wait.py --waiters 200
+#
+# --waiters 個のジョブを投入してそれぞれの結果をスレッドで待たせ、/jobs/result へ 1 件ずつ結果を送る。
+# 送信開始から対応する待機者が戻るまでの時間の中央値と p99 を表示する。
+# 変更前の数値は、変更前のコミットを別の作業ツリーに展開して --repo で指定すると測れる:
+#   git worktree add /tmp/iot-before <commit>^ && python benchmarks/bench_result_wait.py --repo /tmp/iot-before
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEVICE_ID = "bench-device"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="結果待ちの起床遅延のベンチマーク")
+    parser.add_argument("--repo", default=ROOT, help="app.py を読み込む作業ツリー")
+    parser.add_argument("--waiters", type=int, default=200, help="同時に結果を待つジョブ数")
+    parser.add_argument("--interval", type=float, default=0.005, help="結果を送る間隔（秒）")
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ["JOB_STORE"] = "memory"
+    sys.path.insert(0, os.path.abspath(args.repo))
+    import app
+
+    client = app.app.test_client()
+    client.post(
+        "/api/devices/register",
+        json={"device_id": DEVICE_ID, "capabilities": [{"name": "read"}], "meta": {"registered_via": "dashboard"}},
+    )
+    job_ids = [app._enqueue_device_command(DEVICE_ID, {"name": "read", "args": {}}) for _ in range(args.waiters)]
+
+    woke_at = {}
+    missed = []
+
+    def wait(job_id):
+        result = app._await_device_result(DEVICE_ID, job_id, timeout=60)
+        woke_at[job_id] = time.perf_counter()
+        if result is None:
+            missed.append(job_id)
+
+    threads = [threading.Thread(target=wait, args=(job_id,), daemon=True) for job_id in job_ids]
+    for thread in threads:
+        thread.start()
+    # 全員が待機に入ってから結果を送る
+    time.sleep(1.0)
+
+    posted_at = {}
+    for job_id in job_ids:
+        posted_at[job_id] = time.perf_counter()
+        client.post(
+            "/api/devices/{}/jobs/result".format(DEVICE_ID),
+            json={"job_id": job_id, "ok": True, "return_value": 1},
+        )
+        time.sleep(args.interval)
+    for thread in threads:
+        thread.join(timeout=60)
+
+    latencies = sorted((woke_at[job_id] - posted_at[job_id]) * 1000 for job_id in job_ids if job_id in woke_at)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print("waiters {}  missed {}".format(args.waiters, len(missed)))
+    print("wake latency  median {:8.2f} ms  p99 {:8.2f} ms".format(statistics.median(latencies), p99))
+
+
+if __name__ == "__main__":
+    main()
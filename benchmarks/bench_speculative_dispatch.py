@@ -0,0 +1,113 @@
+# 計画の途中で確定したコマンドを先行送信する場合（SPECULATIVE_DISPATCH=1）と、
+# 計画の出力完了を待ってから送信する場合（SPECULATIVE_DISPATCH=0）の /api/chat の所要時間を比べるベンチマーク
+#
+#   python benchmarks/bench_speculative_dispatch.py --server gunicorn
+#   python benchmarks/bench_speculative_dispatch.py --server uvicorn
+#
+# 2〜5 ステップの計画を、同じデバイスへの連続したステップと、2 台のデバイスへの交互のステップの 2 通りで実行する。
+# OpenAI API のスタブ（fake_openai.py）と模擬デバイスは bench_parallel_plan.py と共通。
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+
+import requests
+
+import fake_openai
+from bench_parallel_plan import DEVICES, _free_port, _run_device, _start_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STEPS = (2, 3, 4, 5)
+# 計画の形ごとの、各ステップの送信先デバイス
+LAYOUTS = {
+    "same device": ("pico",),
+    "alternating": ("pico", "esp32"),
+}
+
+
+def _measure(args, speculative: bool, llm_port: int) -> None:
+    port = _free_port()
+    env = dict(
+        os.environ,
+        IOT_AGENT_REPO=os.path.abspath(args.repo),
+        OPENAI_BASE_URL="http://127.0.0.1:{}/v1".format(llm_port),
+        OPENAI_API_KEY="benchmark",
+        JOB_STORE="memory",
+        WEB_CONCURRENCY="1",
+        SPECULATIVE_DISPATCH="1" if speculative else "0",
+    )
+    server = _start_server(args.server, port, env)
+    base_url = "http://127.0.0.1:{}".format(port)
+    stop = threading.Event()
+    threads = []
+    try:
+        for device_id in DEVICES:
+            requests.post(
+                base_url + "/api/devices/register",
+                json={"device_id": device_id, "capabilities": [{"name": "read"}], "meta": {"registered_via": "dashboard"}},
+            )
+        threads = [threading.Thread(target=_run_device, args=(base_url, device_id, stop), daemon=True) for device_id in DEVICES]
+        for thread in threads:
+            thread.start()
+
+        for layout, targets in LAYOUTS.items():
+            medians = {}
+            for steps in STEPS:
+                commands = [{"device_id": targets[index % len(targets)], "name": "read", "args": {}} for index in range(steps)]
+                with open(fake_openai.CONFIG["plan_path"], "w", encoding="utf-8") as handle:
+                    json.dump({"reply": "確認します。", "device_commands": commands}, handle, ensure_ascii=False)
+                timings = []
+                for _ in range(args.repeat):
+                    started = time.time()
+                    response = requests.post(base_url + "/api/chat", json={"messages": [{"role": "user", "content": "go"}]})
+                    timings.append(time.time() - started)
+                    response.raise_for_status()
+                medians[steps] = statistics.median(timings)
+            print(
+                "{:8s} {:12s} {:11s} {}".format(
+                    args.server,
+                    "speculative" if speculative else "serial",
+                    layout,
+                    "  ".join("{} steps {:.2f} s".format(steps, seconds) for steps, seconds in medians.items()),
+                )
+            )
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=5)
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            # 保留中のロングポーリングで終了が遅れる場合は強制終了する
+            server.kill()
+            server.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="コマンド先行送信のベンチマーク")
+    parser.add_argument("--repo", default=ROOT, help="サーバーを起動する作業ツリー")
+    parser.add_argument("--server", choices=("gunicorn", "uvicorn"), default="gunicorn")
+    parser.add_argument("--chunk-delay", type=float, default=0.04, help="スタブ LLM の 8 文字あたりの出力秒数")
+    parser.add_argument("--repeat", type=int, default=3, help="各条件の試行回数（中央値を表示）")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="iot-agent-bench-")
+    fake_openai.CONFIG["plan_path"] = os.path.join(workdir, "plan.json")
+    fake_openai.CONFIG["chunk_delay"] = args.chunk_delay
+    llm_port = _free_port()
+    fake_openai.start(llm_port)
+    try:
+        for speculative in (False, True):
+            _measure(args, speculative, llm_port)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
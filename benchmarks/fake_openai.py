@@ -0,0 +1,142 @@
+# ベンチマーク用の OpenAI Responses API の簡易スタブ（ストリーミング応答にも対応）
+#
+#   python benchmarks/fake_openai.py 5099
+#   OPENAI_BASE_URL=http://127.0.0.1:5099/v1 OPENAI_API_KEY=x gunicorn -c gunicorn.conf.py app:app
+#
+# 計画用プロンプトには FAKE_PLAN の JSON をそのまま返し、それ以外には固定の文章を返す。
+# FAKE_TTFT で最初のトークンまでの秒数、FAKE_CHUNK_DELAY で 8 文字ごとの出力間隔を指定できる。
+# GET すると受け付けた呼び出し数と接続数を返す。
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONFIG = {
+    "plan_path": os.getenv("FAKE_PLAN", ""),
+    "ttft": float(os.getenv("FAKE_TTFT", "0")),
+    "chunk_delay": float(os.getenv("FAKE_CHUNK_DELAY", "0")),
+    "delay": float(os.getenv("FAKE_DELAY", "0.2")),
+}
+_COUNTS = {"calls": 0, "connections": set()}
+_COUNTS_LOCK = threading.Lock()
+
+
+def _reply_for(body):
+    # プロンプトの種類（計画・指示の翻訳・要約）に応じた応答文を返す
+    text = json.dumps(body.get("input"), ensure_ascii=False)
+    if "strict JSON object" in text:
+        try:
+            with open(CONFIG["plan_path"], encoding="utf-8") as handle:
+                return handle.read()
+        except (OSError, TypeError):
+            return json.dumps({"reply": "了解しました。", "device_commands": None}, ensure_ascii=False)
+    if "translate the latest user instruction" in text:
+        return "Check the weather."
+    return "すべてのステップが完了しました。"
+
+
+def _response(body, text, status):
+    return {
+        "id": "resp_1",
+        "object": "response",
+        "created_at": 0,
+        "model": body.get("model"),
+        "status": status,
+        "output": []
+        if status != "completed"
+        else [
+            {
+                "type": "message",
+                "id": "m1",
+                "role": "assistant",
+                "status": "completed",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }
+        ],
+        "parallel_tool_calls": False,
+        "tool_choice": "auto",
+        "tools": [],
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("content-length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        with _COUNTS_LOCK:
+            _COUNTS["calls"] += 1
+            _COUNTS["connections"].add(self.client_address)
+        text = _reply_for(body)
+        time.sleep(CONFIG["ttft"])
+        chunks = [text[index:index + 8] for index in range(0, len(text), 8)] or [""]
+        per_chunk = CONFIG["chunk_delay"] or CONFIG["delay"] / len(chunks)
+
+        if not body.get("stream"):
+            time.sleep(per_chunk * len(chunks))
+            data = json.dumps(_response(body, text, "completed")).encode()
+            self.send_response(200)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("transfer-encoding", "chunked")
+        self.end_headers()
+
+        def send_event(event):
+            data = "event: {}\ndata: {}\n\n".format(event["type"], json.dumps(event, ensure_ascii=False)).encode()
+            self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+            self.wfile.flush()
+
+        send_event({"type": "response.created", "response": _response(body, text, "in_progress"), "sequence_number": 0})
+        for index, chunk in enumerate(chunks):
+            time.sleep(per_chunk)
+            send_event(
+                {
+                    "type": "response.output_text.delta",
+                    "item_id": "m1",
+                    "output_index": 0,
+                    "content_index": 0,
+                    "delta": chunk,
+                    "sequence_number": index + 1,
+                    "logprobs": [],
+                }
+            )
+        send_event(
+            {
+                "type": "response.completed",
+                "response": _response(body, text, "completed"),
+                "sequence_number": len(chunks) + 1,
+            }
+        )
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        with _COUNTS_LOCK:
+            data = json.dumps({"calls": _COUNTS["calls"], "connections": len(_COUNTS["connections"])}).encode()
+        self.send_response(200)
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start(port: int) -> ThreadingHTTPServer:
+    # バックグラウンドスレッドでスタブを起動する
+    server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+    threading.Thread(target=server.serve_forever, name="fake-openai", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    ThreadingHTTPServer(("127.0.0.1", int(sys.argv[1]) if len(sys.argv) > 1 else 5099), _Handler).serve_forever()
@@ -0,0 +1,105 @@
+# 発話との関連度でデバイスを順位づける軽量な語彙索引
+# 表示名・設置場所などの名前と、機能名・説明文・引数名の語を索引化し、出現するデバイスが少ない語ほど
+# 重く数える（IDF）。LLM のプロンプトには上位のデバイスだけ詳しい情報を載せるために使う
+import math
+import re
+import unicodedata
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Iterable, List, Sequence, Set, Tuple
+
+from intent_router import query_terms, tokenize
+
+# 日本語の名前・説明文は文字 bigram で照合する（分かち書きせずに部分一致を拾うため）
+_CJK_RUN_PATTERN = re.compile(r"[぀-ヿ㐀-鿿]+")
+# 発話にデバイスの名前がそのまま含まれる場合の加点（語の一致よりも強い手掛かりとして扱う）
+LABEL_MATCH_BONUS = 5.0
+# 英単語の前方一致を許す最短の長さ（"temperature" の発話で "temp" という機能名に一致させる）
+_MIN_PREFIX_LENGTH = 4
+
+
+@dataclass(frozen=True)
+class DeviceTerms:
+    # 1 台分の索引（labels は発話との部分一致を調べる名前、terms は照合に使う語と bigram）
+
+    labels: Tuple[str, ...]
+    terms: FrozenSet[str]
+
+
+def _normalise(text: str) -> str:
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+def _cjk_bigrams(text: str) -> Set[str]:
+    # 日本語の連続部分を 2 文字ずつに区切る（1 文字だけの部分はそのまま使う）
+    grams: Set[str] = set()
+    for run in _CJK_RUN_PATTERN.findall(text):
+        if len(run) == 1:
+            grams.add(run)
+        grams.update(run[index:index + 2] for index in range(len(run) - 1))
+    return grams
+
+
+def build_device_terms(labels: Iterable[str], texts: Iterable[str]) -> DeviceTerms:
+    # 名前（表示名・ID・設置場所）と説明的な文字列（機能名・説明文・引数名）から索引を作る
+    cleaned_labels = tuple(
+        label for label in (_normalise(raw).strip() for raw in labels if isinstance(raw, str)) if len(label) >= 2
+    )
+    terms: Set[str] = set()
+    for text in (*cleaned_labels, *(_normalise(raw) for raw in texts if isinstance(raw, str))):
+        terms |= tokenize(text)
+        terms |= _cjk_bigrams(text)
+    return DeviceTerms(cleaned_labels, frozenset(terms))
+
+
+def _query_concepts(text: str) -> List[FrozenSet[str]]:
+    # 発話を照合用の概念（同義語・前方一致用の接頭辞を含む語の集合、または日本語の bigram）に分解する
+    concepts: List[FrozenSet[str]] = []
+    for keyword in query_terms(text):
+        expanded = set(keyword)
+        for word in keyword:
+            expanded.update(word[:length] for length in range(_MIN_PREFIX_LENGTH, len(word)))
+        concepts.append(frozenset(expanded))
+    concepts.extend(frozenset({gram}) for gram in _cjk_bigrams(_normalise(text)))
+    return concepts
+
+
+def rank_devices(
+    queries: Sequence[Tuple[str, float]],
+    devices: Sequence[Tuple[str, DeviceTerms]],
+    limit: int,
+) -> List[str]:
+    # (発話, 重み) の並びに関連する順に device_id を最大 limit 件返す（関連が全く無いデバイスは含めない）
+    if limit <= 0 or not devices:
+        return []
+
+    weighted: Dict[FrozenSet[str], float] = {}
+    lowered_queries: List[Tuple[str, float]] = []
+    for text, weight in queries:
+        if not text or weight <= 0:
+            continue
+        lowered_queries.append((_normalise(text), weight))
+        for concept in _query_concepts(text):
+            weighted[concept] = max(weighted.get(concept, 0.0), weight)
+
+    # 各概念を含むデバイス数を数え、多くのデバイスに共通する語ほど軽くする
+    matches: Dict[FrozenSet[str], List[int]] = {}
+    for concept in weighted:
+        hits = [index for index, (_, entry) in enumerate(devices) if not concept.isdisjoint(entry.terms)]
+        if hits:
+            matches[concept] = hits
+
+    total = len(devices)
+    scores: Dict[int, float] = {}
+    for concept, hits in matches.items():
+        score = weighted[concept] * math.log(1 + total / len(hits))
+        for index in hits:
+            scores[index] = scores.get(index, 0.0) + score
+
+    for index, (_, entry) in enumerate(devices):
+        for text, weight in lowered_queries:
+            if any(label in text for label in entry.labels):
+                scores[index] = scores.get(index, 0.0) + LABEL_MATCH_BONUS * weight
+                break
+
+    ranked = sorted(scores, key=lambda index: (-scores[index], index))
+    return [devices[index][0] for index in ranked[:limit]]
@@ -25,11 +25,13 @@ import os
 import random
 import re
 import sys
+import threading
 import time
 import uuid
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Set, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 # HTTP 通信とローカル推論エンジンを扱う外部ライブラリを読み込む
 import requests
@@ -90,6 +92,17 @@ SERVER_BASE_URL = os.getenv(
 # HTTP タイムアウトやポーリング間隔など通信関連の設定
 REQUEST_TIMEOUT = float(os.getenv("IOT_AGENT_HTTP_TIMEOUT", "180"))
 POLL_INTERVAL = float(os.getenv("IOT_AGENT_POLL_INTERVAL", "2.0"))
+# ロングポーリングでサーバー側に待機させる秒数（0 で従来の短周期ポーリング）
+LONG_POLL_WAIT = float(os.getenv("IOT_AGENT_LONG_POLL_WAIT", "25"))
+# 1 回のポーリングでまとめて受け取るジョブの最大件数
+JOB_BATCH_SIZE = max(1, int(os.getenv("IOT_AGENT_JOB_BATCH_SIZE", "5")))
+# ジョブ受信方式（poll: ロングポーリング / sse: Server-Sent Events ストリーム /
+# ws: ジョブ・結果・ハートビートを 1 本で扱う WebSocket チャネル）
+JOB_TRANSPORT = os.getenv("IOT_AGENT_TRANSPORT", "poll").strip().lower()
+# SSE ストリームで keep-alive が途絶えたとみなすまでの読み取りタイムアウト（秒）
+STREAM_READ_TIMEOUT = float(os.getenv("IOT_AGENT_STREAM_READ_TIMEOUT", "60"))
+# ジョブ処理中にハートビートを送る間隔（秒）。サーバーの JOB_LEASE_SECONDS より短くする
+HEARTBEAT_INTERVAL = float(os.getenv("IOT_AGENT_HEARTBEAT_INTERVAL", "15"))
 
 # 自動登録フラグ（ブール文字列を解釈）
 _AUTO_REGISTER_RAW = os.getenv("IOT_AGENT_AUTO_REGISTER")
@@ -124,7 +137,15 @@ LOCATION = os.getenv("IOT_AGENT_LOCATION", "Lab")
 
 REGISTER_PATH = "/api/devices/register"
 NEXT_PATH = "/api/devices/{device_id}/jobs/next"
+STREAM_PATH = "/api/devices/{device_id}/jobs/stream"
+CHANNEL_PATH = "/api/devices/{device_id}/ws"
 RESULT_PATH = "/api/devices/{device_id}/jobs/result"
+RESULTS_BULK_PATH = "/api/devices/{device_id}/jobs/results"
+HEARTBEAT_PATH = "/api/devices/{device_id}/heartbeat"
+
+# 送信に失敗した結果を保持し、次回ポーリング前に一括再送する件数の上限
+MAX_UNDELIVERED_RESULTS = int(os.getenv("IOT_AGENT_MAX_UNDELIVERED_RESULTS", "100"))
+_UNDELIVERED_RESULTS: List[Dict[str, Any]] = []
 
 AGENT_ROLE_VALUE = "jetson-agent"           # 旧: raspberrypi-agent
 AGENT_COMMAND_NAME = "agent_instruction"
@@ -352,36 +373,45 @@ def _register_device(session: requests.Session, device_id: str) -> Tuple[bool, b
         return False, False
 
 
-def _poll_next_job(session: requests.Session, device_id: str) -> Optional[Dict[str, Any]]:
-    # サーバーから次のジョブを取得し、必要に応じて再登録を試みる
+def _handle_unregistered(session: requests.Session, device_id: str) -> None:
+    # サーバーが 404 を返した際にデバイスの再登録を試みる
+    logging.warning("Device not registered on server. Re-registering...")
+    _console(
+        "Server returned 404 for device '{}'. Triggering re-registration.".format(
+            device_id
+        )
+    )
+    registered, manual_required = _register_device(session, device_id)
+    if not registered and manual_required:
+        logging.warning(
+            "Server still waiting for manual approval of device '%s'.", device_id
+        )
+        _console(
+            "Device '{}' still awaiting manual approval on server.".format(device_id)
+        )
+
+
+def _poll_next_jobs(session: requests.Session, device_id: str) -> List[Dict[str, Any]]:
+    # サーバーから次のジョブ群を取得し、必要に応じて再登録を試みる
+    params: Dict[str, Any] = {"max": JOB_BATCH_SIZE}
+    if LONG_POLL_WAIT > 0:
+        params["wait"] = LONG_POLL_WAIT
     try:
         resp = session.get(
             _build_url(NEXT_PATH.format(device_id=device_id)),
-            timeout=REQUEST_TIMEOUT,
+            params=params,
+            timeout=REQUEST_TIMEOUT + max(LONG_POLL_WAIT, 0.0),
         )
     except Exception as exc:
         logging.error("Failed to poll for job: %s", exc)
-        return None
+        return []
 
     if resp.status_code == 204:
-        return None
+        return []
 
     if resp.status_code == 404:
-        logging.warning("Device not registered on server. Re-registering...")
-        _console(
-            "Server returned 404 for device '{}'. Triggering re-registration.".format(
-                device_id
-            )
-        )
-        registered, manual_required = _register_device(session, device_id)
-        if not registered and manual_required:
-            logging.warning(
-                "Server still waiting for manual approval of device '%s'.", device_id
-            )
-            _console(
-                "Device '{}' still awaiting manual approval on server.".format(device_id)
-            )
-        return None
+        _handle_unregistered(session, device_id)
+        return []
 
     if resp.status_code != 200:
         logging.error("Unexpected status from job endpoint: %s", resp.status_code)
@@ -391,19 +421,219 @@ def _poll_next_job(session: requests.Session, device_id: str) -> Optional[Dict[s
                 device_id,
             )
         )
-        return None
+        return []
 
     try:
-        job = resp.json()
+        data = resp.json()
+    except ValueError:
+        logging.error("Job payload is not valid JSON: %s", resp.text[:200])
+        _console("Received invalid job payload from server (JSON decode error).")
+        return []
+
+    # ?max= 非対応のサーバーは単一ジョブを返すため両方の形式を受け付ける
+    if isinstance(data, dict) and isinstance(data.get("jobs"), list):
+        jobs = [job for job in data["jobs"] if isinstance(job, dict)]
+    elif isinstance(data, dict):
+        jobs = [data]
+    else:
+        jobs = []
+
+    for job in jobs:
         job_id = job.get("job_id") or job.get("id")
         _console(
             "Received job {} from server.".format(job_id if job_id is not None else "<unknown>")
         )
-        return job
-    except json.JSONDecodeError:
-        logging.error("Job payload is not valid JSON: %s", resp.text[:200])
-        _console("Received invalid job payload from server (JSON decode error).")
-    return None
+    return jobs
+
+
+@contextmanager
+def _lease_heartbeat(device_id: str, job_ids: List[str]) -> Iterator[None]:
+    # 長いジョブの処理中もリースが切れて再配信されないよう、定期的にハートビートを送る
+    stop = threading.Event()
+    url = _build_url(HEARTBEAT_PATH.format(device_id=device_id))
+    payload = {"job_ids": [job_id for job_id in job_ids if job_id]}
+
+    def _beat() -> None:
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                # Session はメインスレッドと共有しないよう個別のリクエストで送る
+                requests.post(url, json=payload, timeout=REQUEST_TIMEOUT)
+            except requests.RequestException as exc:
+                logging.warning("Heartbeat failed: %s", exc)
+
+    thread = threading.Thread(target=_beat, name="lease-heartbeat", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+
+
+def _stream_jobs(session: requests.Session, llm: Llama, device_id: str) -> None:
+    # SSE ストリームでジョブを受信し、切断されるまで順に処理する
+    try:
+        resp = session.get(
+            _build_url(STREAM_PATH.format(device_id=device_id)),
+            headers={"Accept": "text/event-stream"},
+            stream=True,
+            timeout=(REQUEST_TIMEOUT, STREAM_READ_TIMEOUT),
+        )
+    except Exception as exc:
+        logging.error("Failed to open job stream: %s", exc)
+        return
+
+    with resp:
+        if resp.status_code == 404:
+            _handle_unregistered(session, device_id)
+            return
+        if resp.status_code != 200:
+            logging.error("Unexpected status from job stream: %s", resp.status_code)
+            _console(
+                "Job stream failed with status {} for device '{}'.".format(
+                    resp.status_code,
+                    device_id,
+                )
+            )
+            return
+
+        _console("Job stream connected for device '{}'.".format(device_id))
+        event_name: Optional[str] = None
+        data_lines: List[str] = []
+        try:
+            for line in resp.iter_lines(decode_unicode=True):
+                if line is None:
+                    continue
+                if line == "":
+                    # 空行でイベントが確定する
+                    if event_name == "job" and data_lines:
+                        try:
+                            job = json.loads("\n".join(data_lines))
+                        except ValueError:
+                            logging.error("Streamed job is not valid JSON: %s", data_lines)
+                            job = None
+                        if isinstance(job, dict):
+                            _console(
+                                "Received job {} from stream.".format(
+                                    job.get("job_id") or "<unknown>"
+                                )
+                            )
+                            with _lease_heartbeat(device_id, [job.get("job_id")]):
+                                _process_job(session, llm, device_id, job)
+                    elif event_name == "closed":
+                        _console("Server closed the job stream.")
+                        return
+                    event_name = None
+                    data_lines = []
+                    continue
+                if line.startswith(":"):
+                    continue
+                field_name, _, value = line.partition(":")
+                if value.startswith(" "):
+                    value = value[1:]
+                if field_name == "event":
+                    event_name = value
+                elif field_name == "data":
+                    data_lines.append(value)
+        except Exception as exc:
+            logging.error("Job stream interrupted: %s", exc)
+            _console("Job stream interrupted: {}".format(exc))
+
+
+def _channel_url(device_id: str) -> str:
+    # HTTP のベース URL から WebSocket チャネルの URL を組み立てる
+    url = _build_url(CHANNEL_PATH.format(device_id=device_id))
+    if url.startswith("https://"):
+        return "wss://" + url[len("https://"):]
+    if url.startswith("http://"):
+        return "ws://" + url[len("http://"):]
+    return url
+
+
+def _run_channel(session: requests.Session, llm: Llama, device_id: str) -> None:
+    # WebSocket チャネルでジョブを受信し、結果とハートビートも同じ接続で返す
+    try:
+        import websocket  # websocket-client
+    except ImportError:
+        logging.error("IOT_AGENT_TRANSPORT=ws requires the websocket-client package")
+        _console("websocket-client is not installed; falling back to polling.")
+        raise
+
+    try:
+        ws = websocket.create_connection(
+            _channel_url(device_id),
+            timeout=REQUEST_TIMEOUT,
+            header=["X-Device-ID: {}".format(device_id)],
+        )
+    except Exception as exc:
+        logging.error("Failed to open device channel: %s", exc)
+        return
+
+    stop = threading.Event()
+
+    def _send(message: Dict[str, Any]) -> bool:
+        try:
+            ws.send(json.dumps(message, ensure_ascii=False, default=str))
+            return True
+        except Exception as exc:
+            logging.error("Device channel send failed: %s", exc)
+            return False
+
+    def _heartbeat() -> None:
+        # ジョブ処理中もサーバーへ生存を通知し続ける
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            if not _send({"type": "heartbeat", "device_id": device_id, "ts": time.time()}):
+                return
+
+    def _report(payload: Dict[str, Any]) -> bool:
+        # 送信できなければ HTTP の結果エンドポイントで再送する
+        if _send(dict(payload, type="result")):
+            return True
+        return _post_result(session, payload)
+
+    heartbeat = threading.Thread(target=_heartbeat, name="channel-heartbeat", daemon=True)
+    heartbeat.start()
+    _console("Device channel connected for device '{}'.".format(device_id))
+    try:
+        ws.settimeout(None)
+        while True:
+            raw_message = ws.recv()
+            if not raw_message:
+                break
+            try:
+                message = json.loads(raw_message)
+            except ValueError:
+                logging.error("Device channel message is not valid JSON: %s", raw_message[:200])
+                continue
+            if not isinstance(message, dict):
+                continue
+
+            message_type = message.get("type")
+            if message_type == "job" and isinstance(message.get("job"), dict):
+                job = message["job"]
+                _console(
+                    "Received job {} from device channel.".format(job.get("job_id") or "<unknown>")
+                )
+                _process_job(session, llm, device_id, job, reporter=_report)
+            elif message_type == "ack" and message.get("status") != "ack":
+                logging.error(
+                    "Server rejected result for job %s: %s",
+                    message.get("job_id"),
+                    message.get("error"),
+                )
+            elif message_type == "closed":
+                _console("Server closed the device channel: {}".format(message.get("reason")))
+                if message.get("reason") == "device not registered":
+                    _handle_unregistered(session, device_id)
+                break
+    except Exception as exc:
+        logging.error("Device channel interrupted: %s", exc)
+        _console("Device channel interrupted: {}".format(exc))
+    finally:
+        stop.set()
+        try:
+            ws.close()
+        except Exception:
+            pass
 
 
 def _post_result(
@@ -476,9 +706,78 @@ def _post_result(
         )
         time.sleep(sleep_for)
 
+    _queue_undelivered_result(payload)
     return False
 
 
+def _queue_undelivered_result(payload: Dict[str, Any]) -> None:
+    # 送信できなかった結果を保持し、上限を超えた分は古いものから破棄
+    _UNDELIVERED_RESULTS.append(payload)
+    overflow = len(_UNDELIVERED_RESULTS) - MAX_UNDELIVERED_RESULTS
+    if overflow > 0:
+        dropped = _UNDELIVERED_RESULTS[:overflow]
+        del _UNDELIVERED_RESULTS[:overflow]
+        for item in dropped:
+            logging.error("Dropping undelivered result for job %s", item.get("job_id"))
+    _console(
+        "Result for job {} queued for bulk resend ({} pending).".format(
+            payload.get("job_id"),
+            len(_UNDELIVERED_RESULTS),
+        )
+    )
+
+
+def _flush_undelivered_results(session: requests.Session, device_id: str) -> bool:
+    # 未送信の結果を一括エンドポイントへまとめて送信する
+    if not _UNDELIVERED_RESULTS:
+        return True
+
+    batch = list(_UNDELIVERED_RESULTS)
+    url = _build_url(RESULTS_BULK_PATH.format(device_id=device_id))
+    try:
+        response = session.post(
+            url,
+            json={"results": batch},
+            headers={"X-Device-ID": device_id},
+            timeout=REQUEST_TIMEOUT,
+        )
+    except Exception as exc:
+        logging.error("Bulk result upload raised error: %s", exc)
+        return False
+
+    if response.status_code == 404:
+        # 一括エンドポイント非対応のサーバーには 1 件ずつ送信する
+        del _UNDELIVERED_RESULTS[: len(batch)]
+        for payload in batch:
+            _post_result(session, payload, max_attempts=1)
+        return not _UNDELIVERED_RESULTS
+
+    if not 200 <= response.status_code < 300:
+        logging.error(
+            "Bulk result upload failed with status %s (%s results pending)",
+            response.status_code,
+            len(batch),
+        )
+        return False
+
+    del _UNDELIVERED_RESULTS[: len(batch)]
+    try:
+        data = response.json()
+    except ValueError:
+        data = {}
+    acks = data.get("results") if isinstance(data, dict) else None
+    for ack in acks if isinstance(acks, list) else []:
+        if isinstance(ack, dict) and ack.get("status") != "ack":
+            # サーバーが拒否した結果は再送しても受理されないため破棄する
+            logging.error(
+                "Server rejected result for job %s: %s",
+                ack.get("job_id"),
+                ack.get("error"),
+            )
+    _console("Delivered {} queued results in one bulk upload.".format(len(batch)))
+    return True
+
+
 def _build_result_payload(
     *,
     device_id: str,
@@ -970,8 +1269,12 @@ def _process_job(
     llm: Llama,
     device_id: str,
     job: Dict[str, Any],
+    *,
+    reporter: Optional[Callable[[Dict[str, Any]], bool]] = None,
 ) -> None:
     # サーバーから受信したジョブを解析し、適切なアクションを実行
+    # reporter 指定時は結果を HTTP ではなくその関数（WebSocket 等）で返送する
+    report = reporter or (lambda result: _post_result(session, result))
     raw_job_id: Any = job.get("job_id")
     if raw_job_id is None and "id" in job:
         raw_job_id = job.get("id")
@@ -1007,7 +1310,7 @@ def _process_job(
                 result=None,
                 error=message,
             )
-            if not _post_result(session, payload):
+            if not report(payload):
                 logging.error("Failed to report mismatched device for job %s", job_id)
         return
 
@@ -1027,7 +1330,7 @@ def _process_job(
             result=None,
             error=message,
         )
-        if not _post_result(session, payload):
+        if not report(payload):
             logging.error("Failed to report missing command for job %s", job_id)
         return
 
@@ -1053,7 +1356,7 @@ def _process_job(
                 result=None,
                 error=message,
             )
-            if not _post_result(session, payload):
+            if not report(payload):
                 logging.error("Failed to report missing instruction for job %s", job_id)
             return
 
@@ -1136,7 +1439,7 @@ def _process_job(
             result=None,
             error=error_message,
         )
-        if not _post_result(session, payload):
+        if not report(payload):
             logging.error("Failed to report invalid action for job %s", job_id)
         _console(
             "Job {} failed: resolved action invalid, notified server.".format(job_id)
@@ -1223,9 +1526,9 @@ def _process_job(
             "Job {} message to user: {}".format(job_id, resolved_message)
         )
 
-    if not _post_result(session, result_payload):
+    if not report(result_payload):
         logging.error("Failed to deliver result for job %s", job_id)
-        _console("Job {} result delivery failed after retries.".format(job_id))
+        _console("Job {} result delivery failed after retries; will resend in bulk.".format(job_id))
 
 
 def main() -> None:
@@ -1289,16 +1592,42 @@ def main() -> None:
         )
         time.sleep(30 if manual_required else 10)
 
-    logging.info("Starting polling loop as %s", device_id)
-    _console("Entering polling loop as device '{}'.".format(device_id))
+    logging.info("Starting %s job loop as %s", JOB_TRANSPORT, device_id)
+    _console("Entering {} job loop as device '{}'.".format(JOB_TRANSPORT, device_id))
 
     try:
+        while JOB_TRANSPORT == "ws":
+            if _UNDELIVERED_RESULTS:
+                _flush_undelivered_results(session, device_id)
+            try:
+                _run_channel(session, llm, device_id)
+            except ImportError:
+                break
+            time.sleep(POLL_INTERVAL)
+
+        while JOB_TRANSPORT == "sse":
+            # ストリームが切れたら少し待って再接続する
+            if _UNDELIVERED_RESULTS:
+                _flush_undelivered_results(session, device_id)
+            _stream_jobs(session, llm, device_id)
+            time.sleep(POLL_INTERVAL)
+
         while True:
-            job = _poll_next_job(session, device_id)
-            if job:
-                _process_job(session, llm, device_id, job)
+            if _UNDELIVERED_RESULTS:
+                _flush_undelivered_results(session, device_id)
+            poll_started = time.monotonic()
+            jobs = _poll_next_jobs(session, device_id)
+            if jobs:
+                # 受け取ったバッチを全て処理してから次のポーリングを行う
+                with _lease_heartbeat(device_id, [job.get("job_id") for job in jobs]):
+                    for job in jobs:
+                        _process_job(session, llm, device_id, job)
             else:
-                time.sleep(POLL_INTERVAL)
+                # ロングポーリングが効いていれば待機済みなので即再接続し、
+                # エラーや非対応サーバーで即時応答された場合のみ間隔を空ける
+                elapsed = time.monotonic() - poll_started
+                if elapsed < POLL_INTERVAL:
+                    time.sleep(POLL_INTERVAL - elapsed)
     except KeyboardInterrupt:
         logging.info("Stopping agent")
         _console("Keyboard interrupt received. Stopping agent loop.")
@@ -19,7 +19,7 @@ MicroPython エッジデバイス向け IoT サーバークライアント（デ
   - Wi-Fi接続（secrets.py から SSID/PASS 読み込み）
   - デバイスID生成/保存（フラッシュに device_id.txt）
   - capabilities 登録（提供関数の一覧をサーバーへ通知）
-  - 1秒間隔ポーリングでサーバーからジョブ(JSON)取得
+  - ロングポーリング（?wait=）でサーバーからジョブ(JSON)取得
   - 指示JSONに基づきローカル関数を実行し、結果をPOST返却
 
 備考:
@@ -30,12 +30,13 @@ MicroPython エッジデバイス向け IoT サーバークライアント（デ
   - POST {BASE_URL}{REGISTER_PATH}
       req: {"device_id": "...", "capabilities": [...], "meta": {...}}
       res: 200/201 JSON
-  - GET  {BASE_URL}{NEXT_PATH.format(device_id="...")}
-      res: 204 (no job)
-           200 {"job_id":"...", "command":{"name":"led","args":{"times":3,"interval_sec":0.1}}}
-  - POST {BASE_URL}{RESULT_PATH.format(device_id="...")}
-      req: {"device_id":"...","job_id":"...","ok":true/false,
-            "return_value":..., "stdout":"...", "stderr":"...","ts":123456789}
+  - GET  {BASE_URL}{NEXT_PATH.format(device_id="...")}?max=5&wait=10
+      res: 204 (no job within wait seconds)
+           200 {"jobs":[{"job_id":"...", "command":{"name":"led","args":{"times":3,"interval_sec":0.1}}}, ...]}
+  - POST {BASE_URL}{RESULTS_BULK_PATH.format(device_id="...")}
+      req: {"results":[{"device_id":"...","job_id":"...","ok":true/false,
+            "return_value":..., "stdout":"...", "stderr":"...","ts":123456789}, ...]}
+      res: 200 {"status":"ack","results":[{"index":0,"job_id":"...","status":"ack"}, ...]}
 """
 
 import sys
@@ -74,6 +75,11 @@ try:
 except Exception:
     import io
 
+try:
+    import ubinascii as binascii  # type: ignore
+except Exception:
+    import binascii
+
 try:
     import builtins  # print のラップに使用
 except Exception:
@@ -89,6 +95,9 @@ BASE_URL = "https://iot-agent.project-kk.com"
 REGISTER_PATH = "/api/devices/register"
 NEXT_PATH = "/api/devices/{device_id}/jobs/next"
 RESULT_PATH = "/api/devices/{device_id}/jobs/result"
+RESULTS_BULK_PATH = "/api/devices/{device_id}/jobs/results"
+CHANNEL_PATH = "/api/devices/{device_id}/ws"
+HEARTBEAT_PATH = "/api/devices/{device_id}/heartbeat"
 
 # Wi-Fi 認証情報は secrets.py から読み込み（無ければ未設定扱い）
 WIFI_SSID = ""
@@ -115,6 +124,13 @@ except Exception:
 
 # ポーリングや登録関連の挙動を制御するパラメータ
 POLL_INTERVAL_SEC = 1  # 1秒間隔でサーバーをポーリング
+LONG_POLL_WAIT_SEC = 10  # ロングポーリングでサーバーに待機させる秒数（0 で無効）
+JOB_BATCH_SIZE = 5  # 1 回のポーリングでまとめて受け取るジョブの最大件数
+# ジョブ受信方式: "poll"（HTTP ロングポーリング）または "ws"（WebSocket チャネル）
+# ws ではジョブ・結果・ハートビートを 1 本の接続で扱い、TLS ハンドシェイクは接続時の 1 回のみ
+JOB_TRANSPORT = "poll"
+WS_HEARTBEAT_INTERVAL_SEC = 20  # WebSocket チャネルでハートビートを送る間隔（秒）
+LEASE_HEARTBEAT_INTERVAL_SEC = 15  # ジョブ処理中にリース延長のハートビートを送る間隔（秒）
 AUTO_REGISTER_ON_BOOT = False  # True にすると起動時に自動登録
 CAPABILITY_SYNC_ENABLED = True  # 手動登録後でも機能一覧をサーバーへ同期する
 CAPABILITY_RESYNC_INTERVAL_SEC = 30  # 同期失敗時の再試行間隔（秒）
@@ -150,6 +166,8 @@ ADC_TO_VOLT = 3.3 / 65535.0
 
 _wlan = None  # WLAN ハンドル
 _NOT_REGISTERED_WARNED = False
+# 処理中（結果未送信）ジョブのリース延長用の状態。スレッドが無いため処理の合間に送る
+_LEASE = {"device_id": "", "job_ids": [], "last_ms": 0}
 
 # =========================
 # ネットワーク/HTTP
@@ -373,6 +391,7 @@ def blink_led(times: int = 5, interval_sec: float = 0.2):
         time.sleep(interval_sec)
         LED_PIN.value(0)
         time.sleep(interval_sec)
+        lease_heartbeat_tick()
     print("[led] done")
     return True
 
@@ -387,6 +406,7 @@ def read_temperature(samples: int = 16, sample_interval_sec: float = 0.01):
         volts_sum += reading * ADC_TO_VOLT
         if sample_interval_sec > 0:
             time.sleep(sample_interval_sec)
+            lease_heartbeat_tick()
     vtemp = volts_sum / samples
     temp_c = 27.0 - (vtemp - 0.706) / 0.001721
     print("[temp] est -> {:.2f} C (avg of {})".format(temp_c, samples))
@@ -475,14 +495,20 @@ def register_device(base_url: str, device_id: str):
     return status
 
 
-def fetch_next_job(base_url: str, device_id: str):
+def fetch_next_jobs(base_url: str, device_id: str):
+    """次のジョブ群をまとめて取得する。ジョブが無ければ空リスト。"""
     global _NOT_REGISTERED_WARNED
-    url = "{}{}".format(base_url, NEXT_PATH.format(device_id=device_id))
-    status, text = http_get_text(url, timeout=HTTP_TIMEOUT_SEC)
+    url = "{}{}?max={}".format(base_url, NEXT_PATH.format(device_id=device_id), JOB_BATCH_SIZE)
+    timeout = HTTP_TIMEOUT_SEC
+    if LONG_POLL_WAIT_SEC > 0:
+        # ジョブが入るまでサーバー側で保留させ、空ポーリングと取得遅延を減らす
+        url = "{}&wait={}".format(url, LONG_POLL_WAIT_SEC)
+        timeout = HTTP_TIMEOUT_SEC + LONG_POLL_WAIT_SEC
+    status, text = http_get_text(url, timeout=timeout)
     if status == 204 or (status == 200 and not text.strip()):
         if _NOT_REGISTERED_WARNED:
             _NOT_REGISTERED_WARNED = False
-        return None  # no job
+        return []  # no job
     if status != 200:
         if status == 404:
             if not _NOT_REGISTERED_WARNED:
@@ -499,15 +525,113 @@ def fetch_next_job(base_url: str, device_id: str):
         if text:
             preview = text if len(text) <= HTTP_BODY_PREVIEW_LEN else text[:HTTP_BODY_PREVIEW_LEN] + "\n...[truncated]"
             print("[agent] next resp preview:\n" + preview)
-        return None
+        return []
     if _NOT_REGISTERED_WARNED:
         _NOT_REGISTERED_WARNED = False
     try:
-        job = json.loads(text)
-        return job
+        data = json.loads(text)
     except Exception as e:
         print("[agent] JSON parse error: {}".format(e))
-        return None
+        return []
+    # ?max= 非対応のサーバーは単一ジョブを返すため両方の形式を受け付ける
+    if isinstance(data, dict) and isinstance(data.get("jobs"), list):
+        return [job for job in data["jobs"] if isinstance(job, dict)]
+    if isinstance(data, dict):
+        return [data]
+    return []
+
+
+def build_result_payload(device_id: str, job_id: str, ok: bool, return_value, stdout_text: str, stderr_text: str):
+    """結果送信用のペイロードを生成"""
+    return {
+        "device_id": device_id,
+        "job_id": job_id,
+        "ok": bool(ok),
+        "return_value": return_value,
+        "stdout": stdout_text or "",
+        "stderr": stderr_text or "",
+        "ts": time.ticks_ms() & 0x7fffffff,
+    }
+
+
+def _is_not_registered_error(text) -> bool:
+    """404 の応答本文がサーバーの「デバイス未登録」エラーか（ルートが無い場合の 404 と区別する）"""
+    try:
+        data = json.loads(text) if text else None
+    except Exception:
+        return False
+    return isinstance(data, dict) and "not registered" in str(data.get("error") or "")
+
+
+def _handle_unregistered(base_url: str, device_id: str):
+    """結果送信時にデバイス未登録と言われたら再登録を試みる（結果は破棄せず再送に回す）"""
+    print("[agent] server says device '{}' is not registered; re-registering before resending results.".format(device_id))
+    try:
+        status = register_device(base_url, device_id)
+    except Exception as exc:
+        print("[agent] re-registration error: {}".format(exc))
+        return
+    if status == 403:
+        print("[agent] device still awaiting registration/approval from the dashboard.")
+
+
+def post_results_bulk(base_url: str, device_id: str, payloads):
+    """複数の結果を 1 リクエストで送信し、まだ届けられていない結果のリストを返す（空なら全件受領済み）。"""
+    url = "{}{}".format(base_url, RESULTS_BULK_PATH.format(device_id=device_id))
+    status, text = http_post_json(
+        url,
+        {"results": payloads},
+        timeout=HTTP_TIMEOUT_SEC,
+        extra_headers={"X-Device-ID": device_id},
+    )
+    print("[agent] bulk result status {} ({} results)".format(status, len(payloads)))
+
+    if status == 404 and _is_not_registered_error(text):
+        _handle_unregistered(base_url, device_id)
+        return list(payloads)
+
+    if status == 404:
+        # 一括エンドポイント非対応のサーバーには 1 件ずつ送信する
+        for index, payload in enumerate(payloads):
+            if not post_result(
+                base_url,
+                device_id,
+                payload.get("job_id"),
+                payload.get("ok"),
+                payload.get("return_value"),
+                payload.get("stdout"),
+                payload.get("stderr"),
+                max_attempts=1,
+            ):
+                return list(payloads[index:])
+        return []
+
+    if not 200 <= (status or 0) < 300:
+        if text:
+            preview = text if len(text) <= HTTP_BODY_PREVIEW_LEN else text[:HTTP_BODY_PREVIEW_LEN] + "\n...[truncated]"
+            print("[agent] bulk result resp preview:\n" + preview)
+        return list(payloads)
+
+    try:
+        data = json.loads(text) if text else {}
+    except Exception:
+        data = {}
+    acks = data.get("results") if isinstance(data, dict) else None
+    remaining = []
+    if isinstance(acks, list):
+        for ack in acks:
+            if not isinstance(ack, dict) or ack.get("status") == "ack":
+                continue
+            index = ack.get("index")
+            if ack.get("code") == 404 and isinstance(index, int) and 0 <= index < len(payloads):
+                # デバイス未登録で受理されなかった結果は、再登録後に再送する
+                remaining.append(payloads[index])
+                continue
+            # それ以外で拒否された結果は再送しても受理されないため破棄する
+            print("[agent] server rejected result for job {}: {}".format(ack.get("job_id"), ack.get("error")))
+    if remaining:
+        _handle_unregistered(base_url, device_id)
+    return remaining
 
 
 def post_result(
@@ -525,15 +649,7 @@ def post_result(
     # サーバーはパスパラメーターで device_id を受け取るため URL に埋め込む。
     # ボディとヘッダーにも同じ値を含めて送信し、整合性チェックに備える。
     url = "{}{}".format(base_url, RESULT_PATH.format(device_id=device_id))
-    payload = {
-        "device_id": device_id,
-        "job_id": job_id,
-        "ok": bool(ok),
-        "return_value": return_value,
-        "stdout": stdout_text or "",
-        "stderr": stderr_text or "",
-        "ts": time.ticks_ms() & 0x7fffffff,
-    }
+    payload = build_result_payload(device_id, job_id, ok, return_value, stdout_text, stderr_text)
     extra_headers = {"X-Device-ID": device_id}
     attempt = 0
     while attempt < max_attempts:
@@ -643,6 +759,264 @@ def _exec_with_capture(func, kwargs):
     return ok, ret, out_buf.getvalue(), err_buf.getvalue()
 
 
+def _job_id_of(item) -> str:
+    raw = item.get("job_id") or item.get("id")
+    return str(raw) if raw is not None else ""
+
+
+def track_leased_jobs(device_id: str, items):
+    """結果をまだ送っていないジョブ（未実行ジョブ・未送信の結果）をリース延長の対象にする"""
+    job_ids = [job_id for job_id in (_job_id_of(item) for item in items) if job_id]
+    if not _LEASE["job_ids"] and job_ids:
+        # 新しく受け取ったジョブは配信時点からリースが始まっている
+        _LEASE["last_ms"] = time.ticks_ms()
+    _LEASE["device_id"] = device_id
+    _LEASE["job_ids"] = job_ids
+
+
+def lease_heartbeat_tick():
+    """前回から LEASE_HEARTBEAT_INTERVAL_SEC 経っていれば処理中ジョブのリースを延長する"""
+    if not _LEASE["job_ids"]:
+        return
+    if time.ticks_diff(time.ticks_ms(), _LEASE["last_ms"]) < LEASE_HEARTBEAT_INTERVAL_SEC * 1000:
+        return
+    _LEASE["last_ms"] = time.ticks_ms()
+    device_id = _LEASE["device_id"]
+    url = "{}{}".format(BASE_URL, HEARTBEAT_PATH.format(device_id=device_id))
+    try:
+        status, _ = http_post_json(
+            url,
+            {"job_ids": _LEASE["job_ids"]},
+            timeout=HTTP_TIMEOUT_SEC,
+            extra_headers={"X-Device-ID": device_id},
+        )
+        print("[agent] lease heartbeat status {} ({} jobs)".format(status, len(_LEASE["job_ids"])))
+    except Exception as exc:
+        print("[agent] lease heartbeat failed: {}".format(exc))
+
+
+def run_job(device_id: str, job: dict):
+    """受信したジョブを実行し、結果送信用のペイロードを返す"""
+    raw_job_id = job.get("job_id") or job.get("id")
+    job_id = str(raw_job_id) if raw_job_id is not None else ""
+    cmd = job.get("command") or {}
+    name = (cmd.get("name") or "").strip().lower()
+    args = cmd.get("args") or {}
+
+    print("[agent] job received: id={} name={} args={}".format(
+        job_id,
+        name,
+        _format_for_log(args),
+    ))
+
+    if cmd.get("message"):
+        print("[agent] job note: {}".format(_format_for_log(cmd.get("message"))))
+
+    ok, ret, out, err = _exec_with_capture(
+        _call_function_by_name, {"name": name, "args": args}
+    )
+
+    # 長文は切り詰め
+    if out and len(out) > HTTP_BODY_PREVIEW_LEN:
+        out = out[:HTTP_BODY_PREVIEW_LEN] + "\n...[truncated]"
+    if err and len(err) > HTTP_BODY_PREVIEW_LEN:
+        err = err[:HTTP_BODY_PREVIEW_LEN] + "\n...[truncated]"
+
+    print(
+        "[agent] exec finished for job {}: ok={} return={}".format(
+            job_id,
+            ok,
+            _format_for_log(ret),
+        )
+    )
+    if out:
+        print("[agent] job {} captured stdout:\n{}".format(job_id, out))
+    if err:
+        print("[agent] job {} captured stderr:\n{}".format(job_id, err))
+    print(
+        "[agent] job {} result summary -> ok={} return={} stdout_len={} stderr_len={}".format(
+            job_id,
+            ok,
+            _format_for_log(ret),
+            len(out or ""),
+            len(err or ""),
+        )
+    )
+    return build_result_payload(device_id, job_id, ok, ret, out, err)
+
+
+# =========================
+# WebSocket チャネル
+# =========================
+def _is_timeout_error(exc) -> bool:
+    """ソケットの読み取りタイムアウトかどうかを判定（MicroPython/CPython 両対応）"""
+    code = exc.args[0] if getattr(exc, "args", None) else None
+    return code in (11, 110, 116, -110, -116) or "timed out" in str(exc)
+
+
+def _ws_connect(url: str, device_id: str):
+    """WebSocket ハンドシェイクを行い、(ストリーム, 生ソケット) を返す"""
+    ws_url = "http" + url[2:] if url.startswith("ws") else url
+    scheme, host, port, path = _parse_url(ws_url)
+    addr_info = socket.getaddrinfo(host, port)[0][-1]
+    raw = socket.socket()
+    raw.settimeout(WS_HEARTBEAT_INTERVAL_SEC)
+    raw.connect(addr_info)
+    stream = raw
+    if scheme == "https":
+        try:
+            stream = ssl.wrap_socket(raw, server_hostname=host)  # type: ignore
+        except Exception:
+            stream = ssl.wrap_socket(raw)  # type: ignore
+
+    key = binascii.b2a_base64(bytes([random.getrandbits(8) for _ in range(16)])).strip().decode()
+    req_lines = [
+        "GET {} HTTP/1.1".format(path),
+        "Host: {}".format(host),
+        "User-Agent: {}".format(USER_AGENT),
+        "Upgrade: websocket",
+        "Connection: Upgrade",
+        "Sec-WebSocket-Key: {}".format(key),
+        "Sec-WebSocket-Version: 13",
+        "X-Device-ID: {}".format(device_id),
+    ]
+    stream.write(("\r\n".join(req_lines) + "\r\n\r\n").encode("utf-8"))
+
+    status_line = stream.readline()
+    if b" 101 " not in status_line:
+        stream.close()
+        raise OSError("websocket handshake failed: {}".format(status_line))
+    while True:
+        line = stream.readline()
+        if not line or line == b"\r\n":
+            break
+    return stream, raw
+
+
+def _ws_send_frame(stream, opcode: int, payload: bytes):
+    """クライアント→サーバーのフレーム（マスク必須）を送信"""
+    length = len(payload)
+    header = bytearray([0x80 | opcode])
+    if length < 126:
+        header.append(0x80 | length)
+    elif length < 65536:
+        header.append(0x80 | 126)
+        header.extend(length.to_bytes(2, "big"))
+    else:
+        header.append(0x80 | 127)
+        header.extend(length.to_bytes(8, "big"))
+    mask = bytes([random.getrandbits(8) for _ in range(4)])
+    masked = bytearray(payload)
+    for i in range(length):
+        masked[i] ^= mask[i & 3]
+    stream.write(bytes(header) + mask + bytes(masked))
+
+
+def _ws_send_json(stream, obj):
+    _ws_send_frame(stream, 0x1, json.dumps(obj).encode("utf-8"))
+
+
+def _ws_read_exact(stream, size: int) -> bytes:
+    """フレーム途中の読み取り。タイムアウトしても受信を続けてフレーム境界を保つ"""
+    buf = b""
+    while len(buf) < size:
+        try:
+            chunk = stream.read(size - len(buf))
+        except OSError as exc:
+            if _is_timeout_error(exc):
+                continue
+            raise
+        if not chunk:
+            raise OSError("websocket closed")
+        buf += chunk
+    return buf
+
+
+def _ws_recv_frame(stream):
+    """1 フレームを受信して (opcode, payload) を返す。先頭バイトのタイムアウトは呼び出し側へ送出"""
+    first = stream.read(1)
+    if not first:
+        raise OSError("websocket closed")
+    second = _ws_read_exact(stream, 1)[0]
+    opcode = first[0] & 0x0F
+    length = second & 0x7F
+    if length == 126:
+        length = int.from_bytes(_ws_read_exact(stream, 2), "big")
+    elif length == 127:
+        length = int.from_bytes(_ws_read_exact(stream, 8), "big")
+    mask = _ws_read_exact(stream, 4) if second & 0x80 else None
+    payload = _ws_read_exact(stream, length) if length else b""
+    if mask:
+        payload = bytearray(payload)
+        for i in range(length):
+            payload[i] ^= mask[i & 3]
+        payload = bytes(payload)
+    return opcode, payload
+
+
+def run_channel(base_url: str, device_id: str, undelivered):
+    """WebSocket チャネルでジョブ受信・結果返送・ハートビートを行う。切断されたら戻る。"""
+    url = "{}{}".format(base_url, CHANNEL_PATH.format(device_id=device_id))
+    stream, _raw = _ws_connect(url, device_id)
+    print("[agent] channel connected -> {}".format(url))
+    last_heartbeat = time.ticks_ms()
+    try:
+        while True:
+            if time.ticks_diff(time.ticks_ms(), last_heartbeat) >= WS_HEARTBEAT_INTERVAL_SEC * 1000:
+                _ws_send_json(stream, {"type": "heartbeat", "device_id": device_id})
+                last_heartbeat = time.ticks_ms()
+
+            try:
+                opcode, payload = _ws_recv_frame(stream)
+            except OSError as exc:
+                if _is_timeout_error(exc):
+                    continue
+                raise
+
+            if opcode == 0x8:
+                print("[agent] channel closed by server.")
+                return
+            if opcode == 0x9:
+                _ws_send_frame(stream, 0xA, payload)
+                continue
+            if opcode != 0x1:
+                continue
+
+            try:
+                message = json.loads(payload)
+            except Exception as e:
+                print("[agent] channel JSON parse error: {}".format(e))
+                continue
+            if not isinstance(message, dict):
+                continue
+
+            message_type = message.get("type")
+            if message_type == "job" and isinstance(message.get("job"), dict):
+                track_leased_jobs(device_id, [message["job"]])
+                result = run_job(device_id, message["job"])
+                track_leased_jobs(device_id, [])
+                outgoing = dict(result)
+                outgoing["type"] = "result"
+                try:
+                    _ws_send_json(stream, outgoing)
+                except Exception:
+                    # 送れなかった結果は HTTP の一括エンドポイントで再送する
+                    undelivered.append(result)
+                    raise
+                last_heartbeat = time.ticks_ms()
+                gc.collect()
+            elif message_type == "ack" and message.get("status") != "ack":
+                print("[agent] server rejected result for job {}: {}".format(message.get("job_id"), message.get("error")))
+            elif message_type == "closed":
+                print("[agent] channel closed: {}".format(message.get("reason")))
+                return
+    finally:
+        try:
+            stream.close()
+        except Exception:
+            pass
+
+
 def agent_loop():
     """Wi-Fi接続 -> 登録 -> 1秒ポーリング -> 実行 -> 結果返送"""
     if not ensure_wifi():
@@ -711,7 +1085,8 @@ def agent_loop():
             _schedule_capability_sync(CAPABILITY_RESYNC_INTERVAL_SEC)
 
     backoff = 0
-    pending_result = None
+    queued_jobs = []  # バッチ取得した未実行ジョブ
+    pending_results = []  # 未送信の結果ペイロード
     pending_attempt = 0
     while True:
         try:
@@ -723,34 +1098,29 @@ def agent_loop():
                     else:
                         _schedule_capability_sync(CAPABILITY_RESYNC_INTERVAL_SEC)
 
-            if pending_result is not None:
-                job_id, ok, ret, out, err = pending_result
+            # バッチを実行し終えたら、溜まった結果を 1 リクエストでまとめて返送する
+            if pending_results and not queued_jobs:
                 print(
-                    "[agent] retrying result delivery for job {} (attempt {}).".format(
-                        job_id,
+                    "[agent] delivering {} results (attempt {}).".format(
+                        len(pending_results),
                         pending_attempt + 1,
                     )
                 )
-                success = post_result(
-                    BASE_URL,
-                    device_id,
-                    job_id,
-                    ok,
-                    ret,
-                    out,
-                    err,
-                    max_attempts=1,
-                )
-                if success:
-                    print("[agent] result delivery confirmed for job {}".format(job_id))
+                remaining = post_results_bulk(BASE_URL, device_id, pending_results)
+                for payload in pending_results:
+                    if payload in remaining:
+                        continue
+                    print("[agent] result delivery confirmed for job {}".format(payload.get("job_id")))
                     print(
                         "[agent] job {} final return payload: {}".format(
-                            job_id,
-                            _format_for_log(ret),
+                            payload.get("job_id"),
+                            _format_for_log(payload.get("return_value")),
                         )
                     )
-                    pending_result = None
+                pending_results = remaining
+                if not remaining:
                     pending_attempt = 0
+                    track_leased_jobs(device_id, [])
                     gc.collect()
                     time.sleep(POLL_INTERVAL_SEC)
                     continue
@@ -760,68 +1130,38 @@ def agent_loop():
                     if delay > 30:
                         delay = 30
                     print(
-                        "[agent] result delivery still failing for job {}. Retrying in {}s.".format(
-                            job_id, delay
+                        "[agent] result delivery still failing for {} results. Retrying in {}s.".format(
+                            len(pending_results), delay
                         )
                     )
                     time.sleep(delay)
                     continue
 
-            job = fetch_next_job(BASE_URL, device_id)
-            if not job:
-                if backoff > 0:
-                    backoff -= 1
+            if JOB_TRANSPORT == "ws":
+                run_channel(BASE_URL, device_id, pending_results)
                 time.sleep(POLL_INTERVAL_SEC)
                 continue
 
-            raw_job_id = job.get("job_id") or job.get("id")
-            job_id = str(raw_job_id) if raw_job_id is not None else ""
-            cmd = job.get("command") or {}
-            name = (cmd.get("name") or "").strip().lower()
-            args = cmd.get("args") or {}
-
-            print("[agent] job received: id={} name={} args={}".format(
-                job_id,
-                name,
-                _format_for_log(args),
-            ))
-
-            if cmd.get("message"):
-                print("[agent] job note: {}".format(_format_for_log(cmd.get("message"))))
-
-            ok, ret, out, err = _exec_with_capture(
-                _call_function_by_name, {"name": name, "args": args}
-            )
+            if not queued_jobs:
+                poll_started = time.ticks_ms()
+                queued_jobs = fetch_next_jobs(BASE_URL, device_id)
+                if not queued_jobs:
+                    if backoff > 0:
+                        backoff -= 1
+                    # ロングポーリングで既に待機した場合は即座に再取得する
+                    elapsed_ms = time.ticks_diff(time.ticks_ms(), poll_started)
+                    if elapsed_ms < POLL_INTERVAL_SEC * 1000:
+                        time.sleep_ms(POLL_INTERVAL_SEC * 1000 - elapsed_ms)
+                    continue
 
-            # 長文は切り詰め
-            if out and len(out) > HTTP_BODY_PREVIEW_LEN:
-                out = out[:HTTP_BODY_PREVIEW_LEN] + "\n...[truncated]"
-            if err and len(err) > HTTP_BODY_PREVIEW_LEN:
-                err = err[:HTTP_BODY_PREVIEW_LEN] + "\n...[truncated]"
+            # バッチの残りを全て実行してから次のポーリングを行う
+            # 後ろのジョブや未送信の結果のリースが実行待ちの間に切れないよう、合間にハートビートを送る
+            track_leased_jobs(device_id, queued_jobs + pending_results)
+            lease_heartbeat_tick()
+            job = queued_jobs.pop(0)
 
-            print(
-                "[agent] exec finished for job {}: ok={} return={}".format(
-                    job_id,
-                    ok,
-                    _format_for_log(ret),
-                )
-            )
-            if out:
-                print("[agent] job {} captured stdout:\n{}".format(job_id, out))
-            if err:
-                print("[agent] job {} captured stderr:\n{}".format(job_id, err))
-            print(
-                "[agent] job {} result summary -> ok={} return={} stdout_len={} stderr_len={}".format(
-                    job_id,
-                    ok,
-                    _format_for_log(ret),
-                    len(out or ""),
-                    len(err or ""),
-                )
-            )
             backoff = 0
-            pending_result = (job_id, ok, ret, out, err)
-            pending_attempt = 0
+            pending_results.append(run_job(device_id, job))
             continue
 
         except KeyboardInterrupt:
@@ -0,0 +1,50 @@
+# Gunicorn 設定
+# WEB_CONCURRENCY でワーカー数を指定でき、2 以上の場合はデバイス・ジョブ状態を保持する
+# ブローカープロセスを起動して全ワーカーで状態を共有する（state_broker.py を参照）
+import multiprocessing
+import os
+import secrets
+import tempfile
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5006")
+# ロングポーリングや結果待機でリクエストが長時間保留されるため、スレッドワーカーで起動する
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "64"))
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+_broker_process = None
+
+
+def on_starting(server):
+    # ワーカーを fork する前にブローカーを起動し、接続先をワーカーへ環境変数で引き継ぐ
+    global _broker_process
+    if server.cfg.workers <= 1:
+        return
+
+    from state_broker import run_state_broker
+
+    address = os.getenv("STATE_BROKER_ADDRESS") or os.path.join(
+        tempfile.gettempdir(), f"iot-agent-broker-{os.getpid()}.sock"
+    )
+    os.environ["STATE_BROKER_ADDRESS"] = address
+    os.environ.setdefault("STATE_BROKER_AUTHKEY", secrets.token_hex(16))
+
+    context = multiprocessing.get_context("spawn")
+    _broker_process = context.Process(
+        target=run_state_broker, args=(address,), name="iot-agent-state-broker", daemon=True
+    )
+    _broker_process.start()
+    server.log.info("Started state broker (pid %s) at %s", _broker_process.pid, address)
+
+
+def post_worker_init(worker):
+    # OPENAI_WARMUP が有効なら、ワーカーごとの OpenAI API 接続プールを起動直後に温めておく
+    from app import start_openai_warmup
+
+    start_openai_warmup()
+
+
+def on_exit(server):
+    if _broker_process is not None and _broker_process.is_alive():
+        _broker_process.terminate()
+        _broker_process.join(timeout=5)
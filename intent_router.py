@@ -0,0 +1,301 @@
+# チャットの最新メッセージを登録済みデバイスの機能へ直接対応づける決定的な意図ルーター
+# 「LED を 3 回点滅して」「温度を教えて」のような単発の直接操作だけをコマンドへ変換し、
+# 少しでも確信が持てない入力は None を返して LLM の計画に任せる
+import re
+import unicodedata
+from dataclasses import dataclass, field
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Sequence, Set, Tuple
+
+# 日本語の言い回し → 機能名・説明文・引数名に現れる英単語
+_SYNONYMS: Dict[str, Tuple[str, ...]] = {
+    "led": ("led",),
+    "ライト": ("light", "led"),
+    "ランプ": ("lamp", "light", "led"),
+    "点滅": ("blink", "flash"),
+    "チカチカ": ("blink", "flash"),
+    "光らせ": ("blink", "light", "flash"),
+    "点灯": ("on", "light", "turn"),
+    "消灯": ("off", "light", "turn"),
+    "温度": ("temperature", "temp"),
+    "気温": ("temperature", "temp"),
+    "何度": ("temperature", "temp"),
+    "湿度": ("humidity",),
+    "気圧": ("pressure",),
+    "明るさ": ("brightness", "light", "lux"),
+    "照度": ("brightness", "light", "lux"),
+    "サイコロ": ("dice", "die"),
+    "さいころ": ("dice", "die"),
+    "ダイス": ("dice", "die"),
+    "振って": ("roll",),
+    "振る": ("roll",),
+    "ふって": ("roll",),
+    "天気": ("weather", "forecast"),
+    "時刻": ("time", "clock"),
+    "何時": ("time", "clock"),
+    "写真": ("photo", "picture", "camera", "capture"),
+    "撮影": ("photo", "capture", "camera"),
+    "カメラ": ("camera", "photo"),
+    "ブザー": ("buzzer", "beep"),
+    "鳴らし": ("beep", "buzz", "sound", "play"),
+    "モーター": ("motor",),
+    "ファン": ("fan",),
+    "測って": ("read", "measure", "get"),
+    "計って": ("read", "measure", "get"),
+    "測定": ("read", "measure", "get"),
+    "計測": ("read", "measure", "get"),
+    "読んで": ("read", "get"),
+    "教えて": ("read", "get"),
+    "調べて": ("read", "get", "check"),
+    "確認": ("read", "get", "check"),
+}
+
+_SYNONYM_PATTERN = re.compile(
+    "|".join(re.escape(keyword) for keyword in sorted(_SYNONYMS, key=len, reverse=True)),
+    re.IGNORECASE,
+)
+_WORD_PATTERN = re.compile(r"[a-z][a-z0-9]*")
+_NAME_SPLIT_PATTERN = re.compile(r"[^a-z0-9]+|(?<=[a-z])(?=[0-9])")
+_CAMEL_PATTERN = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+# 数値と単位（漢数字は単位付きのときだけ数値とみなす）
+_NUMBER_PATTERN = re.compile(
+    r"(?P<value>\d+(?:\.\d+)?)\s*(?P<unit>回|times?|ミリ秒|ms|秒|seconds?|secs?|s\b)?"
+    r"|(?P<kanji>[一二三四五六七八九十]+)\s*(?P<kanji_unit>回|秒)",
+    re.IGNORECASE,
+)
+# 複数の操作や条件付きの依頼は LLM に任せる
+_COMPOUND_PATTERN = re.compile(
+    r"てから|それから|そして|その後|そのあと|した後|たら|れば|なら|ついでに|あとで|もう一度|もう一回|再度"
+    r"|and then|after that|\bthen\b|\bagain\b",
+    re.IGNORECASE,
+)
+# 否定（「〜ないで」「〜なくていい」「〜ず」「必要はない」など）は実行しない依頼かもしれないため必ず LLM に任せる
+_NEGATION_PATTERN = re.compile(
+    r"ない|なく|ず|必要は|不要|するな|やめて|止めて|止めろ|中止|キャンセル|取り消"
+    r"|\bnot?\b|n't|never|\bstop\b|\bcancel\b|\bdon'?t\b",
+    re.IGNORECASE,
+)
+# 疑問形（末尾の ?、「できる?」「してる?」「したっけ?」）は状態や可否の質問で、操作の依頼とは限らない
+_QUESTION_PATTERN = re.compile(
+    r"[?？]\s*$|とは|って何|ってなに|何ができ|なにができ|どうやって|どうすれば|仕組み|説明して|使い方"
+    r"|できる|できま|できない|られる|てる|ている|てます|ていま|たっけ|だっけ|でしょうか|ですか|ますか|かな"
+    r"|what is|what can|how do|how to|\bcan you\b|\bis it\b|\bdid\b",
+    re.IGNORECASE,
+)
+# 過去や別の時点を指す依頼（「昨日の温度」など）は今の計測結果では答えられない
+_PAST_TIME_PATTERN = re.compile(
+    r"昨日|きのう|一昨日|おととい|先週|先月|去年|昨年|さっき|先ほど|先程|前回|以前|過去|この前|今朝|明日|あした"
+    r"|yesterday|earlier|last (?:time|week|month|night)|previous|ago|tomorrow",
+    re.IGNORECASE,
+)
+_COUNT_PARAM_PATTERN = re.compile(r"times|count|repeat|samples|iterations|^n$|^num", re.IGNORECASE)
+_SECONDS_PARAM_PATTERN = re.compile(r"sec|second|interval|duration|delay|wait", re.IGNORECASE)
+_NUMERIC_TYPES = frozenset({"int", "integer", "float", "number", "double"})
+_STOPWORDS = frozenset(
+    {
+        "a", "an", "the", "and", "or", "of", "to", "for", "on", "in", "at", "by", "with",
+        "from", "it", "its", "is", "be", "this", "that", "return", "returns", "result",
+        "value", "values", "please", "me", "my", "device", "onboard", "internal",
+    }
+)
+# 「教えて」「測って」などの汎用の動詞。機能の説明文に現れなくても依頼の内容は変わらない
+_GENERIC_VERBS = frozenset({"read", "get", "measure", "check"})
+_KANJI_DIGITS = {"一": 1, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+
+# 1 件のメッセージとして扱う最大文字数（長い依頼は複数の意図を含みやすい）
+MAX_ROUTABLE_LENGTH = 80
+
+
+@dataclass
+class RouteTarget:
+    # ルーティング対象のデバイス（labels は発話中でデバイスを指す名前）
+
+    device_id: str
+    capabilities: Sequence[Dict[str, Any]]
+    labels: Tuple[str, ...] = ()
+
+
+@dataclass
+class RoutedCommand:
+    # 意図ルーターが決定したコマンド
+
+    device_id: str
+    name: str
+    args: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class _CapabilityIndex:
+    name: str
+    name_tokens: FrozenSet[str]
+    tokens: FrozenSet[str]
+    params: List[Dict[str, Any]]
+
+
+def tokenize(text: str) -> Set[str]:
+    # 機能名・説明文などを英単語へ分割する（snake_case・camelCase・数字の境界でも区切る）
+    words: Set[str] = set()
+    for raw in _CAMEL_PATTERN.sub(" ", text).lower().split():
+        for word in _NAME_SPLIT_PATTERN.split(raw):
+            if word and word not in _STOPWORDS and not word.isdigit():
+                words.add(word)
+    return words
+
+
+def query_terms(text: str) -> List[FrozenSet[str]]:
+    # 発話からキーワードを取り出す（日本語の言い回しは対応する英単語の集合に、英単語はそのまま 1 語の集合にする）
+    normalised = unicodedata.normalize("NFKC", text or "")
+    keywords: List[FrozenSet[str]] = []
+    for match in _SYNONYM_PATTERN.finditer(normalised):
+        keywords.append(frozenset(_SYNONYMS[match.group(0).lower()]))
+    for word in _WORD_PATTERN.findall(normalised.lower()):
+        if word not in _STOPWORDS and word not in _SYNONYMS:
+            keywords.append(frozenset({word}))
+    return keywords
+
+
+def _overlaps(concepts: FrozenSet[str], tokens: FrozenSet[str]) -> bool:
+    # 発話の語が機能側の語と一致するか（"temp" と "temperature" のような略語の前方一致も含む）
+    return any(
+        concept in tokens or any(len(token) >= 3 and concept.startswith(token) for token in tokens)
+        for concept in concepts
+    )
+
+
+def _kanji_number(text: str) -> int:
+    # 「三」「十二」「二十」などの漢数字（99 まで）を整数にする
+    if "十" not in text:
+        return _KANJI_DIGITS.get(text[-1], 0)
+    tens, _, ones = text.partition("十")
+    return _KANJI_DIGITS.get(tens, 1) * 10 + (_KANJI_DIGITS.get(ones, 0) if ones else 0)
+
+
+class IntentRouter:
+    # 機能一覧をデバイスごとに索引化して保持し、発話を 1 件のコマンドへ対応づける
+
+    def __init__(self) -> None:
+        # device_id → (索引化した時点の capabilities, 索引)。capabilities が差し替わったら作り直す
+        self._index_cache: Dict[str, Tuple[Any, List[_CapabilityIndex]]] = {}
+
+    def route(self, text: str, targets: Iterable[RouteTarget]) -> Optional[RoutedCommand]:
+        # 確信を持って 1 件のコマンドに決まる場合だけ RoutedCommand を返す
+        normalised = unicodedata.normalize("NFKC", text or "").strip()
+        if not normalised or len(normalised) > MAX_ROUTABLE_LENGTH:
+            return None
+        if (
+            _COMPOUND_PATTERN.search(normalised)
+            or _NEGATION_PATTERN.search(normalised)
+            or _QUESTION_PATTERN.search(normalised)
+            or _PAST_TIME_PATTERN.search(normalised)
+        ):
+            return None
+
+        lowered = normalised.lower()
+        keywords = query_terms(normalised)
+        if not keywords:
+            return None
+
+        # (一致したキーワード数, デバイス指名の有無, device_id, 索引)
+        candidates: List[Tuple[int, bool, str, _CapabilityIndex]] = []
+        mentioned_labels: List[str] = []
+        for target in targets:
+            labels = [label for label in (target.device_id, *target.labels) if label]
+            mentioned = [label for label in labels if label.lower() in lowered]
+            mentioned_labels.extend(mentioned)
+            for capability in self._index(target):
+                matched = [concepts for concepts in keywords if _overlaps(concepts, capability.tokens)]
+                hits_name = any(_overlaps(concepts, capability.name_tokens) for concepts in matched)
+                if hits_name and len(matched) >= 2:
+                    candidates.append((len(matched), bool(mentioned), target.device_id, capability))
+
+        if not candidates:
+            return None
+        if any(candidate[1] for candidate in candidates):
+            candidates = [candidate for candidate in candidates if candidate[1]]
+        best_score = max(candidate[0] for candidate in candidates)
+        best = [candidate for candidate in candidates if candidate[0] == best_score]
+        if len(best) != 1 or any(
+            candidate[3].name != best[0][3].name for candidate in candidates if candidate is not best[0]
+        ):
+            # 同点のデバイスがある・別の機能も候補に残る場合は、曖昧か複数の操作の依頼とみなす
+            return None
+
+        _, _, device_id, capability = best[0]
+        label_words = {word for label in mentioned_labels for word in tokenize(label)}
+        for concepts in keywords:
+            if _overlaps(concepts, capability.tokens) or concepts <= _GENERIC_VERBS or concepts <= label_words:
+                continue
+            # 選んだ機能で扱えない語（「温度と湿度」の湿度など）が残る場合は、依頼の一部を取りこぼすので任せる
+            return None
+
+        for label in sorted(set(mentioned_labels), key=len, reverse=True):
+            # デバイス名に含まれる数字を引数として読まないよう取り除く
+            normalised = re.sub(re.escape(label), " ", normalised, flags=re.IGNORECASE)
+        args = self._extract_args(normalised, capability.params)
+        if args is None:
+            return None
+        return RoutedCommand(device_id=device_id, name=capability.name, args=args)
+
+    def _index(self, target: RouteTarget) -> List[_CapabilityIndex]:
+        cached = self._index_cache.get(target.device_id)
+        if cached is not None and cached[0] is target.capabilities:
+            return cached[1]
+        index: List[_CapabilityIndex] = []
+        for capability in target.capabilities:
+            if not isinstance(capability, dict) or not isinstance(capability.get("name"), str):
+                continue
+            name = capability["name"].strip()
+            params = [param for param in capability.get("params") or [] if isinstance(param, dict)]
+            name_tokens = tokenize(name) | {name.lower()}
+            tokens = set(name_tokens)
+            description = capability.get("description")
+            if isinstance(description, str):
+                tokens |= tokenize(description)
+            for param in params:
+                tokens |= tokenize(str(param.get("name", "")))
+            index.append(_CapabilityIndex(name, frozenset(name_tokens), frozenset(tokens), params))
+        self._index_cache[target.device_id] = (target.capabilities, index)
+        return index
+
+    def _extract_args(self, text: str, params: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        # 発話中の数値を引数へ割り当てる。割り当て先が一意に決まらない数値があれば None
+        numeric_params = [
+            param
+            for param in params
+            if str(param.get("type", "")).lower() in _NUMERIC_TYPES
+            or isinstance(param.get("default"), (int, float)) and not isinstance(param.get("default"), bool)
+        ]
+        args: Dict[str, Any] = {}
+        for match in _NUMBER_PATTERN.finditer(text):
+            if match.group("kanji"):
+                value: float = _kanji_number(match.group("kanji"))
+                unit = match.group("kanji_unit")
+            else:
+                value = float(match.group("value"))
+                unit = (match.group("unit") or "").lower()
+            if unit in {"回", "time", "times"}:
+                pattern: Optional["re.Pattern[str]"] = _COUNT_PARAM_PATTERN
+            elif unit in {"ミリ秒", "ms"}:
+                pattern, value = _SECONDS_PARAM_PATTERN, value / 1000
+            elif unit:
+                pattern = _SECONDS_PARAM_PATTERN
+            else:
+                pattern = None
+            choices = [
+                param
+                for param in numeric_params
+                if param["name"] not in args and (pattern is None or pattern.search(param["name"]))
+            ]
+            if len(choices) != 1:
+                return None
+            param = choices[0]
+            if str(param.get("type", "")).lower() in {"int", "integer"} or isinstance(param.get("default"), int):
+                if value != int(value):
+                    return None
+                args[param["name"]] = int(value)
+            else:
+                args[param["name"]] = value
+
+        for param in params:
+            if param.get("required") and "default" not in param and param.get("name") not in args:
+                return None
+        return args
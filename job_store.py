@@ -0,0 +1,235 @@
+# app.py のデバイス・ジョブ状態を永続化するストレージエンジン
+# メモリ上の辞書が常に正となり、ここでは変更の書き出しと起動時の復元のみを扱う
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class JobStore:
+    # 永続化を行わないメモリエンジン（従来どおりプロセス再起動で状態が消える）
+
+    name = "memory"
+
+    def load(self) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+        # 保存済みの (デバイス一覧, ジョブメタデータ一覧, job_id → 完了結果) を返す
+        return [], [], {}
+
+    def save_device(self, record: Dict[str, Any]) -> None:
+        pass
+
+    def delete_device(self, device_id: str) -> None:
+        pass
+
+    def save_job(self, record: Dict[str, Any]) -> None:
+        pass
+
+    def save_result(self, job_id: str, result: Dict[str, Any]) -> None:
+        pass
+
+    def delete_jobs(self, job_ids: Iterable[str]) -> None:
+        pass
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        # 受け付け済みの書き込みがすべてコミットされるまで待つ
+        return True
+
+    def close(self) -> None:
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {"engine": self.name}
+
+
+class SQLiteJobStore(JobStore):
+    # SQLite（WAL モード）へ書き出すエンジン。書き込みは専用スレッドでまとめてコミットする
+
+    name = "sqlite"
+
+    def __init__(self, path: str, *, commit_interval: float = 0.05, max_batch: int = 1000) -> None:
+        self.path = path
+        self.commit_interval = max(0.0, commit_interval)
+        self.max_batch = max(1, max_batch)
+        # (テーブル, キー) → SQL と引数。同じ行への連続した更新は最後の 1 件だけを書き込む
+        self._pending: Dict[Tuple[str, str], Tuple[str, Tuple[Any, ...]]] = {}
+        self._condition = threading.Condition()
+        self._submitted = 0
+        self._committed = 0
+        self._commits = 0
+        self._rows_written = 0
+        self._closed = False
+
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # WAL ではコミットごとの fsync を省いてもデータベースの整合性は保たれる
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS devices (
+                device_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                device_id TEXT,
+                status TEXT,
+                queued_at REAL,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                job_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            """
+        )
+
+        self._writer = threading.Thread(target=self._writer_loop, name="job-store-writer", daemon=True)
+        self._writer.start()
+
+    def load(self) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+        # 削除済みデバイスのジョブ・結果が残っていても復元しない
+        with self._condition:
+            devices = [json.loads(row[0]) for row in self._connection.execute("SELECT data FROM devices")]
+            jobs = [
+                json.loads(row[0])
+                for row in self._connection.execute(
+                    "SELECT data FROM jobs WHERE device_id IN (SELECT device_id FROM devices) ORDER BY queued_at"
+                )
+            ]
+            results = {
+                row[0]: json.loads(row[1])
+                for row in self._connection.execute(
+                    "SELECT results.job_id, results.data FROM results JOIN jobs ON jobs.job_id = results.job_id"
+                    " WHERE jobs.device_id IN (SELECT device_id FROM devices)"
+                )
+            }
+        return devices, jobs, results
+
+    def _submit(self, key: Tuple[str, str], sql: str, params: Tuple[Any, ...]) -> None:
+        # 呼び出し時点の内容を直列化して書き込み待ちに積み、書き込みスレッドを起こす
+        with self._condition:
+            if self._closed:
+                return
+            self._pending.pop(key, None)
+            self._pending[key] = (sql, params)
+            self._submitted += 1
+            if len(self._pending) >= self.max_batch or len(self._pending) == 1:
+                self._condition.notify_all()
+
+    def save_device(self, record: Dict[str, Any]) -> None:
+        device_id = record["device_id"]
+        self._submit(
+            ("devices", device_id),
+            "INSERT OR REPLACE INTO devices (device_id, data) VALUES (?, ?)",
+            (device_id, json.dumps(record, ensure_ascii=False, default=str)),
+        )
+
+    def delete_device(self, device_id: str) -> None:
+        # デバイスのジョブと完了結果も消す（結果はジョブ経由で特定するため先に消す）
+        self._submit(("devices", device_id), "DELETE FROM devices WHERE device_id = ?", (device_id,))
+        self._submit(
+            ("device_results", device_id),
+            "DELETE FROM results WHERE job_id IN (SELECT job_id FROM jobs WHERE device_id = ?)",
+            (device_id,),
+        )
+        self._submit(("device_jobs", device_id), "DELETE FROM jobs WHERE device_id = ?", (device_id,))
+
+    def save_job(self, record: Dict[str, Any]) -> None:
+        job_id = record["job_id"]
+        self._submit(
+            ("jobs", job_id),
+            "INSERT OR REPLACE INTO jobs (job_id, device_id, status, queued_at, data) VALUES (?, ?, ?, ?, ?)",
+            (
+                job_id,
+                record.get("device_id"),
+                record.get("status"),
+                record.get("queued_at"),
+                json.dumps(record, ensure_ascii=False, default=str),
+            ),
+        )
+
+    def save_result(self, job_id: str, result: Dict[str, Any]) -> None:
+        self._submit(
+            ("results", job_id),
+            "INSERT OR REPLACE INTO results (job_id, data) VALUES (?, ?)",
+            (job_id, json.dumps(result, ensure_ascii=False, default=str)),
+        )
+
+    def delete_jobs(self, job_ids: Iterable[str]) -> None:
+        for job_id in job_ids:
+            self._submit(("jobs", job_id), "DELETE FROM jobs WHERE job_id = ?", (job_id,))
+            self._submit(("results", job_id), "DELETE FROM results WHERE job_id = ?", (job_id,))
+
+    def _writer_loop(self) -> None:
+        # 書き込み待ちを commit_interval ごとに 1 トランザクションへまとめてコミットする
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending and self._closed:
+                    return
+                wait_for_more = self.commit_interval and len(self._pending) < self.max_batch
+            if wait_for_more:
+                # 少し待って後続の書き込みを同じトランザクションに相乗りさせる
+                time.sleep(self.commit_interval)
+            with self._condition:
+                batch = list(self._pending.values())
+                self._pending.clear()
+                submitted = self._submitted
+            try:
+                self._connection.execute("BEGIN")
+                for sql, params in batch:
+                    self._connection.execute(sql, params)
+                self._connection.execute("COMMIT")
+            except sqlite3.Error:
+                # 書き込みスレッドは止めず、失敗したバッチを記録して次へ進む
+                _LOGGER.exception("Failed to commit %d job store writes", len(batch))
+                try:
+                    self._connection.execute("ROLLBACK")
+                except sqlite3.Error:
+                    pass
+            finally:
+                with self._condition:
+                    self._committed = submitted
+                    self._commits += 1
+                    self._rows_written += len(batch)
+                    self._condition.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        with self._condition:
+            target = self._submitted
+            return self._condition.wait_for(
+                lambda: self._committed >= target or not self._writer.is_alive(), timeout=timeout
+            )
+
+    def close(self) -> None:
+        self.flush(timeout=10)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._writer.join(timeout=10)
+        self._connection.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._condition:
+            return {
+                "engine": self.name,
+                "path": self.path,
+                "pending_writes": len(self._pending),
+                "commits": self._commits,
+                "rows_written": self._rows_written,
+            }
+
+
+def create_job_store(engine: str, *, path: str, commit_interval: float) -> JobStore:
+    # JOB_STORE の値からストレージエンジンを生成する
+    normalised = (engine or "memory").strip().lower()
+    if normalised == "memory":
+        return JobStore()
+    if normalised == "sqlite":
+        return SQLiteJobStore(path, commit_interval=commit_interval)
+    raise ValueError(f"Unknown JOB_STORE engine: {engine!r} (expected 'memory' or 'sqlite')")
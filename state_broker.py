@@ -0,0 +1,58 @@
+# 複数の Gunicorn ワーカーでデバイス・ジョブ状態を共有するためのブローカープロセス
+# 状態は 1 つのブローカープロセスだけが保持し、各ワーカーはローカルソケット経由で操作する。
+# ロングポーリングや結果待ちはブローカー内のスレッドで待機するため、別ワーカーで
+# 投入されたジョブや届いた結果でも即座に待機者が起きる
+import os
+import signal
+import sys
+import time
+from multiprocessing.managers import BaseManager
+from typing import Any
+
+# ブローカープロセス側で app モジュールを読み込む際に設定する役割名
+BROKER_ROLE = "broker"
+
+
+class _BrokerManager(BaseManager):
+    pass
+
+
+def broker_authkey() -> bytes:
+    # ブローカーとワーカーで共有する認証キー
+    return os.getenv("STATE_BROKER_AUTHKEY", os.getenv("FLASK_SECRET_KEY", "change-this-secret")).encode()
+
+
+def serve_state_broker(service: Any, address: str) -> None:
+    # service の公開メソッドをローカルソケットで提供し続ける（接続ごとにスレッドで処理）
+    if os.path.exists(address):
+        os.unlink(address)
+    _BrokerManager.register("state", callable=lambda: service)
+    manager = _BrokerManager(address=address, authkey=broker_authkey())
+    manager.get_server().serve_forever()
+
+
+def connect_state_broker(address: str, timeout: float = 30.0) -> Any:
+    # ブローカーへ接続し、状態操作用のプロキシを返す（起動直後は準備完了まで再試行する）
+    _BrokerManager.register("state")
+    deadline = time.monotonic() + timeout
+    while True:
+        manager = _BrokerManager(address=address, authkey=broker_authkey())
+        try:
+            manager.connect()
+            return manager.state()
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.1)
+
+
+def run_state_broker(address: str) -> None:
+    # Gunicorn マスターから別プロセスとして起動されるエントリーポイント
+    # マスター終了時の terminate()（SIGTERM）を通常終了に変え、atexit でジョブストアの未コミット分を書き出す
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    os.environ["IOT_AGENT_STATE_ROLE"] = BROKER_ROLE
+    import app as app_module
+
+    # 非同期モードのチャットはブローカー内で実行されるため、ブローカーの接続プールも温めておく
+    app_module.start_openai_warmup()
+    serve_state_broker(app_module.DeviceStateService(), address)
@@ -0,0 +1,43 @@
+# 共有状態モードのワーカーが持つデバイスのミラーが、ブローカー側のジョブ数をプロンプトへ反映することを確かめる
+import app as iot_app
+
+
+class _SnapshotBroker:
+    def __init__(self, records):
+        self.records = records
+
+    def device_snapshot(self):
+        return self.records
+
+
+def _record(queue_depth, pending_jobs):
+    return {
+        "device_id": "pico",
+        "capabilities": [{"name": "led", "description": "Blink onboard LED.", "params": []}],
+        "meta": {"display_name": "Pico"},
+        "queue_depth": queue_depth,
+        "pending_jobs": pending_jobs,
+        "last_seen": 1_700_000_000.0,
+        "registered_at": 1_700_000_000.0,
+        "last_result": None,
+        "approved": True,
+    }
+
+
+def test_mirror_prompt_uses_broker_job_counts(monkeypatch):
+    broker = _SnapshotBroker([_record(3, 4)])
+    monkeypatch.setattr(iot_app, "_BROKER", broker)
+    monkeypatch.setattr(iot_app, "_DEVICES", {})
+
+    iot_app._sync_device_mirror()
+    context = iot_app._build_device_context()
+    assert "Queue depth: 3" in context
+    assert "Jobs running on device: 1" in context
+    assert iot_app._serialize_device(iot_app._DEVICES["pico"])["queue_depth"] == 3
+
+    # 内容が同じでもジョブ数が変われば、引き継いだキャッシュではなく新しい値で描画し直す
+    broker.records = [_record(0, 0)]
+    iot_app._sync_device_mirror()
+    context = iot_app._build_device_context()
+    assert "Queue depth: 0" in context
+    assert "Jobs running on device" not in context
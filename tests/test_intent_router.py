@@ -0,0 +1,106 @@
+# 意図ルーターの判定表: LLM を介さずに実行してよい発話と、必ず LLM に任せる発話
+import pytest
+
+from intent_router import IntentRouter, RouteTarget
+
+PICO_CAPABILITIES = [
+    {"name": "dice", "description": "Roll a 6-sided dice and return result.", "params": []},
+    {
+        "name": "led",
+        "description": "Blink onboard LED.",
+        "params": [
+            {"name": "times", "type": "int", "default": 5, "required": False},
+            {"name": "interval_sec", "type": "float", "default": 0.2, "required": False},
+        ],
+    },
+    {
+        "name": "temp",
+        "description": "Read internal temperature sensor (Celsius).",
+        "params": [
+            {"name": "samples", "type": "int", "default": 16, "required": False},
+            {"name": "sample_interval_sec", "type": "float", "default": 0.01, "required": False},
+        ],
+    },
+]
+ENV_CAPABILITIES = [
+    {"name": "read_humidity", "description": "Read relative humidity (%).", "params": []},
+    {"name": "read_pressure", "description": "Read barometric pressure in hPa.", "params": []},
+]
+BOARD_CAPABILITIES = [
+    {
+        "name": "blink_led",
+        "description": "Blink the LED.",
+        "params": [{"name": "times", "type": "int", "default": 3}],
+    },
+    {"name": "read_temperature", "description": "Read the temperature sensor.", "params": []},
+]
+
+PICO_TARGETS = [
+    RouteTarget("pico", PICO_CAPABILITIES, ("Pico",)),
+    RouteTarget("env-sensor", ENV_CAPABILITIES, ("環境センサー",)),
+]
+BOARD_TARGETS = [RouteTarget("board", BOARD_CAPABILITIES)]
+
+ROUTED = [
+    ("LEDを3回点滅させて", ("pico", "led", {"times": 3})),
+    ("LEDを点滅して", ("pico", "led", {})),
+    ("ＬＥＤを５回チカチカさせて", ("pico", "led", {"times": 5})),
+    ("LEDを0.5秒間隔で10回点滅", ("pico", "led", {"interval_sec": 0.5, "times": 10})),
+    ("LEDを三回光らせて", ("pico", "led", {"times": 3})),
+    ("blink the LED 3 times", ("pico", "led", {"times": 3})),
+    ("温度を教えて", ("pico", "temp", {})),
+    ("今の温度を測って", ("pico", "temp", {})),
+    ("Picoの温度を確認して", ("pico", "temp", {})),
+    ("read the temperature", ("pico", "temp", {})),
+    ("サイコロを振って", ("pico", "dice", {})),
+    ("roll the dice", ("pico", "dice", {})),
+    ("湿度を教えて", ("env-sensor", "read_humidity", {})),
+    ("気圧を測定して", ("env-sensor", "read_pressure", {})),
+    ("環境センサーの湿度を確認", ("env-sensor", "read_humidity", {})),
+]
+
+# 実行してはいけない・実行するか分からない発話（否定・疑問・過去・複合・曖昧）
+NOT_ROUTED = [
+    "LEDを3回点滅させないで",
+    "LEDを点滅させなくていいよ",
+    "LEDを点滅させる必要はない",
+    "LEDを点滅させずに温度を教えて",
+    "LEDは点滅してる?",
+    "LEDを5回点滅できる?",
+    "LEDを点滅させたっけ?",
+    "温度を教えて?",
+    "昨日の温度を教えて",
+    "さっきの温度を教えて",
+    "don't blink the LED",
+    "LEDを点滅させてから温度を教えて",
+    "LEDを点滅して温度も教えて",
+    "LEDの状態を教えて",
+    "LEDって何?",
+    "点滅をやめて",
+    "サイコロ",
+    "こんにちは",
+    "温度が30度を超えたらLEDを点滅して",
+    "LEDを3回点滅、そのあと2秒待ってもう一度",
+    "何ができますか?",
+    "温度と湿度を教えて",
+    "LEDを2回と3回点滅",
+]
+
+
+@pytest.mark.parametrize("text,expected", ROUTED)
+def test_routes_direct_commands(text, expected):
+    routed = IntentRouter().route(text, PICO_TARGETS)
+    assert routed is not None, text
+    assert (routed.device_id, routed.name, routed.args) == expected
+
+
+@pytest.mark.parametrize("text", NOT_ROUTED)
+@pytest.mark.parametrize("targets", [PICO_TARGETS, BOARD_TARGETS], ids=["pico", "board"])
+def test_leaves_other_messages_to_llm(text, targets):
+    assert IntentRouter().route(text, targets) is None
+
+
+def test_board_targets_still_route_plain_commands():
+    router = IntentRouter()
+    assert router.route("LEDを3回点滅させて", BOARD_TARGETS).args == {"times": 3}
+    assert router.route("温度を教えて", BOARD_TARGETS).name == "read_temperature"
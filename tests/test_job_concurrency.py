@@ -0,0 +1,153 @@
+# 分割ロック下のジョブキューの並行性テスト: 多数のスレッドから追加・取り出し・キャンセル・完了を
+# 同時に行い、ジョブが失われたり二重に配信されたりしないことを確かめる
+import random
+import threading
+import time
+import uuid
+
+import pytest
+
+import app as iot_app
+
+DEVICE_COUNT = 4
+PRODUCERS_PER_DEVICE = 3
+JOBS_PER_PRODUCER = 150
+CONSUMERS_PER_DEVICE = 3
+CANCELLERS = 4
+
+
+@pytest.fixture
+def devices():
+    device_ids = ["stress-{}".format(uuid.uuid4().hex[:8]) for _ in range(DEVICE_COUNT)]
+    with iot_app._STATE_LOCK:
+        for device_id in device_ids:
+            iot_app._DEVICES[device_id] = iot_app.DeviceState(
+                device_id=device_id,
+                capabilities=[{"name": "ping", "params": []}],
+                meta={},
+                approved=True,
+            )
+    yield device_ids
+    with iot_app._STATE_LOCK:
+        for device_id in device_ids:
+            iot_app._DEVICES.pop(device_id, None)
+
+
+def _run_threads(threads):
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=60)
+        assert not thread.is_alive(), thread.name
+
+
+def test_no_job_is_lost_or_delivered_twice(devices):
+    enqueued = []
+    delivered = []
+    cancelled = []
+    errors = []
+    record_lock = threading.Lock()
+    producers_done = threading.Event()
+    consumers_done = threading.Event()
+
+    def produce(device_id):
+        try:
+            for index in range(JOBS_PER_PRODUCER):
+                job_id = iot_app._enqueue_device_command(
+                    device_id,
+                    {"name": "ping", "args": {"n": index}},
+                    source=random.choice(["llm", "api"]),
+                )
+                assert job_id is not None
+                with record_lock:
+                    enqueued.append(job_id)
+        except Exception as exc:  # pragma: no cover - 失敗時の診断用
+            errors.append(exc)
+
+    def consume(device_id):
+        device = iot_app._DEVICES[device_id]
+        rng = random.Random()
+        try:
+            while True:
+                jobs = iot_app._take_device_jobs(device_id, timeout=0.01, limit=rng.randint(1, 4))
+                assert jobs is not None
+                if not jobs:
+                    if producers_done.is_set() and not device.job_queue:
+                        return
+                    continue
+                if rng.random() < 0.2:
+                    # 書き込みに失敗した想定で、未配信のままキューへ戻す
+                    iot_app._return_undelivered_jobs(device_id, jobs)
+                    continue
+                time.sleep(rng.random() * 0.001)
+                iot_app._confirm_jobs_dispatched(jobs)
+                with record_lock:
+                    delivered.extend(job["job_id"] for job in jobs)
+                for job in jobs:
+                    iot_app._record_job_result(device, job["job_id"], {"ok": True, "return_value": 1})
+        except Exception as exc:  # pragma: no cover - 失敗時の診断用
+            errors.append(exc)
+
+    def cancel():
+        rng = random.Random()
+        try:
+            while not consumers_done.is_set():
+                # 取り出し中・配信済みのジョブも狙い、キャンセルと配信が両方成功しないことを確かめる
+                with record_lock:
+                    if not enqueued:
+                        continue
+                    job_id = rng.choice(enqueued)
+                body, status = iot_app._cancel_queued_job(job_id)
+                if status == 200 and body.get("status") == "cancelled":
+                    with record_lock:
+                        if job_id not in cancelled:
+                            cancelled.append(job_id)
+                else:
+                    assert status in (404, 409), (status, body)
+        except Exception as exc:  # pragma: no cover - 失敗時の診断用
+            errors.append(exc)
+
+    producers = [
+        threading.Thread(target=produce, args=(device_id,), name="producer-{}-{}".format(device_id, index))
+        for device_id in devices
+        for index in range(PRODUCERS_PER_DEVICE)
+    ]
+    consumers = [
+        threading.Thread(target=consume, args=(device_id,), name="consumer-{}-{}".format(device_id, index))
+        for device_id in devices
+        for index in range(CONSUMERS_PER_DEVICE)
+    ]
+    cancellers = [threading.Thread(target=cancel, name="canceller-{}".format(index)) for index in range(CANCELLERS)]
+
+    for thread in consumers + cancellers:
+        thread.start()
+    _run_threads(producers)
+    producers_done.set()
+    for thread in consumers:
+        thread.join(timeout=60)
+        assert not thread.is_alive(), thread.name
+    consumers_done.set()
+    for thread in cancellers:
+        thread.join(timeout=60)
+        assert not thread.is_alive(), thread.name
+
+    assert not errors, errors
+    assert len(enqueued) == DEVICE_COUNT * PRODUCERS_PER_DEVICE * JOBS_PER_PRODUCER
+    assert len(set(enqueued)) == len(enqueued)
+    assert delivered and cancelled
+    # 二重配信が無く、キャンセルされたジョブは配信されず、どちらでもないジョブも無い
+    assert len(set(delivered)) == len(delivered)
+    assert not set(delivered) & set(cancelled)
+    assert set(delivered) | set(cancelled) == set(enqueued)
+
+    for job_id in delivered:
+        assert iot_app._JOB_METADATA[job_id]["status"] == "completed"
+        assert job_id not in iot_app._PENDING_JOBS
+    for job_id in cancelled:
+        assert iot_app._JOB_METADATA[job_id]["status"] == "cancelled"
+        assert job_id not in iot_app._PENDING_JOBS
+    for device_id in devices:
+        device = iot_app._DEVICES[device_id]
+        assert not device.job_queue
+        assert not device.pending_job_ids
+        assert not device.leased_job_ids
@@ -0,0 +1,85 @@
+# SQLite ジョブストアの削除・復元と、再起動時の完了結果の保持期限を確かめる
+import time
+
+import app as iot_app
+from job_store import JobStore, SQLiteJobStore
+
+
+def _job(job_id, device_id, status="completed", completed_at=None):
+    return {
+        "job_id": job_id,
+        "device_id": device_id,
+        "command": {"name": "led", "args": {}},
+        "queued_at": (completed_at or time.time()) - 1,
+        "status": status,
+        "completed_at": completed_at,
+    }
+
+
+def test_delete_device_removes_its_jobs_and_results(tmp_path):
+    path = str(tmp_path / "store.db")
+    store = SQLiteJobStore(path, commit_interval=0)
+    for device_id in ("keep", "gone"):
+        store.save_device({"device_id": device_id, "capabilities": [], "meta": {}})
+        store.save_job(_job(f"{device_id}-1", device_id, completed_at=time.time()))
+        store.save_result(f"{device_id}-1", {"job_id": f"{device_id}-1", "ok": True})
+    store.flush()
+    store.delete_device("gone")
+    store.close()
+
+    reopened = SQLiteJobStore(path, commit_interval=0)
+    devices, jobs, results = reopened.load()
+    rows = reopened._connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+    reopened.close()
+    assert [device["device_id"] for device in devices] == ["keep"]
+    assert [job["job_id"] for job in jobs] == ["keep-1"]
+    assert list(results) == ["keep-1"]
+    assert rows == 1
+
+
+def test_load_skips_rows_of_deleted_devices(tmp_path):
+    store = SQLiteJobStore(str(tmp_path / "store.db"), commit_interval=0)
+    store.save_device({"device_id": "keep", "capabilities": [], "meta": {}})
+    store.save_job(_job("orphan-1", "gone", completed_at=time.time()))
+    store.save_result("orphan-1", {"job_id": "orphan-1", "ok": True})
+    store.flush()
+    _, jobs, results = store.load()
+    store.close()
+    assert jobs == [] and results == {}
+
+
+class _LoadedStore(JobStore):
+    def __init__(self, devices, jobs, results):
+        self.snapshot = (devices, jobs, results)
+        self.deleted = []
+
+    def load(self):
+        return self.snapshot
+
+    def delete_jobs(self, job_ids):
+        self.deleted.extend(job_ids)
+
+
+def test_restored_results_keep_their_original_age(monkeypatch):
+    now = time.time()
+    store = _LoadedStore(
+        [{"device_id": "pico", "capabilities": [], "meta": {}, "approved": True}],
+        [
+            _job("old", "pico", completed_at=now - 7200),
+            _job("recent", "pico", completed_at=now - 600),
+        ],
+        {"old": {"job_id": "old", "ok": True}, "recent": {"job_id": "recent", "ok": True}},
+    )
+    monkeypatch.setattr(iot_app, "_JOB_STORE", store)
+    monkeypatch.setattr(iot_app, "_DEVICES", {})
+    monkeypatch.setattr(iot_app, "_JOB_METADATA", {})
+    monkeypatch.setattr(iot_app, "_PENDING_JOBS", {})
+    monkeypatch.setattr(iot_app, "_COMPLETED_JOBS", iot_app.CompletedJobStore())
+    monkeypatch.setattr(iot_app, "COMPLETED_JOB_TTL", 3600)
+
+    iot_app._restore_from_store()
+
+    # 保持期限（1 時間）を過ぎて完了していた結果は、再起動で新しい期限を得ずに破棄される
+    assert "old" not in iot_app._COMPLETED_JOBS
+    assert "recent" in iot_app._COMPLETED_JOBS
+    assert store.deleted == ["old"]
@@ -0,0 +1,80 @@
+# 共有状態モードのワーカーが HTTP をその場で処理し、ブローカーへは状態操作だけを送ることを確かめる
+import multiprocessing
+
+import app as iot_app
+from state_broker import connect_state_broker, run_state_broker
+
+
+class _RecordingBroker:
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args):
+            self.calls.append((name, args))
+            return self.replies.get(name)
+
+        return call
+
+    replies = {
+        "take_device_jobs": [{"job_id": "j1", "command": {"name": "led", "args": {}}}],
+        "accept_result": ({"status": "ack"}, 200),
+        "device_heartbeat": None,
+    }
+
+
+def test_worker_routes_send_state_operations(monkeypatch):
+    broker = _RecordingBroker()
+    monkeypatch.setattr(iot_app, "_BROKER", broker)
+    client = iot_app.app.test_client()
+
+    response = client.get("/api/devices/pico/jobs/next?wait=5")
+    assert response.get_json()["job_id"] == "j1"
+
+    response = client.post("/api/devices/pico/jobs/result", json={"job_id": "j1", "ok": True}, headers={"X-Device-ID": "pico"})
+    assert response.get_json() == {"status": "ack"}
+
+    response = client.post("/api/devices/pico/heartbeat", json={"job_ids": [" j1 "]})
+    assert response.status_code == 404
+
+    assert [name for name, _ in broker.calls] == [
+        "take_device_jobs",
+        "confirm_dispatched",
+        "accept_result",
+        "device_heartbeat",
+    ]
+    assert broker.calls[0][1] == ("pico", 5.0, 1)
+    assert broker.calls[2][1] == ("j1", [None, "", "pico", "pico"], {"job_id": "j1", "ok": True})
+    assert broker.calls[3][1] == ("pico", ["j1"])
+
+
+def _start_broker(address):
+    process = multiprocessing.get_context("spawn").Process(target=run_state_broker, args=(address,), daemon=True)
+    process.start()
+    return process, connect_state_broker(address, timeout=60)
+
+
+def test_broker_restart_restores_state_written_before_sigterm(tmp_path, monkeypatch):
+    # コミット待ちの書き込みが残っている間に SIGTERM で止めても、再起動後に状態が戻る
+    monkeypatch.setenv("JOB_STORE", "sqlite")
+    monkeypatch.setenv("JOB_STORE_PATH", str(tmp_path / "state.db"))
+    monkeypatch.setenv("JOB_STORE_COMMIT_INTERVAL", "2")
+    monkeypatch.setenv("STATE_BROKER_AUTHKEY", "test")
+
+    process, broker = _start_broker(str(tmp_path / "first.sock"))
+    try:
+        broker.register_device("pico", [{"name": "led", "description": "", "params": []}], {}, True)
+        job_id = broker.enqueue_command("pico", {"name": "led", "args": {}}, "api", None, None)
+    finally:
+        process.terminate()
+        process.join(timeout=15)
+    assert process.exitcode == 0
+
+    # プロキシは接続先ごとに接続を使い回すため、再起動後は別のソケットで待ち受ける
+    process, broker = _start_broker(str(tmp_path / "second.sock"))
+    try:
+        assert broker.device_record("pico")["approved"] is True
+        assert broker.job_status(job_id)["status"] == "pending"
+    finally:
+        process.terminate()
+        process.join(timeout=15)
@@ -0,0 +1,43 @@
+# 定型文の要約表: LLM を呼ばずに日本語の定型文で返す結果と、必ず LLM に要約させる結果
+import pytest
+
+import app as iot_app
+
+TEMPLATED = [
+    ({"ok": True, "return_value": 23.45, "stdout": "[temp] est -> 23.45 C (avg of 16)\n"}, "結果は 23.45 です。"),
+    ({"ok": True, "return_value": 4}, "結果は 4 です。"),
+    ({"ok": True, "return_value": "21.5"}, "結果は 21.5 です。"),
+    ({"ok": True, "return_value": 0.1 + 0.2}, "結果は 0.3 です。"),
+    ({"ok": True, "return_value": True, "stdout": "[led] blinking 3 times @ 0.200s\n[led] done\n"}, "正常に完了しました。"),
+    ({"ok": True, "return_value": False}, "結果は「いいえ」でした。"),
+    ({"ok": True, "return_value": None}, "正常に完了しました。"),
+]
+
+# 数値・真偽値・値なし以外の戻り値や、英語の出力・失敗を含む結果
+NOT_TEMPLATED = [
+    {"ok": True, "return_value": "sunny"},
+    {"ok": True, "return_value": "OK"},
+    {"ok": True, "return_value": {"temp": 21.5, "humidity": 40}},
+    {"ok": True, "return_value": [1, 2, 3]},
+    {"ok": True, "return_value": float("nan")},
+    {"ok": True, "return_value": None, "stdout": "Door is closed."},
+    {"ok": True, "return_value": 3, "stderr": "warning: sensor not calibrated"},
+    {"ok": False, "return_value": None, "error": "timeout"},
+]
+
+
+def _summary(result):
+    return iot_app._CommandExecutionSummary(device_id="pico", command_name="read", result=result)
+
+
+@pytest.mark.parametrize("result,outcome", TEMPLATED)
+def test_simple_results_use_japanese_templates(result, outcome):
+    reply = iot_app._template_step_reply(_summary(result))
+    assert reply is not None and reply.endswith("『read』を実行しました。" + outcome)
+    assert "True" not in reply and "False" not in reply and "None" not in reply
+
+
+@pytest.mark.parametrize("result", NOT_TEMPLATED)
+def test_other_results_are_left_to_the_llm(result):
+    assert iot_app._template_step_reply(_summary(result)) is None
+    assert iot_app._template_summary([_summary({"ok": True, "return_value": 1}), _summary(result)]) is None